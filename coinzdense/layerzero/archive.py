@@ -0,0 +1,261 @@
+"""Content-addressed deduplicating archive format for stored signatures
+
+Signatures made with the same level keys repeat the same level salts, merkle
+nodes, level pubkeys and upper level signatures. These are hash outputs that
+generic compression can not shrink, so the archive interns them instead: a
+layout function splits every record into literal and internable fields, every
+distinct internable field is stored once in a blob table, and records are
+stored as a sequence of literals and blob references.
+
+File layout (all fixed width integers big-endian)::
+
+    magic "CZAR" (4) | version (1) | reserved (3) |
+    blob count (8) | record count (8) | blob area size (8) | record area size (8) |
+    blob offsets ((blob count + 1) * 8) | blob area |
+    record offsets ((record count + 1) * 8) | record area
+
+A record is a sequence of varint tokens, (length << 1) followed by length
+literal bytes, or (blob number << 1) | 1 for a blob reference. The offset
+tables make decoding of a single record random access, also on a memory
+mapped archive file.
+"""
+import os
+import mmap
+import struct
+from hashlib import blake2b as _hashlib_blake2b
+
+_MAGIC = b"CZAR"
+_VERSION = 1
+_HEADER = struct.Struct(">4sB3xQQQQ")
+_OFFSET = struct.Struct(">Q")
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _decode_varint(buffer, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def level_signature_layout(hashlen, height):
+    """Layout function for layerzero LevelKey signatures
+
+    Interns the level salt, the merkle header nodes and the level pubkey, keeps the
+    index and the one-time signature literal.
+
+    Parameters
+    ----------
+    hashlen : int
+        Hash length of the level key
+    height : int
+        Merkle tree height of the level key
+
+    Returns
+    -------
+    callable
+        Function mapping a signature to a list of (internable, length) fields
+    """
+    header = [(False, 2)] + [(True, hashlen)] * (height + 2)
+    header_len = 2 + (height + 2) * hashlen
+
+    def layout(signature):
+        if len(signature) <= header_len:
+            return [(False, len(signature))]
+        return header + [(False, len(signature) - header_len)]
+    return layout
+
+
+class ArchiveWriter:
+    """Build a deduplicating signature archive"""
+    def __init__(self, layout, base=None):
+        """Constructor
+
+        Parameters
+        ----------
+        layout : callable
+            Function mapping a record to a list of (internable, length) fields
+            covering the whole record, for example level_signature_layout(...)
+        base : ArchiveReader or None
+            Existing archive to append to
+        """
+        if not callable(layout):
+            raise TypeError("layout must be callable")
+        self._layout = layout
+        self._blobs = []
+        self._blob_ids = {}
+        self._records = []
+        if base is not None:
+            for number in range(0, base.blob_count()):
+                self._intern(base.blob(number))
+            for number in range(0, len(base)):
+                self._records.append(base.raw_record(number))
+
+    def _intern(self, blob):
+        """Get the blob number for a field, adding it to the blob table if new"""
+        address = _hashlib_blake2b(blob, digest_size=16).digest()
+        number = self._blob_ids.get(address)
+        if number is None or self._blobs[number] != blob:
+            number = len(self._blobs)
+            self._blobs.append(blob)
+            self._blob_ids[address] = number
+        return number
+
+    def add(self, record):
+        """Add a record to the archive
+
+        Returns
+        -------
+        int
+            Record number for ArchiveReader lookups
+        """
+        record = bytes(record)
+        fields = self._layout(record)
+        if sum(length for _, length in fields) != len(record):
+            raise ValueError("layout does not cover the record")
+        tokens = []
+        literal = bytearray()
+        offset = 0
+        for internable, length in fields:
+            field = record[offset:offset + length]
+            offset += length
+            if internable:
+                if literal:
+                    tokens.append(_encode_varint(len(literal) << 1) + literal)
+                    literal = bytearray()
+                tokens.append(_encode_varint((self._intern(field) << 1) | 1))
+            else:
+                literal += field
+        if literal:
+            tokens.append(_encode_varint(len(literal) << 1) + literal)
+        self._records.append(b"".join(tokens))
+        return len(self._records) - 1
+
+    def to_bytes(self):
+        """Serialize the archive"""
+        parts = []
+        blob_area = 0
+        offsets = [_OFFSET.pack(0)]
+        for blob in self._blobs:
+            blob_area += len(blob)
+            offsets.append(_OFFSET.pack(blob_area))
+        record_area = 0
+        record_offsets = [_OFFSET.pack(0)]
+        for record in self._records:
+            record_area += len(record)
+            record_offsets.append(_OFFSET.pack(record_area))
+        parts.append(_HEADER.pack(_MAGIC,
+                                  _VERSION,
+                                  len(self._blobs),
+                                  len(self._records),
+                                  blob_area,
+                                  record_area))
+        parts += offsets
+        parts += self._blobs
+        parts += record_offsets
+        parts += self._records
+        return b"".join(parts)
+
+    def save(self, path):
+        """Write the archive to a file that can be memory mapped with ArchiveReader.open"""
+        tmppath = path + ".tmp"
+        with open(tmppath, "wb") as outfile:
+            outfile.write(self.to_bytes())
+        os.replace(tmppath, path)
+
+
+class ArchiveReader:
+    """Random access decoding of a deduplicating signature archive"""
+    def __init__(self, buffer, owner=None):
+        """Constructor
+
+        Parameters
+        ----------
+        buffer : bytes-like
+            The serialized archive
+        owner : object or None
+            Object backing the buffer (mmap) that is closed by close()
+        """
+        view = memoryview(buffer).cast("B")
+        if len(view) < _HEADER.size:
+            raise ValueError("buffer too small for a signature archive")
+        magic, version, blobs, records, blob_area, record_area = _HEADER.unpack_from(view)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("buffer does not hold a signature archive")
+        self._blob_offsets = _HEADER.size
+        self._blob_area = self._blob_offsets + (blobs + 1) * _OFFSET.size
+        self._record_offsets = self._blob_area + blob_area
+        self._record_area = self._record_offsets + (records + 1) * _OFFSET.size
+        if len(view) < self._record_area + record_area:
+            raise ValueError("signature archive is truncated")
+        self._blobs = blobs
+        self._records = records
+        self._view = view.toreadonly()
+        self._owner = owner
+        self._closed = False
+
+    @classmethod
+    def open(cls, path):
+        """Memory map an archive saved with ArchiveWriter.save"""
+        with open(path, "rb") as infile:
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, mapped)
+
+    def __len__(self):
+        return self._records
+
+    def blob_count(self):
+        """Number of distinct interned fields"""
+        return self._blobs
+
+    def _span(self, table, area, count, number):
+        if number < 0 or number >= count:
+            raise IndexError("archive index out of range")
+        start = _OFFSET.unpack_from(self._view, table + number * _OFFSET.size)[0]
+        end = _OFFSET.unpack_from(self._view, table + (number + 1) * _OFFSET.size)[0]
+        return area + start, area + end
+
+    def blob(self, number):
+        """Get an interned field"""
+        start, end = self._span(self._blob_offsets, self._blob_area, self._blobs, number)
+        return bytes(self._view[start:end])
+
+    def raw_record(self, number):
+        """Get the encoded token stream of a record"""
+        start, end = self._span(self._record_offsets, self._record_area, self._records, number)
+        return bytes(self._view[start:end])
+
+    def __getitem__(self, number):
+        """Decode a single record"""
+        start, end = self._span(self._record_offsets, self._record_area, self._records, number)
+        parts = []
+        offset = start
+        while offset < end:
+            token, offset = _decode_varint(self._view, offset)
+            if token & 1:
+                parts.append(self.blob(token >> 1))
+            else:
+                parts.append(bytes(self._view[offset:offset + (token >> 1)]))
+                offset += token >> 1
+        return b"".join(parts)
+
+    def close(self):
+        """Release the buffer and close the backing map"""
+        if not self._closed:
+            self._closed = True
+            self._view.release()
+            if self._owner is not None:
+                self._owner.close()
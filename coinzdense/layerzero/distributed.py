@@ -0,0 +1,223 @@
+"""Distributed level key generation using subtree work units
+
+A level key of height h has 2^h one-time pubkeys as merkle tree leaves. The tree
+is split into aligned subtrees of 2^unit_height leaves. Every subtree is a work
+unit: the worker calculates the one-time pubkeys of its leaf range and the root
+of the subtree. The coordinator checks every returned subtree root against the
+root of the returned leaves, recomputes a random sample of at least one leaf
+per work unit, and assembles the leaves into the LevelKey.
+
+Work units carry the seed key, so workers must be as trusted as the coordinator.
+
+Wire format (all integers big-endian)::
+
+    request:  magic "CZWU" | version (1) | hashlen (1) | otsbits (1) | height (1) |
+              wen3index (8) | first leaf (4) | leaf count (4) | seedkey (32)
+
+The high bit of the otsbits byte is set for level keys in the wots OTS mode.
+    response: magic "CZWR" | version (1) | status (1) | reserved (2) |
+              first leaf (4) | leaf count (4) | subtree root | leaves
+
+A status other than zero is followed by a utf8 error message instead of the
+root and leaves. serve_worker answers length-prefixed (4 byte) requests on a
+pair of binary streams, for example stdin and stdout of a remote process.
+"""
+import sys
+import struct
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from libnacl import crypto_kdf_derive_from_key as _nacl2_key_derive
+from libnacl import crypto_kdf_KEYBYTES as _nacl2_kdf_KEYBYTES
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from .onetime import OneTimeSigningKey, OTS_DUAL, OTS_WINTERNITZ
+from .level import LevelKey, _entropy_per_signature
+
+_REQUEST = struct.Struct(">4sBBBBQII")
+_RESPONSE = struct.Struct(">4sBB2xII")
+_REQUEST_MAGIC = b"CZWU"
+_RESPONSE_MAGIC = b"CZWR"
+_VERSION = 1
+_LENGTH = struct.Struct(">I")
+_WOTS_FLAG = 0x80
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+def encode_request(seedkey, wen3index, hashlen, otsbits, height, first, count, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """Encode a work unit for leaves first .. first + count - 1 of a level key"""
+    if len(seedkey) != _nacl2_kdf_KEYBYTES:
+        raise ValueError("seedkey has wrong size for a key")
+    if count < 1 or count & (count - 1) or first % count:
+        raise ValueError("work unit must be an aligned power of two leaf range")
+    if first + count > 1 << height:
+        raise ValueError("work unit beyond the last leaf")
+    if otsmode == OTS_WINTERNITZ:
+        otsbits |= _WOTS_FLAG
+    return _REQUEST.pack(_REQUEST_MAGIC, _VERSION, hashlen, otsbits, height,
+                         wen3index, first, count) + seedkey
+
+def _decode_response(response, hashlen):
+    """Parse a response into first leaf, subtree root and list of leaves"""
+    magic, version, status, first, count = _RESPONSE.unpack_from(response)
+    if magic != _RESPONSE_MAGIC or version != _VERSION:
+        raise ValueError("Not a work unit response")
+    body = response[_RESPONSE.size:]
+    if status != STATUS_OK:
+        raise RuntimeError("Worker failed: " + body.decode("utf8", errors="replace"))
+    if len(body) != (count + 1) * hashlen:
+        raise ValueError("Work unit response has the wrong size")
+    leaves = [body[hashlen * (i + 1):hashlen * (i + 2)] for i in range(0, count)]
+    return first, body[:hashlen], leaves
+
+def _node_hash(left, right, hashlen, salt):
+    return _nacl1_hash_function(left + right,
+                                digest_size=hashlen,
+                                key=salt,
+                                encoder=_Nacl1RawEncoder)
+
+def _subtree_levels(leaves, hashlen, salt):
+    """All node levels of a subtree, leaves first and the root level last"""
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        below = levels[-1]
+        levels.append([_node_hash(below[i], below[i + 1], hashlen, salt)
+                       for i in range(0, len(below), 2)])
+    return levels
+
+def _sample_leaves(first, count, samples):
+    """samples distinct random leaves of the work unit starting at leaf first"""
+    leaves = list(range(first, first + count))
+    return [leaves.pop(secrets.randbelow(len(leaves))) for _ in range(0, samples)]
+
+def _leaf_pubkey(seedkey, wen3index, hashlen, otsbits, levelsalt, leaf, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """One-time pubkey of a leaf, derived exactly as LevelKey does"""
+    startno = wen3index + 2 + leaf * _entropy_per_signature(hashlen, otsbits, otsmode)
+    return OneTimeSigningKey(hashlen, otsbits, levelsalt, seedkey, startno, otsmode=otsmode).get_pubkey()
+
+def process_work_unit(request):
+    """Worker side: calculate the leaves and subtree root for an encoded work unit
+
+    Returns
+    -------
+    bytes
+        The encoded response, an error response if the request is invalid
+    """
+    first = count = 0
+    try:
+        if len(request) != _REQUEST.size + _nacl2_kdf_KEYBYTES:
+            raise ValueError("Work unit request has the wrong size")
+        magic, version, hashlen, otsbits, height, wen3index, first, count = _REQUEST.unpack_from(request)
+        if magic != _REQUEST_MAGIC or version != _VERSION:
+            raise ValueError("Not a work unit request")
+        otsmode = OTS_WINTERNITZ if otsbits & _WOTS_FLAG else OTS_DUAL
+        otsbits &= ~_WOTS_FLAG
+        if count < 1 or count & (count - 1) or first % count or first + count > 1 << height:
+            raise ValueError("Invalid leaf range")
+        seedkey = bytes(request[_REQUEST.size:])
+        levelsalt = _nacl2_key_derive(hashlen, wen3index, "levelslt", seedkey)
+        leaves = [_leaf_pubkey(seedkey, wen3index, hashlen, otsbits, levelsalt, leaf, otsmode)
+                  for leaf in range(first, first + count)]
+        root = _subtree_levels(leaves, hashlen, levelsalt)[-1][0]
+        return _RESPONSE.pack(_RESPONSE_MAGIC, _VERSION, STATUS_OK, first, count) + root + b"".join(leaves)
+    except Exception as exc:  # pylint: disable=broad-except
+        return _RESPONSE.pack(_RESPONSE_MAGIC, _VERSION, STATUS_ERROR, first, count) + str(exc).encode("utf8")
+
+def serve_worker(instream, outstream):
+    """Answer length-prefixed work unit requests until the input stream ends"""
+    while True:
+        header = instream.read(_LENGTH.size)
+        if len(header) < _LENGTH.size:
+            return
+        request = instream.read(_LENGTH.unpack(header)[0])
+        response = process_work_unit(request)
+        outstream.write(_LENGTH.pack(len(response)) + response)
+        outstream.flush()
+
+
+class LocalProcessTransport:
+    """Stand-in for a remote transport, running work units on local worker processes"""
+    def __init__(self, max_workers=None):
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def submit(self, request):
+        """Send an encoded work unit
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future for the encoded response
+        """
+        return self._executor.submit(process_work_unit, request)
+
+    def close(self):
+        """Shut down the worker processes"""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def generate_level_key(seedkey, wen3index, hashlen, otsbits, height, transport, unit_height=None, samples=8,
+                       otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments, too-many-locals
+    """Generate a LevelKey by farming out subtree work units
+
+    Parameters
+    ----------
+    seedkey, wen3index, hashlen, otsbits, height, otsmode
+        As for LevelKey
+    transport : object
+        Anything with a submit(request) method returning a concurrent.futures.Future
+        for the response bytes, for example LocalProcessTransport
+    unit_height : int or None
+        Height of the subtrees per work unit, height - 4 (16 units) if None
+    samples : int
+        Number of randomly chosen leaves to recompute and check, spread over the
+        work units with at least one per unit
+
+    Returns
+    -------
+    LevelKey
+        The level key, with the pubkey available
+
+    Raises
+    ------
+    RuntimeError
+        Thrown if a worker failed or returned a subtree that does not verify
+    """
+    if unit_height is None:
+        unit_height = max(0, height - 4)
+    if unit_height < 0 or unit_height > height:
+        raise ValueError("unit_height must be in the 0..height range")
+    count = 1 << unit_height
+    futures = [transport.submit(encode_request(seedkey, wen3index, hashlen, otsbits, height, first, count, otsmode))
+               for first in range(0, 1 << height, count)]
+    levelsalt = _nacl2_key_derive(hashlen, wen3index, "levelslt", seedkey)
+    bigpubkey = [None] * (1 << height)
+    seen = set()
+    for future in futures:
+        first, root, leaves = _decode_response(future.result(), hashlen)
+        if len(leaves) != count or first % count or first in seen:
+            raise RuntimeError("Worker returned an unexpected leaf range")
+        seen.add(first)
+        # The reported subtree root must be the root of the reported leaves
+        if _subtree_levels(leaves, hashlen, levelsalt)[-1][0] != root:
+            raise RuntimeError("Work unit for leaves starting at " + str(first) + " failed verification")
+        bigpubkey[first:first + count] = leaves
+    units = len(futures)
+    per_unit = min(count, max(1, -(-samples // units)))
+    for first in range(0, 1 << height, count):
+        for leaf in _sample_leaves(first, count, per_unit):
+            if _leaf_pubkey(seedkey, wen3index, hashlen, otsbits, levelsalt, leaf, otsmode) != bigpubkey[leaf]:
+                raise RuntimeError("Work unit for leaves starting at " + str(first) + " failed verification")
+    return LevelKey(seedkey, wen3index, hashlen, otsbits, height, bigpubkey=bigpubkey, otsmode=otsmode)
+
+
+if __name__ == "__main__":
+    serve_worker(sys.stdin.buffer, sys.stdout.buffer)
@@ -1,4 +1,5 @@
 """Level-key signing keys and signature validation"""
+import os
 import asyncio
 from concurrent.futures import Executor
 from asyncio.events import AbstractEventLoop
@@ -6,50 +7,20 @@ from libnacl import crypto_kdf_derive_from_key as _nacl2_key_derive
 from libnacl import crypto_kdf_KEYBYTES as _nacl2_kdf_KEYBYTES
 from nacl.hash import blake2b as _nacl1_hash_function
 from nacl.encoding import RawEncoder as _Nacl1RawEncoder
-from .onetime import OneTimeSigningKey, OneTimeValidator
+from .onetime import OneTimeSigningKey, OneTimeValidator, _calculate_pubkeys
+from .onetime import OTS_DUAL, _check_otsmode, _ots_chains_per_signature
+from .sharedtree import MerkleTable
 
 def _ots_pairs_per_signature(hashlen, otsbits):
     """Calculate the number of one-time-signature private-key up-down duos needed to
     sign a single digest"""
     return ((hashlen*8-1) // otsbits)+1
 
-def _to_merkle_tree(pubkey_in, hashlen, salt):
-    """Convert a list of one-time pubkley into a merkletree lookup structure"""
-    mtree = {}
-    if len(pubkey_in) > 2:
-        mtree["0"] = _to_merkle_tree(pubkey_in[:len(pubkey_in)//2],
-                                     hashlen,
-                                     salt)
-        mtree["1"] = _to_merkle_tree(pubkey_in[len(pubkey_in)//2:],
-                                     hashlen,
-                                     salt)
-        mtree["node"] = _nacl1_hash_function(mtree["0"]["node"] + mtree["1"]["node"],
-                                             digest_size=hashlen,
-                                             key=salt,
-                                             encoder=_Nacl1RawEncoder)
-    else:
-        mtree["0"] = {"node": pubkey_in[0]}
-        mtree["1"] = {"node": pubkey_in[1]}
-        mtree["node"] = _nacl1_hash_function(pubkey_in[0] + pubkey_in[1],
-                                             digest_size=hashlen,
-                                             key=salt,
-                                             encoder=_Nacl1RawEncoder)
-    return mtree
-
-def _get_merkle_prefix(merkletree, height, index):
-    """Extract a index based merkletree signature prefix"""
-    fstring = "0" + str(height) + "b"
-    as_binlist = list(format(index, fstring))
-    header = []
-    while len(as_binlist) > 0:
-        subtree = merkletree
-        for idx in as_binlist[:-1]:
-            subtree = subtree[idx]
-        inverse = str(1 - int(as_binlist[-1]))
-        header.append(subtree[inverse]["node"])
-        as_binlist = as_binlist[:-1]
-    header.append(merkletree["node"])
-    return b"".join(header)
+def _entropy_per_signature(hashlen, otsbits, otsmode):
+    """Calculate the number of wen3 key indices a LevelKey reserves per one-time key"""
+    if otsmode == OTS_DUAL:
+        return _ots_pairs_per_signature(hashlen, otsbits) + 2
+    return _ots_chains_per_signature(hashlen, otsbits, otsmode) + 2
 
 # pylint: disable=too-many-arguments
 def _validate_merkle_root(merkleheaders, merkleroot, hashlen, height, index, salt, levelpubkey):
@@ -75,7 +46,7 @@ class LevelKey:
     """Single level signing key class, used to compose SigningKey"""
     # pylint: disable=too-many-arguments
     def __init__(self, seedkey, wen3index, hashlen, otsbits, height,
-                 bigpubkey=None, loop=None):
+                 bigpubkey=None, loop=None, merkle_table=None, otsmode=OTS_DUAL):
         # pylint: disable=too-many-branches, too-many-statements
         if not isinstance(seedkey, bytes):
             raise TypeError("seedkey must be an bytes")
@@ -91,13 +62,16 @@ class LevelKey:
             raise TypeError("bigpubkey must be a list if not None")
         if loop is not None and not isinstance(loop, AbstractEventLoop):
             raise TypeError("loop must be an AbstractEventLoop")
+        if merkle_table is not None and not isinstance(merkle_table, MerkleTable):
+            raise TypeError("merkle_table must be a MerkleTable if not None")
+        _check_otsmode(otsmode)
         if len(seedkey) != _nacl2_kdf_KEYBYTES:
             raise ValueError("seedkey has wrong size for a key")
         if wen3index < 0:
             raise ValueError("wen3index must be non-negative")
         if wen3index.bit_length() > 64:
             raise ValueError("wen3index too big to fit in 64 bit unsigned")
-        if (wen3index + (_ots_pairs_per_signature(hashlen, otsbits) + 2) *
+        if (wen3index + _entropy_per_signature(hashlen, otsbits, otsmode) *
                 (1 << height)).bit_length() > 64:
             raise ValueError("startno would overflow beyond 64 bit unsigned")
         if (hashlen < 16 or hashlen > 64):
@@ -111,10 +85,15 @@ class LevelKey:
                 raise ValueError("bigpubkey has wrong number of entries")
             if not all(isinstance(x, bytes) and len(x) == hashlen for x in bigpubkey):
                 raise ValueError("bigpubkey must be an array of hashlen long bytes strings")
+        if merkle_table is not None:
+            if merkle_table.hashlen != hashlen or merkle_table.height != height:
+                raise ValueError("merkle_table doesn't match hashlen and height")
+            bigpubkey = merkle_table.leaves()
         self._hashlen = hashlen
+        self._otsbits = otsbits
+        self._otsmode = otsmode
         self._height = height
-        if loop is None:
-            loop = asyncio.get_event_loop()
+        # The loop argument is no longer used, keys don't capture an event loop.
         self._levelsalt = _nacl2_key_derive(hashlen,
                                             wen3index,
                                             "levelslt",
@@ -122,16 +101,15 @@ class LevelKey:
         self._keys = []
         self._nonces = []
         self.pubkey = None
-        self._merkletree = None
+        self._merkletable = None
         otscount = 1 << self._height
-        entropy_per_signature = _ots_pairs_per_signature(hashlen,
-                                                         otsbits) + 2
+        entropy_per_signature = _entropy_per_signature(hashlen, otsbits, otsmode)
         next_index = wen3index + 1
         for _ in range(0, otscount):
             nonce = _nacl2_key_derive(hashlen, next_index, "levelslt", seedkey)
             self._nonces.append(nonce)
             next_index += entropy_per_signature
-        if self.pubkey is None:
+        if bigpubkey is None:
             next_index = wen3index + 1
             for _ in range(0, otscount):
                 self._keys.append(OneTimeSigningKey(hashlen,
@@ -140,7 +118,7 @@ class LevelKey:
                                                     seedkey,
                                                     next_index + 1,
                                                     None,
-                                                    loop))
+                                                    otsmode=otsmode))
                 next_index += entropy_per_signature
         else:
             next_index = wen3index + 1
@@ -151,10 +129,12 @@ class LevelKey:
                                                     seedkey,
                                                     next_index + 1,
                                                     bigpubkey[indx],
-                                                    loop))
+                                                    otsmode=otsmode))
                 next_index += entropy_per_signature
-            self._merkletree = _to_merkle_tree(bigpubkey, self._hashlen, self._levelsalt)
-            self.pubkey = self._merkletree["node"]
+            if merkle_table is None:
+                merkle_table = MerkleTable.build(bigpubkey, self._hashlen, self._levelsalt)
+            self._merkletable = merkle_table
+            self.pubkey = self._merkletable.root()
 
     def get_pubkey(self):
         """Get the pubkey for this level synchonicaly, no async calculation may be pending"""
@@ -162,10 +142,15 @@ class LevelKey:
             bigpubkey = []
             for otskey in self._keys:
                 bigpubkey.append(otskey.get_pubkey())
-            self._merkletree = _to_merkle_tree(bigpubkey, self._hashlen, self._levelsalt)
-            self.pubkey = self._merkletree["node"]
+            self._merkletable = MerkleTable.build(bigpubkey, self._hashlen, self._levelsalt)
+            self.pubkey = self._merkletable.root()
         return self.pubkey
 
+    def get_merkle_table(self):
+        """Get the flat merkle table, for publishing to shared memory or a state file.
+        Only available once the pubkey is."""
+        return self._merkletable
+
     def announce(self, executor):
         """Schedule background calculation of the pubkey"""
         if not isinstance(executor, Executor):
@@ -177,21 +162,95 @@ class LevelKey:
     async def require(self):
         """If needed, wait for background calculation to complete"""
         if self.pubkey is None:
-            bigpubkey = []
-            for otskey in self._keys:
-                await otskey.require()
-                bigpubkey.append(otskey.get_pubkey())
-            self._merkletree = _to_merkle_tree(bigpubkey, self._hashlen, self._levelsalt)
-            self.pubkey = self._merkletree["node"]
+            await asyncio.gather(*[otskey.require() for otskey in self._keys])
+            self.get_pubkey()
 
     async def available(self):
         """Check if the pubkey is already available"""
         if self.pubkey is None:
             for otskey in self._keys:
-                if not otskey.available():
+                if not await otskey.available():
                     return False
         return True
 
+    async def build(self, executor, batch_size=64, timeout=None, max_pending=None):
+        """Calculate the pubkey on an executor without stalling the event loop
+
+        The one-time pubkeys are calculated in batches of batch_size keys per executor
+        call, with at most max_pending batches submitted at any time. Batches still
+        queued are cancelled if building times out or the build task is cancelled.
+
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor
+            Thread or process pool for the OTS chain hashing
+        batch_size : int
+            Number of one-time pubkeys calculated per executor call
+        timeout : float or None
+            Maximum number of seconds to wait for the pubkey, no limit if None
+        max_pending : int or None
+            Maximum number of submitted batches, twice the CPU count if None
+
+        Returns
+        -------
+        bytes
+            The level key pubkey
+
+        Raises
+        ------
+        asyncio.TimeoutError
+            Thrown if the pubkey was not available within timeout seconds
+        """
+        if not isinstance(executor, Executor):
+            raise TypeError("Invalid executor type")
+        if not isinstance(batch_size, int):
+            raise TypeError("batch_size must be an integer")
+        if max_pending is None:
+            max_pending = 2 * (os.cpu_count() or 1)
+        if not isinstance(max_pending, int):
+            raise TypeError("max_pending must be an integer or None")
+        if batch_size < 1 or max_pending < 1:
+            raise ValueError("batch_size and max_pending must be positive")
+        if self.pubkey is None:
+            await asyncio.wait_for(self._build(executor, batch_size, max_pending), timeout)
+        return self.pubkey
+
+    async def _build(self, executor, batch_size, max_pending):
+        """Submit batches with backpressure and collect their one-time pubkeys"""
+        todo = []
+        announced = []
+        for index, otskey in enumerate(self._keys):
+            if await otskey.available():
+                continue
+            # Keys announced earlier whose calculation already started are awaited as is
+            if otskey.cancel():
+                todo.append(index)
+            else:
+                announced.append(otskey)
+        batches = [todo[start:start + batch_size] for start in range(0, len(todo), batch_size)]
+        pending = {}
+        try:
+            while batches or pending:
+                while batches and len(pending) < max_pending:
+                    batch = batches.pop(0)
+                    # pylint: disable=protected-access
+                    future = asyncio.wrap_future(executor.submit(_calculate_pubkeys,
+                                                                 [self._keys[index]._privkey for index in batch],
+                                                                 self._otsbits,
+                                                                 self._hashlen,
+                                                                 self._levelsalt))
+                    pending[future] = batch
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    for index, pubkey in zip(batch, future.result()):
+                        self._keys[index].set_pubkey(pubkey)
+            await asyncio.gather(*[otskey.require() for otskey in announced])
+        finally:
+            for future in pending:
+                future.cancel()
+        self.get_pubkey()
+
     def sign_hash(self, digest, index):
         """Sign a hash"""
         if not isinstance(digest, bytes):
@@ -205,7 +264,7 @@ class LevelKey:
         if index >= (1 << self._height):
             raise IndexError("index out of range for levelkey with this height")
         bin_index = index.to_bytes(2,'big')
-        merkle_prefix = _get_merkle_prefix(self._merkletree, self._height, index)
+        merkle_prefix = self._merkletable.auth_path(index) + self.pubkey
         return bin_index + self._levelsalt + merkle_prefix + self._keys[index].sign_hash(digest)
 
     def get_nonce(self, index):
@@ -229,13 +288,40 @@ class LevelKey:
         if index >= (1 << self._height):
             raise IndexError("index out of range for levelkey with this height")
         bin_index = index.to_bytes(2,'big')
-        merkle_prefix = _get_merkle_prefix(self._merkletree, self._height, index)
+        merkle_prefix = self._merkletable.auth_path(index) + self.pubkey
         return bin_index + self._levelsalt + merkle_prefix + self._keys[index].sign_data(data)
 
+    async def sign_data_async(self, data, index, executor=None):
+        """Sign a message, with the OTS chain hashing offloaded to an executor"""
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+        if not isinstance(index, int):
+            raise TypeError("index must be int")
+        if index < 0:
+            raise IndexError("Negative indices are invalid")
+        if index >= (1 << self._height):
+            raise IndexError("index out of range for levelkey with this height")
+        bin_index = index.to_bytes(2,'big')
+        merkle_prefix = self._merkletable.auth_path(index) + self.pubkey
+        return bin_index + self._levelsalt + merkle_prefix + await self._keys[index].sign_data_async(data, executor)
+
+    def sign_stream(self, source, index):
+        """Sign a streamed message (path, file object or iterable of chunks)"""
+        if not isinstance(index, int):
+            raise TypeError("index must be int")
+        if index < 0:
+            raise IndexError("Negative indices are invalid")
+        if index >= (1 << self._height):
+            raise IndexError("index out of range for levelkey with this height")
+        bin_index = index.to_bytes(2,'big')
+        merkle_prefix = self._merkletable.auth_path(index) + self.pubkey
+        return bin_index + self._levelsalt + merkle_prefix + self._keys[index].sign_stream(source)
+
 
 class _LevelSignature:
     """Single level signature validation"""
-    def __init__(self, hashlen, otsbits, height, signature):
+    def __init__(self, hashlen, otsbits, height, signature, otsmode=OTS_DUAL):
+        # pylint: disable=too-many-arguments
         self._height = height
         self._hashlen = hashlen
         bindex = signature[:2]
@@ -251,7 +337,8 @@ class _LevelSignature:
         self._validator = OneTimeValidator(hashlen,
                                            otsbits,
                                            self._level_salt,
-                                           self._merkle_nodes[-1])
+                                           self._merkle_nodes[-1],
+                                           otsmode)
 
     def validate_data(self, data):
         """Validate a signature matches the data"""
@@ -268,6 +355,19 @@ class _LevelSignature:
                                      self._level_salt,
                                      reconstructed_pubkey)
 
+    def validate_stream(self, source):
+        """Validate a signature matches a streamed message (path, file object or iterable of chunks)"""
+        reconstructed_pubkey = self._validator.validate_stream(source,
+                                                               self._ots_signature,
+                                                               merkle_mode=True)
+        return _validate_merkle_root(self._merkle_nodes[:-1],
+                                     self._merkle_nodes[-1],
+                                     self._hashlen,
+                                     self._height,
+                                     self._index,
+                                     self._level_salt,
+                                     reconstructed_pubkey)
+
     def validate_hash(self, digest):
         """Validate that a signature matches a digest"""
         if not isinstance(digest, bytes):
@@ -292,13 +392,14 @@ class _LevelSignature:
 class LevelValidation:
     # pylint: disable=too-few-public-methods
     """Convenience class for constructing _LevelSignature objects"""
-    def __init__(self, hashlen, otsbits, height):
+    def __init__(self, hashlen, otsbits, height, otsmode=OTS_DUAL):
         if not isinstance(hashlen, int):
             raise TypeError("hashlen must be an integer")
         if not isinstance(otsbits, int):
             raise TypeError("otsbits must be an integer")
         if not isinstance(height, int):
             raise TypeError("height must be an integer")
+        _check_otsmode(otsmode)
         if (hashlen < 16 or hashlen > 64):
             raise ValueError("hashlen should have a value in the 16..64 range")
         if otsbits < 4 or otsbits > 16:
@@ -307,13 +408,14 @@ class LevelValidation:
             raise ValueError("height should have a value in the 3..16 range")
         self._hashlen = hashlen
         self._otsbits = otsbits
+        self._otsmode = otsmode
         self._height = height
-        self._chopcount = _ots_pairs_per_signature(hashlen, otsbits)
+        self._chaincount = _ots_chains_per_signature(hashlen, otsbits, otsmode)
 
     def signature(self, level_signature):
         """Construct a signature object for a level signature"""
         if not isinstance(level_signature, bytes):
             raise TypeError("level_signature should be bytes")
-        if len(level_signature) != (3 +  2 * self._chopcount + self._height) * self._hashlen + 2:
+        if len(level_signature) != (3 + self._chaincount + self._height) * self._hashlen + 2:
             raise ValueError("Wrong size for level_signature")
-        return _LevelSignature(self._hashlen, self._otsbits, self._height, level_signature)
+        return _LevelSignature(self._hashlen, self._otsbits, self._height, level_signature, self._otsmode)
@@ -1,4 +1,11 @@
-"""One-time signing (OTS) keys and signature validation"""
+"""One-time signing (OTS) keys and signature validation
+
+Two OTS modes are supported. In the default "dual" mode every otsbits chunk of
+the digest is signed with an up-chain and a down-chain. In the "wots" mode every
+chunk uses a single chain, and a Winternitz checksum over the chunks, signed
+with a few extra chains, keeps anyone from advancing a chain to forge a
+signature. That roughly halves keygen work, signing work and signature size.
+"""
 import asyncio
 from concurrent.futures import Executor
 from asyncio.events import AbstractEventLoop
@@ -6,12 +13,61 @@ from libnacl import crypto_kdf_derive_from_key as _nacl2_key_derive
 from libnacl import crypto_kdf_KEYBYTES as _nacl2_kdf_KEYBYTES
 from nacl.hash import blake2b as _nacl1_hash_function
 from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from .stream import stream_digest
+
+OTS_DUAL = "dual"
+OTS_WINTERNITZ = "wots"
+OTS_MODES = (OTS_DUAL, OTS_WINTERNITZ)
 
 def _ots_pairs_per_signature(hashlen, otsbits):
     """Calculate the number of one-time-signature private-key up-down duos needed to
     sign a single digest"""
     return ((hashlen*8-1) // otsbits)+1
 
+def _checksum_chunks(hashlen, otsbits):
+    """Calculate the number of otsbits long checksum chunks a single-chain (wots)
+    signature adds to the digest chunks"""
+    max_checksum = _ots_pairs_per_signature(hashlen, otsbits) * ((1 << otsbits) - 1)
+    return ((max_checksum.bit_length() - 1) // otsbits) + 1
+
+def _ots_chains_per_signature(hashlen, otsbits, otsmode=OTS_DUAL):
+    """Calculate the number of hash chains, and private key chunks, needed to sign a
+    single digest in the given OTS mode"""
+    if otsmode == OTS_WINTERNITZ:
+        return _ots_pairs_per_signature(hashlen, otsbits) + _checksum_chunks(hashlen, otsbits)
+    return 2 * _ots_pairs_per_signature(hashlen, otsbits)
+
+def _check_otsmode(otsmode):
+    if not isinstance(otsmode, str):
+        raise TypeError("otsmode must be a string")
+    if otsmode not in OTS_MODES:
+        raise ValueError("otsmode should be one of " + ", ".join(OTS_MODES))
+
+def _digest_chunks(digest, hashlen, otsbits):
+    """Convert a digest into an array of otsbits long numbers, most significant first"""
+    as_bigno = int.from_bytes(digest,
+                              byteorder='big',
+                              signed=True)
+    as_int_list = []
+    for _ in range(0, _ots_pairs_per_signature(hashlen, otsbits)):
+        as_int_list.append(as_bigno % (1 << otsbits))
+        as_bigno = as_bigno >> otsbits
+    as_int_list.reverse()
+    return as_int_list
+
+def _checksum_values(values, hashlen, otsbits):
+    """Calculate the Winternitz checksum chunks for the digest chunks, most significant first
+
+    Making any digest chunk bigger, the only thing a signature allows without
+    the private key, makes the checksum smaller."""
+    checksum = sum((1 << otsbits) - 1 - value for value in values)
+    as_int_list = []
+    for _ in range(0, _checksum_chunks(hashlen, otsbits)):
+        as_int_list.append(checksum % (1 << otsbits))
+        checksum = checksum >> otsbits
+    as_int_list.reverse()
+    return as_int_list
+
 def _calculate_pubkey(privkey, otsbits, hashlen, salt):
     pubparts = []
     # Calculate the full-sized one-time-signing pubkey
@@ -32,10 +88,65 @@ def _calculate_pubkey(privkey, otsbits, hashlen, salt):
             key=salt,
             encoder=_Nacl1RawEncoder)
 
+def _calculate_pubkeys(privkeys, otsbits, hashlen, salt):
+    """Calculate the pubkeys for a batch of one-time signing keys in a single executor call"""
+    return [_calculate_pubkey(privkey, otsbits, hashlen, salt) for privkey in privkeys]
+
+def _sign_hash(privkey, otsbits, hashlen, salt, digest, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """Calculate the up and down chain values signing a digest, without nonce"""
+    as_int_list = _digest_chunks(digest, hashlen, otsbits)
+    if otsmode == OTS_WINTERNITZ:
+        # A single chain per chunk, the checksum chunks are signed the same way
+        signature = b""
+        for value, privpart in zip(as_int_list + _checksum_values(as_int_list, hashlen, otsbits), privkey):
+            sig = privpart
+            for _ in range(0, value + 1):
+                sig = _nacl1_hash_function(
+                          sig,
+                          digest_size=hashlen,
+                          key=salt,
+                          encoder=_Nacl1RawEncoder)
+            signature += sig
+        return signature
+    # Make a convenience array, grouping the digest based numbers with the private key chunks
+    my_sigparts = [
+        [
+            as_int_list[i//2],
+            privkey[i],
+            privkey[i+1]
+        ] for i in range(0, len(privkey), 2)
+    ]
+    signature = b""
+    for sigpart in my_sigparts:
+        # Figure out the number of times the up and the down chain will need to repeat hashing
+        # in order to create signature chunks.
+        count1 = sigpart[0] + 1
+        count2 = (1 << otsbits) - sigpart[0]
+        # Hash the up-chain
+        sig1 = sigpart[1]
+        for _ in range(0, count1):
+            sig1 = _nacl1_hash_function(
+                       sig1,
+                       digest_size=hashlen,
+                       key=salt,
+                       encoder=_Nacl1RawEncoder)
+        signature += sig1
+        # Hash the down chain
+        sig2 = sigpart[2]
+        for _ in range(0, count2):
+            sig2 = _nacl1_hash_function(
+                    sig2,
+                    digest_size=hashlen,
+                    key=salt,
+                    encoder=_Nacl1RawEncoder)
+        signature += sig2
+    return signature
+
 class OneTimeSigningKey:
     """Signing key for making a single one-time signature with"""
     # pylint: disable=too-many-arguments, too-many-instance-attributes
-    def __init__(self, hashlen, otsbits, levelsalt, key, startno, pubkey=None, loop=None):
+    def __init__(self, hashlen, otsbits, levelsalt, key, startno, pubkey=None, loop=None, otsmode=OTS_DUAL):
         # pylint: disable=too-many-branches
         """Constructor"""
         if not isinstance(hashlen, int):
@@ -51,7 +162,8 @@ class OneTimeSigningKey:
         if pubkey is not None and not isinstance(pubkey, bytes):
             raise TypeError("pubkey must be an bytes or None")
         if loop is not None and not isinstance(loop, AbstractEventLoop):
-            raise TypeError("loop must be concurrent.futures.Executor or None")
+            raise TypeError("loop must be an AbstractEventLoop or None")
+        _check_otsmode(otsmode)
         if (hashlen < 16 or hashlen > 64):
             raise ValueError("hashlen should have a value in the 16..64 range")
         if otsbits < 4 or otsbits > 16:
@@ -64,19 +176,18 @@ class OneTimeSigningKey:
             raise ValueError("startno should be non-negative")
         if startno.bit_length() > 64:
             raise ValueError("startno too big to fit in 64 bit unsigned")
-        if (startno + 2 * _ots_pairs_per_signature(hashlen, otsbits)).bit_length() > 64:
+        if (startno + _ots_chains_per_signature(hashlen, otsbits, otsmode)).bit_length() > 64:
             raise ValueError("startno would overflow beyond 64 bit unsigned")
         if isinstance(pubkey, bytes) and len(pubkey) != hashlen:
             raise ValueError("pubkey (if non-Null) should be hashlen long")
         self._hashlen = hashlen
         self._otsbits = otsbits
+        self._otsmode = otsmode
         self._levelsalt = levelsalt
         self._pubkey = pubkey
-        self._loop = loop
-        if loop is None:
-            self._loop = asyncio.get_event_loop()
+        # The loop argument is no longer used, keys don't capture an event loop.
         self._privkey = []
-        self._chopcount = _ots_pairs_per_signature(hashlen, otsbits)
+        self._chaincount = _ots_chains_per_signature(hashlen, otsbits, otsmode)
         # We use up one chunk of entropy for a nonce. This nonce is basically the
         #  salt we use instead of the level salt when hashing the transaction, message
         #  or next-level level-key pubkey.
@@ -85,7 +196,7 @@ class OneTimeSigningKey:
                                         "SigNonce",
                                         key)
         # Derive the whole one-time-signing private key from the seeding key.
-        for keyspace_index in range(startno + 1, startno + 1 + 2 * self._chopcount):
+        for keyspace_index in range(startno + 1, startno + 1 + self._chaincount):
             self._privkey.append(
                     _nacl2_key_derive(hashlen,
                                       keyspace_index,
@@ -103,7 +214,9 @@ class OneTimeSigningKey:
             The public key.
         """
         if self._pending is not None and self._pubkey is None:
-            raise RuntimeError("Can't synchonously call get_pubkey on anounced and not required OTSK")
+            if not self._pending.done():
+                raise RuntimeError("Can't synchonously call get_pubkey on anounced and not required OTSK")
+            self._pubkey = self._pending.result()
         if self._pubkey is None:
             self._pubkey = _calculate_pubkey(self._privkey, self._otsbits, self._hashlen, self._levelsalt)
         return self._pubkey
@@ -119,17 +232,40 @@ class OneTimeSigningKey:
         if not isinstance(executor, Executor):
             raise TypeError("Invalid executor type")
         if self._pubkey is None and self._pending is None:
-            self._pending = self._loop.run_in_executor(executor,
-                                                       _calculate_pubkey,
-                                                       self._privkey,
-                                                       self._otsbits,
-                                                       self._hashlen,
-                                                       self._levelsalt)
+            self._pending = executor.submit(_calculate_pubkey,
+                                            self._privkey,
+                                            self._otsbits,
+                                            self._hashlen,
+                                            self._levelsalt)
+
+    def set_pubkey(self, pubkey):
+        """Set a pubkey calculated elsewhere, for example in a batched executor call"""
+        if not isinstance(pubkey, bytes):
+            raise TypeError("pubkey must be bytes")
+        if len(pubkey) != self._hashlen:
+            raise ValueError("pubkey should be hashlen long")
+        self._pubkey = pubkey
+        self._pending = None
+
+    def cancel(self):
+        """Cancel a pending pubkey calculation that has not started yet
+
+        Returns
+        -------
+        bool
+            True if no calculation is pending anymore
+        """
+        if self._pending is None or self._pubkey is not None:
+            return True
+        if self._pending.cancel():
+            self._pending = None
+            return True
+        return False
 
     async def require(self):
         """Await any pending executor code for calculating the pubkey"""
         if self._pubkey is None and self._pending is not None:
-            self._pubkey = await self._pending
+            self._pubkey = await asyncio.wrap_future(self._pending)
 
     async def available(self):
         """Check if pubkey is available
@@ -144,7 +280,7 @@ class OneTimeSigningKey:
         if self._pending is None:
             return False
         if self._pending.done():
-            self._pubkey = await self._pending
+            self._pubkey = self._pending.result()
             return True
         return False
 
@@ -172,48 +308,7 @@ class OneTimeSigningKey:
             raise TypeError("digest should be bytes")
         if len(digest) != self._hashlen:
             raise ValueError("sign_hash called with hash of inapropriate size")
-        # Convert the input digest into an array of otsbits long numbers
-        as_bigno = int.from_bytes(digest,
-                                  byteorder='big',
-                                  signed=True)
-        as_int_list = []
-        for _ in range(0, self._chopcount):
-            as_int_list.append(as_bigno % (1 << self._otsbits))
-            as_bigno = as_bigno >> self._otsbits
-        as_int_list.reverse()
-        # Make a convenience array, grouping the digest based numbers with the private key chunks
-        my_sigparts = [
-            [
-                as_int_list[i//2],
-                self._privkey[i],
-                self._privkey[i+1]
-            ] for i in range(0, len(self._privkey), 2)
-        ]
-        signature = b""
-        for sigpart in my_sigparts:
-            # Figure out the number of times the up and the down chain will need to repeat hashing
-            # in order to create signature chunks.
-            count1 = sigpart[0] + 1
-            count2 = (1 << self._otsbits) - sigpart[0]
-            # Hash the up-chain
-            sig1 = sigpart[1]
-            for _ in range(0, count1):
-                sig1 = _nacl1_hash_function(
-                           sig1,
-                           digest_size=self._hashlen,
-                           key=self._levelsalt,
-                           encoder=_Nacl1RawEncoder)
-            signature += sig1
-            # Hash the down chain
-            sig2 = sigpart[2]
-            for _ in range(0, count2):
-                sig2 = _nacl1_hash_function(
-                        sig2,
-                        digest_size=self._hashlen,
-                        key=self._levelsalt,
-                        encoder=_Nacl1RawEncoder)
-            signature += sig2
-        return signature
+        return _sign_hash(self._privkey, self._otsbits, self._hashlen, self._levelsalt, digest, self._otsmode)
 
     def sign_data(self, data):
         """Signature from data
@@ -239,16 +334,67 @@ class OneTimeSigningKey:
         # Prefix the signature with the nonce
         return self._nonce + self.sign_hash(digest)
 
+    async def sign_data_async(self, data, executor=None):
+        """Signature from data, with the chain hashing offloaded to an executor
+
+        Parameters
+        ----------
+        data : bytes
+            Data that needs signing
+        executor : concurrent.futures.Executor or None
+            Executor for the chain hashing, the loop's default executor if None
+
+        Returns
+        -------
+        bytes
+            The signature including nonce, identical to sign_data.
+        """
+        if not isinstance(data, bytes):
+            raise TypeError("data should be bytes")
+        digest = _nacl1_hash_function(
+                        data,
+                        digest_size=self._hashlen,
+                        key=self._nonce,
+                        encoder=_Nacl1RawEncoder)
+        signature = await asyncio.get_running_loop().run_in_executor(executor,
+                                                                     _sign_hash,
+                                                                     self._privkey,
+                                                                     self._otsbits,
+                                                                     self._hashlen,
+                                                                     self._levelsalt,
+                                                                     digest,
+                                                                     self._otsmode)
+        return self._nonce + signature
+
+    def sign_stream(self, source):
+        """Signature from a streamed payload
+
+        Parameters
+        ----------
+        source : str, os.PathLike, file object, bytes-like or iterable of bytes-like
+            Path (memory mapped), file object or iterable of chunks of the data that needs signing
+
+        Returns
+        -------
+        bytes
+            The signature including nonce, identical to sign_data on the concatenated data.
+        """
+        # Hash the data incrementally, using the nonce salt as a key.
+        digest = stream_digest(source, self._hashlen, self._nonce)
+        # Prefix the signature with the nonce
+        return self._nonce + self.sign_hash(digest)
+
 
 class OneTimeValidator:
     """Validator for one-time signature"""
-    def __init__(self, hashlen, otsbits, levelsalt, otpubkey):
+    def __init__(self, hashlen, otsbits, levelsalt, otpubkey, otsmode=OTS_DUAL):
         """Constructor"""
         if (not isinstance(hashlen, int) or
                 not isinstance(otsbits, int) or
                 not isinstance(levelsalt, bytes) or
                 not isinstance(otpubkey, bytes)):
             raise TypeError("OneTimeValidator constructor argument type mismatch")
+        _check_otsmode(otsmode)
         if hashlen < 16 or hashlen > 64:
             raise ValueError("hashlen should have a value in the 16..64 range")
         if otsbits < 4 or otsbits > 16:
@@ -261,7 +407,8 @@ class OneTimeValidator:
         self._otsbits = otsbits
         self._levelsalt = levelsalt
         self._pubkey = otpubkey
-        self._chopcount = _ots_pairs_per_signature(hashlen, otsbits)
+        self._otsmode = otsmode
+        self._chaincount = _ots_chains_per_signature(hashlen, otsbits, otsmode)
 
     def validate_hash(self, digest, signature, merkle_mode=False):
         """Validate signature from signature
@@ -293,21 +440,14 @@ class OneTimeValidator:
             raise TypeError("merkle_mode should be a bool")
         if len(digest) != self._hashlen:
             raise ValueError("sign_hash called with hash of inapropriate size")
-        if len(signature) != self._hashlen * 2 * _ots_pairs_per_signature(
-                self._hashlen,
-                self._otsbits):
+        if len(signature) != self._hashlen * self._chaincount:
             raise ValueError("sign_hash called with signature of inapropriate size")
         # Chop up the signature into hashlen long chunks
         partials = [signature[i:i+self._hashlen] for i in range(0, len(signature), self._hashlen)]
         # Convert the input digest into an array of otsbits long numbers
-        as_bigno = int.from_bytes(digest,
-                                  byteorder='big',
-                                  signed=True)
-        as_int_list = []
-        for _ in range(0, self._chopcount):
-            as_int_list.append(as_bigno % (1 << self._otsbits))
-            as_bigno = as_bigno >> self._otsbits
-        as_int_list.reverse()
+        as_int_list = _digest_chunks(digest, self._hashlen, self._otsbits)
+        if self._otsmode == OTS_WINTERNITZ:
+            return self._validate_single_chains(as_int_list, partials, merkle_mode)
         # Make a convenience array, grouping the digest based numbers with the private key chunks
         my_sigparts = [
             [
@@ -351,6 +491,27 @@ class OneTimeValidator:
             return reconstructed_pubkey
         return self._pubkey == reconstructed_pubkey
 
+    def _validate_single_chains(self, as_int_list, partials, merkle_mode):
+        """Complete the single chains of a wots signature and check the resulting pubkey"""
+        bigpubkey = b""
+        for value, sig in zip(as_int_list + _checksum_values(as_int_list, self._hashlen, self._otsbits),
+                              partials):
+            for _ in range(0, (1 << self._otsbits) - value - 1):
+                sig = _nacl1_hash_function(
+                          sig,
+                          digest_size=self._hashlen,
+                          key=self._levelsalt,
+                          encoder=_Nacl1RawEncoder)
+            bigpubkey += sig
+        reconstructed_pubkey = _nacl1_hash_function(
+                                   bigpubkey,
+                                   digest_size=self._hashlen,
+                                   key=self._levelsalt,
+                                   encoder=_Nacl1RawEncoder)
+        if merkle_mode:
+            return reconstructed_pubkey
+        return self._pubkey == reconstructed_pubkey
+
     def validate_data(self, data, signature, merkle_mode=False):
         """Validate signature from data
 
@@ -372,7 +533,7 @@ class OneTimeValidator:
             raise TypeError("signature should be bytes")
         if not  isinstance(merkle_mode, bool):
             raise TypeError("merkle_mode should be a bool")
-        if len(signature) != (1 +  2 * self._chopcount) * self._hashlen:
+        if len(signature) != (1 + self._chaincount) * self._hashlen:
             raise ValueError("Signature has wrong length")
         # Extract the nonce from the signature
         nonce = signature[:self._hashlen]
@@ -384,3 +545,31 @@ class OneTimeValidator:
                         encoder=_Nacl1RawEncoder)
         # Validate the resulting digest is indeed signed with the known OTS key.
         return self.validate_hash(digest, signature[self._hashlen:], merkle_mode)
+
+    def validate_stream(self, source, signature, merkle_mode=False):
+        """Validate signature from a streamed payload
+
+        Parameters
+        ----------
+        source : str, os.PathLike, file object, bytes-like or iterable of bytes-like
+            Path (memory mapped), file object or iterable of chunks of the signed data
+        signature : bytes
+                      The signature including nonce, signing the data.
+
+        Returns
+        -------
+        bool
+            Boolean indicating if signature matches the pubkey/data combo
+        """
+        if not isinstance(signature, bytes):
+            raise TypeError("signature should be bytes")
+        if not  isinstance(merkle_mode, bool):
+            raise TypeError("merkle_mode should be a bool")
+        if len(signature) != (1 + self._chaincount) * self._hashlen:
+            raise ValueError("Signature has wrong length")
+        # Extract the nonce from the signature
+        nonce = signature[:self._hashlen]
+        # Hash the data incrementally using the nonce
+        digest = stream_digest(source, self._hashlen, nonce)
+        # Validate the resulting digest is indeed signed with the known OTS key.
+        return self.validate_hash(digest, signature[self._hashlen:], merkle_mode)
@@ -0,0 +1,203 @@
+"""Flat, read-only merkle tables that can live in shared memory or a memory mapped file
+
+A level key's merkle tree only depends on its public one-time pubkeys, so it is
+identical for every process that signs or verifies with it. Stored as one flat
+buffer it can be placed in a named shared-memory segment or a state file that
+many processes attach to without building their own copy.
+
+Layout of the buffer (all integers big-endian)::
+
+    magic "CZMT" (4) | version (1) | hashlen (1) | height (1) | reserved (1) |
+    extra length (4) | tree nodes | extra
+
+The tree nodes are stored in heap order, node 1 being the root and node i having
+children 2i and 2i+1, so leaf j is node 2^height + j.
+"""
+import os
+import mmap
+import struct
+from multiprocessing import shared_memory
+try:
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+
+_MAGIC = b"CZMT"
+_VERSION = 1
+_HEADER = struct.Struct(">4sBBBxI")
+
+def table_size(hashlen, height, extra_len=0):
+    """Size in bytes of a merkle table buffer"""
+    return _HEADER.size + ((2 << height) - 1) * hashlen + extra_len
+
+
+class MerkleTable:
+    """Read-only view on a flat merkle tree, optionally with an extra blob"""
+    def __init__(self, buffer, owner=None):
+        """Constructor
+
+        Parameters
+        ----------
+        buffer : bytes-like
+            Buffer holding a merkle table
+        owner : object or None
+            Object backing the buffer (SharedMemory, mmap) that must stay alive and
+            is closed by close()
+        """
+        view = memoryview(buffer).cast("B")
+        if len(view) < _HEADER.size:
+            raise ValueError("buffer too small for a merkle table")
+        magic, version, hashlen, height, extra_len = _HEADER.unpack_from(view)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("buffer does not hold a merkle table")
+        if len(view) < table_size(hashlen, height, extra_len):
+            raise ValueError("merkle table buffer is truncated")
+        self.hashlen = hashlen
+        self.height = height
+        self._extra_len = extra_len
+        self._view = view[:table_size(hashlen, height, extra_len)].toreadonly()
+        self._owner = owner
+        self._closed = False
+
+    @classmethod
+    def build(cls, leaves, hashlen, salt, extra=b""):
+        """Build a merkle table from a list of one-time pubkeys
+
+        Parameters
+        ----------
+        leaves : list of bytes
+            The 2^height hashlen long leaf pubkeys
+        hashlen : int
+            Hash length
+        salt : bytes
+            The level salt used as key for the node hashes
+        extra : bytes
+            Extra blob stored with the table, for example the parent level signature
+
+        Returns
+        -------
+        MerkleTable
+            A table backed by a private bytearray
+        """
+        height = len(leaves).bit_length() - 1
+        if len(leaves) != 1 << height or height < 1:
+            raise ValueError("number of leaves must be a power of two")
+        buffer = bytearray(table_size(hashlen, height, len(extra)))
+        _HEADER.pack_into(buffer, 0, _MAGIC, _VERSION, hashlen, height, len(extra))
+        base = _HEADER.size - hashlen
+        first_leaf = 1 << height
+        for index, leaf in enumerate(leaves):
+            start = base + (first_leaf + index) * hashlen
+            buffer[start:start + hashlen] = leaf
+        for node in range(first_leaf - 1, 0, -1):
+            start = base + 2 * node * hashlen
+            buffer[base + node * hashlen:base + (node + 1) * hashlen] = _nacl1_hash_function(
+                    bytes(buffer[start:start + 2 * hashlen]),
+                    digest_size=hashlen,
+                    key=salt,
+                    encoder=_Nacl1RawEncoder)
+        buffer[len(buffer) - len(extra):] = extra
+        return cls(buffer)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach read-only to a merkle table published in a named shared-memory segment"""
+        if _posixshmem is None:
+            segment = shared_memory.SharedMemory(name=name)
+            return cls(segment.buf, segment)
+        # Map the segment directly so attaching does not register it with the resource
+        # tracker, which would remove it when this process exits.
+        fdesc = _posixshmem.shm_open("/" + name, os.O_RDONLY, 0)
+        try:
+            mapped = mmap.mmap(fdesc, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fdesc)
+        return cls(mapped, mapped)
+
+    @classmethod
+    def open_file(cls, path):
+        """Memory map a merkle table saved with save()"""
+        with open(path, "rb") as infile:
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, mapped)
+
+    def publish(self, name):
+        """Copy the table into a new named shared-memory segment
+
+        Returns
+        -------
+        MerkleTable
+            Table backed by the segment; call unlink() on it once no new process
+            needs to attach anymore
+        """
+        segment = shared_memory.SharedMemory(name=name, create=True, size=len(self._view))
+        segment.buf[:len(self._view)] = self._view
+        return MerkleTable(segment.buf, segment)
+
+    def save(self, path):
+        """Write the table to a file that can be memory mapped with open_file()"""
+        tmppath = path + ".tmp"
+        with open(tmppath, "wb") as outfile:
+            outfile.write(self._view)
+        os.replace(tmppath, path)
+
+    def node(self, index):
+        """Get a tree node by heap index (1 is the root)"""
+        start = _HEADER.size + (index - 1) * self.hashlen
+        return bytes(self._view[start:start + self.hashlen])
+
+    def root(self):
+        """Get the merkle root, the level key pubkey"""
+        return self.node(1)
+
+    def leaf(self, index):
+        """Get a one-time pubkey"""
+        return self.node((1 << self.height) + index)
+
+    def leaves(self):
+        """Get all one-time pubkeys as a list"""
+        return [self.leaf(index) for index in range(0, 1 << self.height)]
+
+    def auth_path(self, index):
+        """Get the sibling nodes from the leaf for a signature index up to (not including) the root"""
+        node = (1 << self.height) + index
+        path = []
+        while node > 1:
+            path.append(self.node(node ^ 1))
+            node >>= 1
+        return b"".join(path)
+
+    def extra(self):
+        """Get the extra blob stored with the table"""
+        return bytes(self._view[len(self._view) - self._extra_len:])
+
+    def tobytes(self):
+        """Copy of the table buffer, for embedding in other containers"""
+        return bytes(self._view)
+
+    def is_shared(self):
+        """True if the table lives in a shared-memory segment or memory mapped file"""
+        return self._owner is not None
+
+    def nbytes(self):
+        """Size of the table buffer"""
+        return len(self._view)
+
+    def close(self):
+        """Release the buffer and close the backing segment or map"""
+        if not self._closed:
+            self._closed = True
+            self._view.release()
+            if self._owner is not None:
+                self._owner.close()
+
+    def __del__(self):
+        # Views on a segment must be released before the segment itself can be closed
+        self.close()
+
+    def unlink(self):
+        """Remove the backing shared-memory segment (publisher only)"""
+        if isinstance(self._owner, shared_memory.SharedMemory):
+            self._owner.unlink()
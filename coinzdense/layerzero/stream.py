@@ -0,0 +1,180 @@
+"""Incremental hashing of large payloads from files, paths and iterables of chunks"""
+import os
+import mmap
+from hashlib import blake2b as _hashlib_blake2b
+
+STREAM_CHUNK_SIZE = 1 << 20
+
+def _iter_path(path, chunk_size):
+    """Yield zero-copy memoryview chunks of a memory mapped file"""
+    with open(path, "rb") as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for start in range(0, len(view), chunk_size):
+                    with view[start:start + chunk_size] as chunk:
+                        yield chunk
+
+def _iter_file(fileobj, chunk_size):
+    """Yield chunks read from a binary file object, reusing a single buffer if possible"""
+    if hasattr(fileobj, "readinto"):
+        buffer = bytearray(chunk_size)
+        with memoryview(buffer) as view:
+            while True:
+                count = fileobj.readinto(buffer)
+                if not count:
+                    return
+                with view[:count] as chunk:
+                    yield chunk
+    else:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def iter_chunks(source, chunk_size=STREAM_CHUNK_SIZE):
+    """Iterate over a payload in chunks without copying it as a whole
+
+    Parameters
+    ----------
+    source : str, os.PathLike, file object, bytes-like or iterable of bytes-like
+        A path is memory mapped, a file object is read in chunk_size blocks,
+        a bytes-like object is used as is and any other iterable is taken to
+        yield bytes-like chunks.
+    chunk_size : int
+        Size of the chunks for paths and file objects
+
+    Yields
+    ------
+    bytes-like
+        Consecutive chunks of the payload. Chunks may be views into a reused
+        buffer and are only valid until the next chunk is requested.
+    """
+    if not isinstance(chunk_size, int):
+        raise TypeError("chunk_size must be an integer")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    if isinstance(source, (str, os.PathLike)):
+        return _iter_path(source, chunk_size)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return iter((source,))
+    if hasattr(source, "read"):
+        return _iter_file(source, chunk_size)
+    try:
+        return iter(source)
+    except TypeError as exc:
+        raise TypeError("source must be a path, file object or iterable of bytes-like chunks") from exc
+
+def stream_digest(source, digest_size, key=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Calculate the (keyed) BLAKE2b digest of a payload incrementally
+
+    The result is identical to hashing the whole payload in one go with
+    nacl.hash.blake2b using the same digest_size and key.
+
+    Parameters
+    ----------
+    source : str, os.PathLike, file object, bytes-like or iterable of bytes-like
+        The payload, see iter_chunks
+    digest_size : int
+        Size of the digest in bytes
+    key : bytes or None
+        Optional BLAKE2b key
+    chunk_size : int
+        Size of the chunks for paths and file objects
+
+    Returns
+    -------
+    bytes
+        The digest
+    """
+    if key is None:
+        key = b""
+    hasher = _hashlib_blake2b(digest_size=digest_size, key=key)
+    for chunk in iter_chunks(source, chunk_size):
+        hasher.update(chunk)
+    return hasher.digest()
+
+TREE_LEAF_SIZE = 1 << 23
+
+def _tree_params(digest_size, key, leaf_size):
+    """BLAKE2b tree hashing parameters shared by all nodes (unlimited fanout, depth two)"""
+    if key is None:
+        key = b""
+    return {"digest_size": digest_size,
+            "key": key,
+            "fanout": 0,
+            "depth": 2,
+            "leaf_size": leaf_size,
+            "inner_size": digest_size}
+
+def _tree_leaf_digest(path, digest_size, key, leaf_size, leaf_index, last_node):
+    # pylint: disable=too-many-arguments
+    """Hash a single leaf of a BLAKE2b tree hash, reading it from a memory mapped file"""
+    hasher = _hashlib_blake2b(node_offset=leaf_index,
+                              node_depth=0,
+                              last_node=last_node,
+                              **_tree_params(digest_size, key, leaf_size))
+    with open(path, "rb") as infile:
+        size = os.fstat(infile.fileno()).st_size
+        length = min(leaf_size, size - leaf_index * leaf_size)
+        if length > 0:
+            with mmap.mmap(infile.fileno(),
+                           length,
+                           access=mmap.ACCESS_READ,
+                           offset=leaf_index * leaf_size) as mapped:
+                with memoryview(mapped) as view:
+                    hasher.update(view)
+    return hasher.digest()
+
+def tree_digest(path, digest_size, key=None, executor=None, leaf_size=TREE_LEAF_SIZE):
+    # pylint: disable=too-many-arguments
+    """Calculate a BLAKE2b tree-hash digest of a file, hashing leaves in parallel
+
+    The file is cut into leaf_size leaves that are hashed as depth zero nodes
+    (node_offset set to the leaf number, last_node set on the final leaf). The
+    concatenated leaf digests are hashed into a single depth one root node.
+
+    Parameters
+    ----------
+    path : str or os.PathLike
+        File to hash, memory mapped per leaf
+    digest_size : int
+        Size of the leaf and root digests in bytes
+    key : bytes or None
+        Optional BLAKE2b key used for every node
+    executor : concurrent.futures.Executor or None
+        Thread or process pool used for hashing leaves, sequential if None
+    leaf_size : int
+        Leaf size in bytes, must be a multiple of mmap.ALLOCATIONGRANULARITY
+
+    Returns
+    -------
+    bytes
+        The root digest
+    """
+    if not isinstance(path, (str, os.PathLike)):
+        raise TypeError("path must be a str or os.PathLike")
+    if not isinstance(leaf_size, int):
+        raise TypeError("leaf_size must be an integer")
+    if leaf_size < 1 or leaf_size % mmap.ALLOCATIONGRANULARITY != 0 or leaf_size.bit_length() > 32:
+        raise ValueError("leaf_size must be a 32 bit multiple of mmap.ALLOCATIONGRANULARITY")
+    leaf_count = max(1, (os.stat(path).st_size + leaf_size - 1) // leaf_size)
+    args = [[path] * leaf_count,
+            [digest_size] * leaf_count,
+            [key] * leaf_count,
+            [leaf_size] * leaf_count,
+            range(0, leaf_count),
+            [index == leaf_count - 1 for index in range(0, leaf_count)]]
+    if executor is None:
+        leaves = map(_tree_leaf_digest, *args)
+    else:
+        leaves = executor.map(_tree_leaf_digest, *args)
+    root = _hashlib_blake2b(node_offset=0,
+                            node_depth=1,
+                            last_node=True,
+                            **_tree_params(digest_size, key, leaf_size))
+    for leaf in leaves:
+        root.update(leaf)
+    return root.digest()
@@ -0,0 +1,166 @@
+"""Executor kind, worker count and batch size autotuning for level key generation
+
+The fastest way to calculate one-time pubkeys depends on the hash backend, the
+hash length, the number of OTS bits and the host. calibrate() runs a short
+benchmark of LevelKey.build style batches on thread and process pools, and
+get_tuning() caches the outcome per host and parameter set in
+~/.coinzdense/tuning.json::
+
+    tuning = get_tuning(hashlen, otsbits)
+    with make_executor(tuning) as executor:
+        await levelkey.build(executor, batch_size=tuning["batch_size"])
+"""
+import os
+import sys
+import json
+import time
+import socket
+import platform
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from nacl.utils import random as _nacl1_random
+from .onetime import _calculate_pubkeys, _ots_chains_per_signature, OTS_DUAL
+
+TUNING_CACHE = os.path.join(os.path.expanduser("~"), ".coinzdense", "tuning.json")
+
+_EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+def host_id():
+    """Identify the host and interpreter a tuning result is valid for"""
+    return "/".join([socket.gethostname(),
+                     platform.machine(),
+                     str(os.cpu_count()),
+                     platform.python_implementation(),
+                     ".".join(str(part) for part in sys.version_info[:2])])
+
+def _calibration_keys(hashlen, otsbits, count, otsmode=OTS_DUAL):
+    """Random private keys and salt, calibration only needs the hashing work"""
+    parts = _ots_chains_per_signature(hashlen, otsbits, otsmode)
+    privkeys = [[_nacl1_random(hashlen) for _ in range(0, parts)] for _ in range(0, count)]
+    return privkeys, _nacl1_random(hashlen)
+
+def _keys_per_second(executor, privkeys, otsbits, hashlen, salt, batch_size):
+    # pylint: disable=too-many-arguments
+    batches = [privkeys[start:start + batch_size] for start in range(0, len(privkeys), batch_size)]
+    start = time.monotonic()
+    for _ in executor.map(_calculate_pubkeys,
+                          batches,
+                          [otsbits] * len(batches),
+                          [hashlen] * len(batches),
+                          [salt] * len(batches)):
+        pass
+    return len(privkeys) / max(time.monotonic() - start, 1e-9)
+
+def calibrate(hashlen, otsbits, budget=2.0, max_workers=None, otsmode=OTS_DUAL):
+    """Benchmark executor kinds, worker counts and batch sizes for one-time pubkey calculation
+
+    Parameters
+    ----------
+    hashlen : int
+        Hash length of the level keys
+    otsbits : int
+        Number of OTS bits of the level keys
+    budget : float
+        Approximate number of seconds of hashing work per measurement
+    max_workers : int or None
+        Largest worker count to try, the CPU count if None
+    otsmode : str
+        OTS mode of the level keys, "dual" or "wots"
+
+    Returns
+    -------
+    dict
+        kind ("thread" or "process"), workers, batch_size and keys_per_second
+    """
+    if not isinstance(hashlen, int) or not isinstance(otsbits, int):
+        raise TypeError("hashlen and otsbits must be integers")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    # Size the sample so a single worker needs about budget / 4 seconds
+    privkeys, salt = _calibration_keys(hashlen, otsbits, 4, otsmode)
+    start = time.monotonic()
+    _calculate_pubkeys(privkeys, otsbits, hashlen, salt)
+    per_key = max((time.monotonic() - start) / 4, 1e-6)
+    count = max(8, int(budget / 4 / per_key))
+    privkeys, salt = _calibration_keys(hashlen, otsbits, count, otsmode)
+    worker_counts = sorted({1, max_workers} | {1 << i for i in range(0, max_workers.bit_length())
+                                               if 1 << i <= max_workers})
+    best = None
+    for kind, executor_class in _EXECUTORS.items():
+        for workers in worker_counts:
+            with executor_class(max_workers=workers) as executor:
+                # Start the workers before measuring
+                list(executor.map(abs, range(0, workers)))
+                batch_size = max(1, count // (4 * workers))
+                rate = _keys_per_second(executor, privkeys, otsbits, hashlen, salt, batch_size)
+            if best is None or rate > best["keys_per_second"]:
+                best = {"kind": kind, "workers": workers, "batch_size": batch_size, "keys_per_second": rate}
+    with _EXECUTORS[best["kind"]](max_workers=best["workers"]) as executor:
+        list(executor.map(abs, range(0, best["workers"])))
+        for batch_size in [1, 4, 16, 64, 256]:
+            if batch_size >= count or batch_size == best["batch_size"]:
+                continue
+            rate = _keys_per_second(executor, privkeys, otsbits, hashlen, salt, batch_size)
+            if rate > best["keys_per_second"]:
+                best["batch_size"] = batch_size
+                best["keys_per_second"] = rate
+    return best
+
+def _load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf8") as cachefile:
+            return json.load(cachefile)
+    except (OSError, ValueError):
+        return {}
+
+def get_tuning(hashlen, otsbits, recalibrate=False, cache_path=None, budget=2.0, otsmode=OTS_DUAL):
+    """Get the tuning for a parameter set on this host, calibrating on a cache miss
+
+    Parameters
+    ----------
+    hashlen : int
+        Hash length of the level keys
+    otsbits : int
+        Number of OTS bits of the level keys
+    recalibrate : bool
+        Ignore and replace a cached result
+    cache_path : str or None
+        Cache file, TUNING_CACHE if None
+    budget : float
+        Calibration budget, see calibrate
+    otsmode : str
+        OTS mode of the level keys, see calibrate
+
+    Returns
+    -------
+    dict
+        kind, workers, batch_size and keys_per_second
+    """
+    if cache_path is None:
+        cache_path = TUNING_CACHE
+    cache = _load_cache(cache_path)
+    host = cache.setdefault(host_id(), {})
+    params = str(hashlen) + "-" + str(otsbits)
+    if otsmode != OTS_DUAL:
+        params += "-" + otsmode
+    if recalibrate or params not in host:
+        host[params] = calibrate(hashlen, otsbits, budget, otsmode=otsmode)
+        directory = os.path.dirname(cache_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmppath = cache_path + ".tmp"
+        with open(tmppath, "w", encoding="utf8") as cachefile:
+            json.dump(cache, cachefile, indent=1)
+        os.replace(tmppath, cache_path)
+    return host[params]
+
+def make_executor(tuning):
+    """Create the executor a tuning result asks for
+
+    Returns
+    -------
+    concurrent.futures.Executor
+        Thread or process pool, to be shut down by the caller
+    """
+    return _EXECUTORS[tuning["kind"]](max_workers=tuning["workers"])
@@ -1,31 +1,41 @@
 #!/usr/bin/python3
-from coinzdense.signing import SigningKey as _SigningKey
-from coinzdense.validation import ValidationEnv as _ValidationEnv
-from coinzdense.wallet import create_wallet as _create_wallet
-from coinzdense.wallet import open_wallet as _open_wallet
+from coinzdense.unstable.signing import SigningKey as _SigningKey
+from coinzdense.unstable.validation import ValidationEnv as _ValidationEnv
+from coinzdense.unstable.validation import _level_params
+from coinzdense.unstable.wallet import create_wallet as _create_wallet
+from coinzdense.unstable.wallet import open_wallet as _open_wallet
+from coinzdense.layerzero.onetime import OTS_DUAL, OTS_MODES
+from coinzdense.layerzero.onetime import _ots_chains_per_signature
 
-def _keys_per_signature(hashlen, otsbits):
-    return 2*(((hashlen*8-1) // otsbits)+1)
+def _keys_per_signature(hashlen, otsbits, otsmode=OTS_DUAL):
+    return _ots_chains_per_signature(hashlen, otsbits, otsmode)
 
-def _sub_sub_keyspace_usage(hashlen, otsbits, height):
-    return 1 + _keys_per_signature(hashlen, otsbits) * (1 << height)
+def _sub_sub_keyspace_usage(hashlen, otsbits, height, otsmode=OTS_DUAL):
+    return 1 + _keys_per_signature(hashlen, otsbits, otsmode) * (1 << height)
 
-def _sub_keyspace_usage(hashlen, otsbits, heights):
-    usage = _sub_sub_keyspace_usage(hashlen, otsbits,heights[0])
+def _sub_keyspace_usage(hashlens, otsbits, heights, otsmode=OTS_DUAL):
+    # hashlens and otsbits hold the per level values for heights
+    usage = _sub_sub_keyspace_usage(hashlens[0], otsbits[0], heights[0], otsmode)
     if len(heights) > 1:
-        usage += (1 << heights[0]) * _sub_keyspace_usage(hashlen, otsbits, heights[1:])
+        usage += (1 << heights[0]) * _sub_keyspace_usage(hashlens[1:], otsbits[1:], heights[1:], otsmode)
     return usage
 
-def _keyspace_usage(hashlen, otsbits, keyspace):
-    usage = (1 << sum(keyspace[0]["heights"])) + _sub_keyspace_usage(hashlen, otsbits, keyspace[0]["heights"])
+def _own_keyspace_usage(hashlen, otsbits, keyspace_entry, otsmode=OTS_DUAL):
+    hashlens, otsbits_list = _level_params(hashlen, otsbits, keyspace_entry)
+    return (1 << sum(keyspace_entry["heights"])) + _sub_keyspace_usage(hashlens, otsbits_list,
+                                                                       keyspace_entry["heights"], otsmode)
+
+def _keyspace_usage(hashlen, otsbits, keyspace, otsmode=OTS_DUAL):
+    usage = _own_keyspace_usage(hashlen, otsbits, keyspace[0], otsmode)
     if len(keyspace) > 1:
-        usage += (1 << keyspace[0]["reserve"]) * _keyspace_usage(hashlen, otsbits, keyspace[1:])
+        usage += (1 << keyspace[0]["reserve"]) * _keyspace_usage(hashlen, otsbits, keyspace[1:], otsmode)
     return usage
 
 class KeySpace:
-    def __init__(self, hashlen, otsbits, keyspace, offset=0, size=1<<64, state=None):
+    def __init__(self, hashlen, otsbits, keyspace, offset=0, size=1<<64, state=None, otsmode=OTS_DUAL):
         self.hashlen = hashlen
         self.otsbits = otsbits
+        self.otsmode = otsmode
         self.keyspace = keyspace
         if state is None:
             self.state = {}
@@ -39,22 +49,23 @@ class KeySpace:
                 self.state["reserved_heap_start"] = offset
                 self.state["reserved_heap"] = offset
             else:
-                reserved = (1 << reserve_bits) * _keyspace_usage(hashlen, otsbits, keyspace[1:])
+                reserved = (1 << reserve_bits) * _keyspace_usage(hashlen, otsbits, keyspace[1:], otsmode)
                 self.state["heap_start"] = offset + reserved
                 self.state["heap"] = offset + reserved
                 self.state["has_reserved"] = True
                 self.state["reserved_heap_start"] = offset
                 self.state["reserved_heap"] = offset
             self.state["own_offset"] = self.state["heap"]
-            self.state["heap"] += (1 << sum(keyspace[0]["heights"])) + _sub_keyspace_usage(hashlen, otsbits, keyspace[0]["heights"])
+            self.state["heap"] += _own_keyspace_usage(hashlen, otsbits, keyspace[0], otsmode)
         else:
             self.state = state
     def own_offset(self):
         return self.state["own_offset"]
     def allocate_subspace(self):
-        keyspace_size = _keyspace_usage(hashlen, otsbits, keyspace[1:])
+        keyspace_size = _keyspace_usage(hashlen, otsbits, keyspace[1:], self.otsmode)
         self.state["stack"] -= keyspace_size
-        return KeySpace(self.hashlen, self.otsbits, self.keyspace[1:], self.state["stack"], keyspace_size)
+        return KeySpace(self.hashlen, self.otsbits, self.keyspace[1:], self.state["stack"], keyspace_size,
+                        otsmode=self.otsmode)
     def get_state(self):
         return self.state
 
@@ -67,6 +78,7 @@ class BlockChainEnv:
         self.appname = conf["appname"]
         self.hashlen = conf["hashlen"]
         self.otsbits = conf["otsbits"]
+        self.otsmode = conf.get("otsmode", OTS_DUAL)
         self.keyspace = conf["keyspace"]
         if "hierarchy" in conf:
             self.hierarchy = conf["hierarchy"]
@@ -79,6 +91,7 @@ class BlockChainEnv:
         assert isinstance(self.appname, str), "Please run coinzdense-lint on your blockchain RC"
         assert isinstance(self.hashlen, int), "Please run coinzdense-lint on your blockchain RC"
         assert isinstance(self.otsbits, int), "Please run coinzdense-lint on your blockchain RC"
+        assert self.otsmode in OTS_MODES, "Please run coinzdense-lint on your blockchain RC"
         assert isinstance(self.keyspace, list), "Please run coinzdense-lint on your blockchain RC"
         assert isinstance(self.hierarchy, dict), "Please run coinzdense-lint on your blockchain RC"
         assert isinstance(self.subpath, list), "Please run coinzdense-lint on your blockchain RC"
@@ -100,6 +113,14 @@ class BlockChainEnv:
                 assert height > 2, "Please run coinzdense-lint on your blockchain RC"
                 assert height < 17, "Please run coinzdense-lint on your blockchain RC"
                 total_height += height
+            for name, low, high in (("hashlen", 15, 65), ("otsbits", 3, 17)):
+                # Optional per level override of the application wide value
+                if name in val:
+                    per_level = val[name] if isinstance(val[name], list) else [val[name]] * len(val["heights"])
+                    assert len(per_level) == len(val["heights"]), "Please run coinzdense-lint on your blockchain RC"
+                    for value in per_level:
+                        assert isinstance(value, int), "Please run coinzdense-lint on your blockchain RC"
+                        assert low < value < high, "Please run coinzdense-lint on your blockchain RC"
             if idx < len(self.keyspace) -1:
                 assert "reserve" in val, "Please run coinzdense-lint on your blockchain RC"
                 assert isinstance(val["reserve"], int), "Please run coinzdense-lint on your blockchain RC"
@@ -109,7 +130,7 @@ class BlockChainEnv:
                 assert "reserve" not in val, "Please run coinzdense-lint on your blockchain RC"
         for subpath_part in self.subpath:
             assert isinstance(subpath_part, str), "Please run coinzdense-lint on your blockchain RC"
-        total = _keyspace_usage(self.hashlen, self.otsbits, self.keyspace)
+        total = _keyspace_usage(self.hashlen, self.otsbits, self.keyspace, self.otsmode)
         assert total.bit_length() < 65, "Please run coinzdense-lint on your blockchain RC"
 
     def _check_hierarchy(self, sub_hierarchy=None, depth=0):
@@ -130,6 +151,7 @@ class BlockChainEnv:
             subconf["appname"] = self.appname
             subconf["hashlen"] = self.hashlen
             subconf["otsbits"] = self.otsbits
+            subconf["otsmode"] = self.otsmode
             subconf["keyspace"] = self.keyspace[1:]
             subconf["hierarchy"] = self.hierarchy[key]
             subconf["sub_path"] = self.subpath[:] + [key]
@@ -137,13 +159,16 @@ class BlockChainEnv:
         else:
             raise KeyError("No sub-key hierarchy named " + key)
 
-    def get_signing_key(self, wallet, idx=0, idx2=0, backup=None):
+    def get_signing_key(self, wallet, idx=0, idx2=0, backup=None, table_source=None, executor=None):
+        # pylint: disable=too-many-arguments
         path = [self.appname] + self.subpath
-        return _SigningKey(self.hashlen, self.otsbits, self.keyspace, path, self.hierarchy, wallet, idx, idx2, backup)
+        return _SigningKey(self.hashlen, self.otsbits, self.keyspace, path, self.hierarchy, wallet, idx, idx2, backup,
+                           table_source=table_source, executor=executor, otsmode=self.otsmode)
 
-    def get_validator(self):
+    def get_validator(self, index_store=None, result_cache=None):
         path = [self.appname] + self.subpath
-        return _ValidationEnv(self.hashlen, self.otsbits, self.keyspace, path, self.hierarchy)
+        return _ValidationEnv(self.hashlen, self.otsbits, self.keyspace, path, self.hierarchy, index_store,
+                              result_cache, self.otsmode)
 
     def create_wallet(self, salt, key, password):
         path = [self.appname] + self.subpath
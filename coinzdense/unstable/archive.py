@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+"""Archive layout for full and compressed coinZdense signatures
+
+Use with coinzdense.layerzero.archive.ArchiveWriter: the privid, level pubkeys,
+bottom level salt, merkle header nodes and whole upper level signatures are
+interned, the indices, message salt, digest and OTS chain values are stored
+literally.
+"""
+from coinzdense.layerzero.archive import ArchiveWriter, ArchiveReader
+from coinzdense.layerzero.onetime import OTS_DUAL, _ots_chains_per_signature
+from coinzdense.unstable.validation import _PRIVID_LEN, _TREE_DIGEST_FLAG, _level_signature_size
+
+def signature_layout(hashlen, otsbits, heights, otsmode=OTS_DUAL, level_hashlen=None, level_otsbits=None):
+    # pylint: disable=too-many-arguments
+    """Layout function for signatures made with SigningKey
+
+    Parameters
+    ----------
+    hashlen : int
+        Hash length of the key structure
+    otsbits : int
+        OTS bits of the key structure
+    heights : list of int
+        Level key heights of the key space, top level first
+    otsmode : str
+        OTS mode of the key structure, "dual" or "wots"
+    level_hashlen, level_otsbits : list of int or None
+        Per level hash length and OTS bits, top level first; hashlen and otsbits for every level if None
+
+    Returns
+    -------
+    callable
+        Function mapping a signature to a list of (internable, length) fields
+    """
+    level_hashlen = level_hashlen or [hashlen] * len(heights)
+    level_otsbits = level_otsbits or [otsbits] * len(heights)
+    bottom_hashlen = level_hashlen[-1]
+    vps = _ots_chains_per_signature(bottom_hashlen, level_otsbits[-1], otsmode)
+    # Upper level signatures in signature order: bottom key's parent signature first
+    upper_sizes = [_level_signature_size(level_hashlen[level], level_otsbits[level], heights[level], otsmode)
+                   for level in reversed(range(0, len(heights) - 1))]
+    fixed = [(True, _PRIVID_LEN), (False, 9 + 2 * hashlen)] + \
+            [(True, length) for length in reversed(level_hashlen)] + \
+            [(False, 8), (True, bottom_hashlen)] + \
+            [(True, bottom_hashlen)] * heights[-1] + \
+            [(False, vps * bottom_hashlen)]
+    fixed_len = sum(length for _, length in fixed)
+
+    def layout(signature):
+        if len(signature) < fixed_len:
+            return [(False, len(signature))]
+        sigcount = signature[_PRIVID_LEN] & ~_TREE_DIGEST_FLAG
+        upper = [(True, size) for size in upper_sizes[:sigcount - 1]]
+        if sigcount < 1 or fixed_len + sum(length for _, length in upper) != len(signature):
+            return [(False, len(signature))]
+        return fixed + upper
+    return layout
+
+def signature_archive(validator, base=None):
+    """Create an ArchiveWriter for signatures of the key space of a ValidationEnv"""
+    return ArchiveWriter(signature_layout(validator.hashlen, validator.otsbits, validator.heights, validator.otsmode,
+                                          validator.level_hashlen, validator.level_otsbits),
+                         base)
+
+def open_archive(path):
+    """Memory map an archive for random access decoding"""
+    return ArchiveReader.open(path)
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""Zero-copy iteration over block files of concatenated signatures
+
+A block file holds signatures made with SigningKey back to back, full and
+compressed mixed. The size of every signature follows from its sigcount
+header byte and the key space heights, so the reader finds the boundaries
+without parsing or copying and hands out read-only memoryview slices of the
+mapped file that go straight into ValidationEnv.validate_many::
+
+    with SignatureBlockReader.open(path, validator) as block:
+        results = block.validate(validator, messages)
+
+Signature archives (coinzdense.unstable.archive) store signatures
+deduplicated rather than back to back; decode those with open_archive.
+"""
+import mmap
+from array import array
+from coinzdense.unstable.validation import _PRIVID_LEN, _TREE_DIGEST_FLAG, _signature_size
+
+class SignatureBlockReader:
+    """Signature boundaries and zero-copy views of a block of concatenated signatures"""
+    def __init__(self, buffer, validator, owner=None):
+        """Constructor
+
+        Parameters
+        ----------
+        buffer : bytes-like
+            The concatenated signatures
+        validator : ValidationEnv
+            Validation environment of the key space the signatures were made in
+        owner : object or None
+            Object backing the buffer (mmap) that is closed by close()
+
+        Raises
+        ------
+        ValueError
+            Thrown if the block does not split into whole signatures
+        """
+        view = memoryview(buffer).cast("B").toreadonly()
+        heights = validator.heights
+        sizes = [_signature_size(validator.hashlen, validator.level_hashlen, validator.level_otsbits, heights,
+                                 sigcount, validator.otsmode)
+                 for sigcount in range(0, len(heights) + 1)]
+        offsets = array("Q", [0])
+        offset = 0
+        try:
+            while offset < len(view):
+                if offset + _PRIVID_LEN >= len(view):
+                    raise ValueError("Truncated signature at offset " + str(offset))
+                sigcount = view[offset + _PRIVID_LEN] & ~_TREE_DIGEST_FLAG
+                if sigcount < 1 or sigcount > len(heights):
+                    raise ValueError("Invalid signature count at offset " + str(offset))
+                offset += sizes[sigcount]
+                if offset > len(view):
+                    raise ValueError("Truncated signature at end of block")
+                offsets.append(offset)
+        except ValueError:
+            # Let the caller close the backing map
+            view.release()
+            raise
+        self._view = view
+        self._offsets = offsets
+        self._owner = owner
+        self._closed = False
+
+    @classmethod
+    def open(cls, path, validator):
+        """Memory map a block file"""
+        with open(path, "rb") as infile:
+            infile.seek(0, 2)
+            if infile.tell() == 0:
+                return cls(b"", validator)
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mapped, validator, mapped)
+        except ValueError:
+            mapped.close()
+            raise
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, number):
+        """Zero-copy view of a single signature"""
+        if number < 0 or number >= len(self):
+            raise IndexError("block index out of range")
+        return self._view[self._offsets[number]:self._offsets[number + 1]]
+
+    def __iter__(self):
+        for number in range(0, len(self)):
+            yield self[number]
+
+    def offset(self, number):
+        """Byte offset of a signature in the block"""
+        return self._offsets[number]
+
+    def views(self):
+        """Zero-copy views of all signatures, in block order"""
+        return list(self)
+
+    def validate(self, validator, messages=None, stored_indices=None, executor=None):
+        """Validate all signatures in the block, see ValidationEnv.validate_many"""
+        return validator.validate_many(self.views(), messages, stored_indices, executor)
+
+    def close(self):
+        """Release the buffer and close the backing map
+
+        Views handed out must be released first."""
+        if not self._closed:
+            self._closed = True
+            self._view.release()
+            if self._owner is not None:
+                self._owner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+"""Deterministic signature corpora for validator throughput and correctness benchmarks
+
+generate_corpus signs messages for many accounts and sub-key paths on a process
+pool, every key on its own worker so only the level keys that key needs get
+built. Everything derives from the seed: account keys, messages, the choice of
+compressed signatures, which signatures get corrupted and the interleaving of
+keys over the blocks. Within a key signatures stay in index order, so every
+compressed signature follows a full one of the same key.
+
+The output directory holds block files of concatenated signatures for
+SignatureBlockReader and manifest.json with the application config and per
+block the messages and expected validation results. check_corpus replays a
+corpus through ValidationEnv.validate_many and reports throughput and
+mismatches. All key paths use the same level heights so one validator can
+check every block.
+
+Command line::
+
+    python3 -m coinzdense.unstable.corpus OUTDIR --accounts 100 --yaml etc/coinzdense.d/hiveish.yml
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from coinzdense.layerzero.onetime import OTS_DUAL, OTS_MODES
+from coinzdense.unstable.app import BlockChainEnv
+from coinzdense.unstable.wallet import _Wallet, _keypath_to_id
+from coinzdense.unstable.blockfile import SignatureBlockReader
+from coinzdense.unstable.validation import _PRIVID_LEN
+
+MANIFEST = "manifest.json"
+# Ways a corpus signature is made invalid
+CORRUPT_CHAIN = "chain"
+CORRUPT_HEADER = "header"
+CORRUPT_MESSAGE = "message"
+
+def _derive(seed, *parts, size=32):
+    return _nacl1_hash_function("/".join(parts).encode("utf8"),
+                                digest_size=size,
+                                key=seed,
+                                encoder=_Nacl1RawEncoder)
+
+def hierarchy_from_yaml(path):
+    """Read appname, hashlen, otsbits and the sub-key hierarchy from a Wen3 YAML app config
+    like etc/coinzdense.d/hiveish.yml; needs PyYAML"""
+    # pylint: disable=import-outside-toplevel
+    from yaml import load
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader
+    with open(path, encoding="utf8") as infile:
+        conf = load(infile, Loader=Loader)
+
+    def subkeys(node):
+        return {sub["name"]: subkeys(sub) for sub in node.get("subkeys", []) if "name" in sub}
+    return conf["appname"], conf["hashlen"], conf["otsbits"], subkeys(conf)
+
+def make_conf(appname, hashlen, otsbits, hierarchy, heights, reserve=2, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """BlockChainEnv config using the same level heights at every depth of the hierarchy"""
+    def depth(node):
+        return 1 + max([depth(sub) for sub in node.values()], default=0)
+    keyspace = [{"heights": list(heights), "reserve": reserve} for _ in range(1, depth(hierarchy))]
+    keyspace.append({"heights": list(heights)})
+    return {"appname": appname,
+            "hashlen": hashlen,
+            "otsbits": otsbits,
+            "otsmode": otsmode,
+            "keyspace": keyspace,
+            "hierarchy": hierarchy}
+
+def _paths(hierarchy, prefix=()):
+    rval = [list(prefix)]
+    for name, sub in hierarchy.items():
+        rval += _paths(sub, prefix + (name,))
+    return rval
+
+def _key_job(conf, seed, account, path, count, compressed_fraction):
+    # pylint: disable=too-many-arguments
+    """Sign count seeded messages with one account's key for a path"""
+    env = BlockChainEnv(conf)
+    for part in path:
+        env = env[part]
+    label = account + ":" + "/".join(path)
+    wallet = _Wallet(b"", _keypath_to_id([conf["appname"]] + path), _derive(seed, "key", label))
+    signing_key = env.get_signing_key(wallet)
+    rng = random.Random(_derive(seed, "mix", label))
+    rval = []
+    for number in range(0, count):
+        message = _derive(seed, "msg", label, str(number), size=16 + rng.randrange(0, 48))
+        compressed = number > 0 and rng.random() < compressed_fraction
+        rval.append((signing_key.sign_data(message, compressed=compressed), message))
+    return rval
+
+def _corrupt(signature, message, kind, rng, validator):
+    """Make a signature invalid in one of the CORRUPT_ ways"""
+    signature = bytearray(signature)
+    if kind == CORRUPT_CHAIN:
+        signature[-1 - rng.randrange(0, 64)] ^= 1 << rng.randrange(0, 8)
+    elif kind == CORRUPT_HEADER:
+        # A byte of the top level pubkey
+        signature[_PRIVID_LEN + 9 + 2 * validator.hashlen + sum(validator.level_hashlen[1:])] ^= 1
+    else:
+        message = message + b"!"
+    return bytes(signature), message
+
+def _expected(validator, signatures, corrupted, trusted):
+    """Expected validate_many results for a block, given the level pubkeys trusted so far
+
+    Like validate_many, full signatures are checked before compressed ones, and a
+    compressed signature is only valid if a valid full signature made its chain
+    trusted."""
+    # pylint: disable=protected-access
+    parsed = [validator.signature(signature) for signature in signatures]
+    full = [number for number, sig in enumerate(parsed) if sig.sigcount == len(sig.pubkeys)]
+    compressed = [number for number, sig in enumerate(parsed) if sig.sigcount < len(sig.pubkeys)]
+    expected = [False] * len(signatures)
+    for number in full + compressed:
+        sig = parsed[number]
+        valid = not corrupted[number]
+        if valid and sig.sigcount < len(sig.pubkeys):
+            valid = trusted.get(sig._trust_key()) == tuple(sig.pubkeys[sig.sigcount:])
+        if valid:
+            for level in range(0, len(sig.pubkeys)):
+                trusted[(sig.privhash, sig.pubkeys[level])] = tuple(sig.pubkeys[level + 1:])
+        expected[number] = valid
+    return expected
+
+def generate_corpus(directory, conf, accounts, seed, signatures_per_key=8, compressed_fraction=0.5,
+                    invalid_fraction=0.05, block_size=1000, executor=None):
+    # pylint: disable=too-many-arguments, too-many-locals
+    """Generate a seeded corpus of blocks and an expected results manifest
+
+    Parameters
+    ----------
+    directory : str
+        Output directory, created if needed
+    conf : dict
+        BlockChainEnv config, see make_conf
+    accounts : int
+        Number of accounts, each signing with every key path of the hierarchy
+    seed : bytes
+        16 to 64 byte corpus seed
+    signatures_per_key : int
+        Number of signatures per account and key path
+    compressed_fraction : float
+        Chance for all but the first signature of a key to be compressed
+    invalid_fraction : float
+        Chance for a signature to be corrupted
+    block_size : int
+        Maximum number of signatures per block file
+    executor : concurrent.futures.Executor or None
+        Pool to sign on, a ProcessPoolExecutor if None
+
+    Returns
+    -------
+    dict
+        The manifest
+    """
+    env = BlockChainEnv(conf)
+    jobs = [("account%06d" % number, path) for number in range(0, accounts) for path in _paths(env.hierarchy)]
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor()
+    try:
+        results = list(executor.map(_key_job,
+                                    [conf] * len(jobs),
+                                    [seed] * len(jobs),
+                                    [account for account, _ in jobs],
+                                    [path for _, path in jobs],
+                                    [signatures_per_key] * len(jobs),
+                                    [compressed_fraction] * len(jobs)))
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+    # Interleave keys randomly, keeping every key's signatures in index order
+    rng = random.Random(_derive(seed, "order"))
+    queues = [list(reversed(result)) for result in results if result]
+    ordered = []
+    while queues:
+        queue = queues[rng.randrange(0, len(queues))]
+        ordered.append(queue.pop())
+        if not queue:
+            queues.remove(queue)
+    os.makedirs(directory, exist_ok=True)
+    validator = env.get_validator()
+    trusted = {}
+    blocks = []
+    kinds = [CORRUPT_CHAIN, CORRUPT_HEADER, CORRUPT_MESSAGE]
+    for start in range(0, len(ordered), block_size):
+        name = "block-%05d.czsb" % (start // block_size)
+        signatures = []
+        messages = []
+        corruptions = []
+        for signature, message in ordered[start:start + block_size]:
+            kind = None
+            if rng.random() < invalid_fraction:
+                kind = kinds[rng.randrange(0, len(kinds))]
+                signature, message = _corrupt(signature, message, kind, rng, validator)
+            signatures.append(signature)
+            messages.append(message)
+            corruptions.append(kind)
+        expected = _expected(validator, signatures, corruptions, trusted)
+        entries = [{"message": message.hex(), "valid": valid, "corruption": kind}
+                   for message, valid, kind in zip(messages, expected, corruptions)]
+        with open(os.path.join(directory, name), "wb") as outfile:
+            outfile.write(b"".join(signatures))
+        blocks.append({"file": name, "signatures": entries})
+    manifest = {"conf": conf,
+                "seed": seed.hex(),
+                "accounts": accounts,
+                "signatures": len(ordered),
+                "blocks": blocks}
+    with open(os.path.join(directory, MANIFEST), "w", encoding="utf8") as outfile:
+        json.dump(manifest, outfile, indent=1)
+    return manifest
+
+def check_corpus(directory, executor=None, **kwargs):
+    """Validate a corpus block by block against its manifest
+
+    Blocks are validated in order with one validator, so compressed signatures
+    can chain up from full signatures in earlier blocks. Extra keyword arguments
+    go to ValidationEnv.validate_many.
+
+    Returns
+    -------
+    dict
+        signatures, seconds, signatures_per_second and mismatches (block file,
+        signature number) where the result differs from the manifest
+    """
+    with open(os.path.join(directory, MANIFEST), encoding="utf8") as infile:
+        manifest = json.load(infile)
+    validator = BlockChainEnv(manifest["conf"]).get_validator()
+    mismatches = []
+    count = 0
+    seconds = 0.0
+    for block in manifest["blocks"]:
+        entries = block["signatures"]
+        with SignatureBlockReader.open(os.path.join(directory, block["file"]), validator) as reader:
+            start = time.monotonic()
+            results = reader.validate(validator, [bytes.fromhex(entry["message"]) for entry in entries],
+                                      executor=executor, **kwargs)
+            seconds += time.monotonic() - start
+        count += len(results)
+        for number, (entry, result) in enumerate(zip(entries, results)):
+            if bool(result) != entry["valid"]:
+                mismatches.append((block["file"], number))
+    return {"signatures": count,
+            "seconds": seconds,
+            "signatures_per_second": count / seconds if seconds else 0.0,
+            "mismatches": mismatches}
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Generate a seeded coinZdense signature benchmark corpus")
+    parser.add_argument("directory", help="output directory")
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--yaml", help="Wen3 YAML app config to take the appname, hash parameters and key paths from")
+    parser.add_argument("--appname", default="BENCH")
+    parser.add_argument("--hashlen", type=int, default=24)
+    parser.add_argument("--otsbits", type=int, default=6)
+    parser.add_argument("--otsmode", choices=OTS_MODES, default=OTS_DUAL)
+    parser.add_argument("--heights", default="3,3,3", help="comma separated level heights for every key path")
+    parser.add_argument("--seed", default="coinzdense-corpus")
+    parser.add_argument("--per-key", type=int, default=8)
+    parser.add_argument("--compressed", type=float, default=0.5)
+    parser.add_argument("--invalid", type=float, default=0.05)
+    parser.add_argument("--block-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--check", action="store_true", help="validate the corpus afterwards")
+    args = parser.parse_args(argv)
+    appname, hashlen, otsbits, hierarchy = args.appname, args.hashlen, args.otsbits, {}
+    if args.yaml:
+        appname, hashlen, otsbits, hierarchy = hierarchy_from_yaml(args.yaml)
+    conf = make_conf(appname, hashlen, otsbits, hierarchy, [int(part) for part in args.heights.split(",")],
+                     otsmode=args.otsmode)
+    seed = _nacl1_hash_function(args.seed.encode("utf8"), digest_size=32, encoder=_Nacl1RawEncoder)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        start = time.monotonic()
+        manifest = generate_corpus(args.directory, conf, args.accounts, seed, args.per_key, args.compressed,
+                                   args.invalid, args.block_size, executor)
+        print("Generated", manifest["signatures"], "signatures in", len(manifest["blocks"]), "blocks in",
+              round(time.monotonic() - start, 1), "seconds")
+        if args.check:
+            report = check_corpus(args.directory, executor)
+            print("Validated", report["signatures"], "signatures,", round(report["signatures_per_second"], 1),
+                  "per second,", len(report["mismatches"]), "mismatches")
+            return 1 if report["mismatches"] else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
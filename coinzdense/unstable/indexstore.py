@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+"""Persistent store of used (account, signature index) facts for replay and OTS reuse detection
+
+A privid only names a key path, every account on that path shares it, so the
+store is keyed on an account id (see account_id) that binds the privid to the
+account's top level pubkey.
+
+Per key the store keeps the highest signature index seen and, for the last
+window indices up to it, which indices were seen with a fingerprint of the
+signed digest. That answers seen, highest index and gaps in O(1) amortized,
+and tells a replay (same index, same digest) apart from one-time key reuse
+(same index, different digest). Reuse means the signing key leaked or a
+signer was restored from a stale backup.
+
+Indices at or below highest - window are stale: below the replay horizon
+they count as seen and can no longer be accepted.
+
+File layout: magic "CZIX" | version (1) | reserved (3), followed by appended
+records of account id (24) | index (8, big-endian) | digest fingerprint (8).
+Opening replays the records into memory, compact() rewrites the file with
+only the live state.
+
+Durability: records are buffered until flush(). ValidationEnv flushes at the
+end of every validate and validate_many call, so a fact is handed to the OS
+before the caller learns the signature was accepted and survives a crash of
+the process. With sync=True every flush is also fsynced, to survive power
+loss at the cost of a disk sync per call.
+"""
+import os
+import struct
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+
+NEW = "new"
+REPLAY = "replay"
+REUSE = "reuse"
+STALE = "stale"
+
+_MAGIC = b"CZIX"
+_VERSION = 2
+_HEADER = struct.Struct(">4sB3x")
+_RECORD = struct.Struct(">24sQ8s")
+_PRIVID_LEN = 24
+_ACCOUNT_LEN = 24
+_FINGERPRINT_LEN = 8
+_FLUSH_RECORDS = 4096
+
+def account_id(privid, pubkey):
+    """Store key of an account: its privid bound to its top level pubkey"""
+    return _nacl1_hash_function(bytes(pubkey),
+                                digest_size=_ACCOUNT_LEN,
+                                key=bytes(privid),
+                                encoder=_Nacl1RawEncoder)
+
+class IndexStore:
+    """Seen signature indices per key, in memory with an append-only log file"""
+    def __init__(self, path=None, window=64, sync=False):
+        """Constructor
+
+        Parameters
+        ----------
+        path : str or None
+            Log file, created if it does not exist; memory only if None
+        window : int
+            Number of indices up to the highest one kept per key for replay, reuse and gap queries
+        sync : bool
+            fsync the log file on every flush
+
+        Raises
+        ------
+        ValueError
+            Thrown if the file is not an index store log
+        """
+        if not isinstance(window, int) or window < 1:
+            raise ValueError("window must be a positive integer")
+        self._path = path
+        self._window = window
+        self._sync = sync
+        # account to highest index, and account to {index: fingerprint} for the window
+        self._highest = {}
+        self._recent = {}
+        self._pending = []
+        self._file = None
+        if path is not None:
+            self._load()
+            self._file = open(path, "ab")  # pylint: disable=consider-using-with
+            if self._file.tell() == 0:
+                self._file.write(_HEADER.pack(_MAGIC, _VERSION))
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, "rb") as infile:
+            header = infile.read(_HEADER.size)
+            if not header:
+                return
+            if len(header) < _HEADER.size or _HEADER.unpack(header) != (_MAGIC, _VERSION):
+                raise ValueError("Not an index store file")
+            while True:
+                chunk = infile.read(_RECORD.size * _FLUSH_RECORDS)
+                # A torn last record from an interrupted append is ignored
+                for account, index, fingerprint in _RECORD.iter_unpack(chunk[:len(chunk) - len(chunk) % _RECORD.size]):
+                    self._apply(account, index, fingerprint)
+                if len(chunk) < _RECORD.size * _FLUSH_RECORDS:
+                    return
+
+    def _apply(self, account, index, fingerprint):
+        recent = self._recent.setdefault(account, {})
+        recent[index] = fingerprint
+        if index > self._highest.get(account, -1):
+            self._highest[account] = index
+            if len(recent) > 2 * self._window:
+                floor = index - self._window
+                self._recent[account] = {idx: fpr for idx, fpr in recent.items() if idx > floor}
+
+    def __len__(self):
+        return len(self._highest)
+
+    def __contains__(self, account):
+        return account in self._highest
+
+    def highest(self, account):
+        """Highest index seen for a key, None for an unknown key"""
+        return self._highest.get(account)
+
+    def status(self, account, index, digest=None):
+        """Classify an (account, index) fact against the store without recording it
+
+        Parameters
+        ----------
+        account : bytes
+            Account id, see account_id
+        index : int
+            Signature index
+        digest : bytes or None
+            Signed digest; without it a seen index counts as a replay
+
+        Returns
+        -------
+        str
+            NEW, REPLAY, REUSE or STALE
+        """
+        highest = self._highest.get(account)
+        if highest is None:
+            return NEW
+        fingerprint = self._recent[account].get(index)
+        if fingerprint is not None:
+            if digest is None or fingerprint == bytes(digest[:_FINGERPRINT_LEN]):
+                return REPLAY
+            return REUSE
+        if index <= highest - self._window:
+            return STALE
+        return NEW
+
+    def seen(self, account, index):
+        """True if the index was used by the key or is below its replay horizon"""
+        return self.status(account, index) != NEW
+
+    def gaps(self, account):
+        """Unused indices within the window up to the highest index of a key"""
+        highest = self._highest.get(account)
+        if highest is None:
+            return []
+        recent = self._recent[account]
+        return [index for index in range(max(0, highest - self._window + 1), highest)
+                if index not in recent]
+
+    def record(self, account, index, digest):
+        """Record a fact from a validated signature
+
+        Returns
+        -------
+        str
+            The status before recording, the fact is only stored if NEW
+        """
+        account = bytes(account)
+        status = self.status(account, index, digest)
+        if status == NEW:
+            fingerprint = bytes(digest[:_FINGERPRINT_LEN])
+            self._apply(account, index, fingerprint)
+            if self._file is not None:
+                self._pending.append(_RECORD.pack(account, index, fingerprint))
+                if len(self._pending) >= _FLUSH_RECORDS:
+                    self.flush()
+        return status
+
+    def bulk_load(self, signatures, validator):
+        """Record the facts of already validated historical signatures, in order
+
+        Only the signature headers are read, no hashing is done.
+
+        Parameters
+        ----------
+        signatures : iterable of bytes-like
+            Signatures, for example the views of a SignatureBlockReader
+        validator : ValidationEnv
+            Validation environment of the key space the signatures were made in
+
+        Returns
+        -------
+        dict
+            Count per status
+        """
+        hashlen = validator.hashlen
+        # The top level pubkey is the last of the header pubkeys
+        top = _PRIVID_LEN + 9 + 2 * hashlen + sum(validator.level_hashlen[1:])
+        counts = {NEW: 0, REPLAY: 0, REUSE: 0, STALE: 0}
+        for signature in signatures:
+            index = int.from_bytes(signature[_PRIVID_LEN + 1:_PRIVID_LEN + 9], "big")
+            digest = signature[_PRIVID_LEN + 9 + hashlen:_PRIVID_LEN + 9 + 2 * hashlen]
+            account = account_id(signature[:_PRIVID_LEN], signature[top:top + validator.level_hashlen[0]])
+            counts[self.record(account, index, digest)] += 1
+        self.flush()
+        return counts
+
+    def flush(self):
+        """Append pending records to the log file, fsynced if the store was opened with sync"""
+        if self._file is not None and self._pending:
+            self._file.write(b"".join(self._pending))
+            self._file.flush()
+            if self._sync:
+                os.fsync(self._file.fileno())
+            self._pending = []
+
+    def compact(self):
+        """Rewrite the log file with only the highest index and window of every key"""
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        tmppath = self._path + ".tmp"
+        with open(tmppath, "wb") as outfile:
+            outfile.write(_HEADER.pack(_MAGIC, _VERSION))
+            for account, recent in self._recent.items():
+                floor = self._highest[account] - self._window
+                outfile.write(b"".join(_RECORD.pack(account, index, fingerprint)
+                                       for index, fingerprint in sorted(recent.items())
+                                       if index > floor))
+        os.replace(tmppath, self._path)
+        self._file = open(self._path, "ab")  # pylint: disable=consider-using-with
+
+    def close(self):
+        """Flush and close the log file"""
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
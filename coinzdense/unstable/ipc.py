@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""Compact binary framing for the local coinZdense services on Unix domain sockets
+
+Every request and every response is a single frame::
+
+    opcode (1) | flags (1) | name length (2) | payload length (4) | name | payload
+
+All integers are big-endian. For responses the opcode holds a status code and
+the name is empty.
+"""
+import asyncio
+import struct
+
+_HEADER = struct.Struct(">BBHI")
+
+MAX_PAYLOAD = 1 << 30
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+def encode_frame(opcode, flags, name, payload):
+    """Encode a single frame
+
+    Parameters
+    ----------
+    opcode : int
+        Request opcode or response status
+    flags : int
+        Request flags
+    name : bytes
+        Key name the request is for, empty for responses
+    payload : bytes-like
+        Request or response body
+
+    Returns
+    -------
+    bytes
+        The encoded frame
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("payload too large for a single frame")
+    return _HEADER.pack(opcode, flags, len(name), len(payload)) + name + bytes(payload)
+
+def _decode_header(header):
+    opcode, flags, namelen, payloadlen = _HEADER.unpack(header)
+    if payloadlen > MAX_PAYLOAD:
+        raise ValueError("frame payload exceeds the maximum size")
+    return opcode, flags, namelen, payloadlen
+
+async def read_frame(reader):
+    """Read a single frame from an asyncio stream, None on a clean end of stream
+
+    Returns
+    -------
+    tuple
+        opcode, flags, name and payload
+    """
+    try:
+        header = await reader.readexactly(_HEADER.size)
+    except asyncio.IncompleteReadError as exc:
+        if exc.partial == b"":
+            return None
+        raise
+    opcode, flags, namelen, payloadlen = _decode_header(header)
+    name = await reader.readexactly(namelen)
+    payload = await reader.readexactly(payloadlen)
+    return opcode, flags, name, payload
+
+def _recv_exactly(sock, count):
+    """Receive exactly count bytes from a blocking socket"""
+    buffer = bytearray(count)
+    view = memoryview(buffer)
+    received = 0
+    while received < count:
+        chunk = sock.recv_into(view[received:], count - received)
+        if chunk == 0:
+            raise ConnectionError("Connection closed by service")
+        received += chunk
+    return bytes(buffer)
+
+def recv_frame(sock):
+    """Read a single frame from a blocking socket
+
+    Returns
+    -------
+    tuple
+        opcode, flags, name and payload
+    """
+    opcode, flags, namelen, payloadlen = _decode_header(_recv_exactly(sock, _HEADER.size))
+    name = _recv_exactly(sock, namelen)
+    payload = _recv_exactly(sock, payloadlen)
+    return opcode, flags, name, payload
+
+def call(sock, opcode, flags, name, payload):
+    """Send a request frame on a blocking socket and return the response payload
+
+    Raises
+    ------
+    RuntimeError
+        Thrown if the service answered with an error status
+    """
+    sock.sendall(encode_frame(opcode, flags, name, payload))
+    status, _, _, body = recv_frame(sock)
+    if status != STATUS_OK:
+        raise RuntimeError(body.decode("utf8", errors="replace"))
+    return body
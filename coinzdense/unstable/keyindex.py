@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+"""Compiled privid to key path index for an application config
+
+Every key in the hierarchy has a privid, BLAKE2b chained over its key path
+(see wallet._keypath_to_id). PrivIdIndex maps privids to key paths and the key
+space a key may use, and key paths back to privids, in O(1). Levels down to
+eager_depth are expanded on construction; deeper levels are only expanded
+when a lookup misses, so a deep hierarchy costs nothing until it is used.
+
+get_index builds an index once per process for every config hash. Given a
+cache directory, for example KEYINDEX_CACHE, a fully expanded index is also
+written to <cache dir>/<config hash>.json and loaded from there instead of
+hashing the hierarchy again.
+"""
+import os
+import json
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from nacl.encoding import HexEncoder as _Nacl1HexEncoder
+from coinzdense.unstable.wallet import _keypath_to_id
+
+KEYINDEX_CACHE = os.path.join(os.path.expanduser("~"), ".coinzdense", "keyindex")
+
+_INDICES = {}
+
+def config_hash(path, hierarchy, keyspace):
+    """Hash identifying the privid index of an application config"""
+    data = json.dumps([list(path), hierarchy, keyspace], sort_keys=True).encode("utf8")
+    return _nacl1_hash_function(data, digest_size=16, encoder=_Nacl1HexEncoder).decode()
+
+def _child_id(privid, name):
+    return _nacl1_hash_function(name.encode(),
+                                digest_size=24,
+                                key=privid,
+                                encoder=_Nacl1RawEncoder)
+
+class PrivIdIndex:
+    """Two-way privid and key path lookups for a key hierarchy"""
+    def __init__(self, path, hierarchy, keyspace, eager_depth=2, cache_path=None, entries=None):
+        # pylint: disable=too-many-arguments
+        """Constructor
+
+        Parameters
+        ----------
+        path : list of str
+            Key path of the hierarchy root, the appname and any sub path
+        hierarchy : dict
+            Sub-key hierarchy below the root
+        keyspace : list of dict
+            Key space config of the root, sub-keys use it minus one entry per level
+        eager_depth : int
+            Number of hierarchy levels below the root to expand right away
+        cache_path : str or None
+            File to save the index to once it is fully expanded
+        entries : dict or None
+            Fully expanded index as saved (privid hex to key path), skips hashing
+        """
+        self._root = tuple(path)
+        self._keyspace = keyspace
+        self.cache_path = cache_path
+        # privid to key path, key path to privid, and (key path, privid, sub hierarchy) to expand
+        self._by_id = {}
+        self._by_path = {}
+        self._frontier = []
+        if entries is not None:
+            for hexid, keypath in entries.items():
+                self._add(tuple(keypath), bytes.fromhex(hexid))
+        else:
+            privid = _keypath_to_id(self._root)
+            self._add(self._root, privid)
+            if hierarchy:
+                self._frontier.append((self._root, privid, hierarchy))
+            self._expand(eager_depth)
+
+    def _add(self, keypath, privid):
+        self._by_id[privid] = keypath
+        self._by_path[keypath] = privid
+
+    def _expand(self, max_depth=None):
+        """Expand the frontier down to max_depth levels below the root, all of it if None"""
+        if not self._frontier:
+            return
+        pending = []
+        while self._frontier:
+            keypath, privid, hierarchy = self._frontier.pop()
+            if max_depth is not None and len(keypath) - len(self._root) >= max_depth:
+                pending.append((keypath, privid, hierarchy))
+                continue
+            for name, sub_hierarchy in hierarchy.items():
+                child = keypath + (name,)
+                childid = _child_id(privid, name)
+                self._add(child, childid)
+                if sub_hierarchy:
+                    self._frontier.append((child, childid, sub_hierarchy))
+        self._frontier = pending
+        if not pending and self.cache_path is not None:
+            self.save(self.cache_path)
+
+    def is_complete(self):
+        """True if the whole hierarchy is expanded"""
+        return not self._frontier
+
+    def __len__(self):
+        self._expand()
+        return len(self._by_id)
+
+    def __contains__(self, privid):
+        return self.path(privid) is not None
+
+    def path(self, privid):
+        """Key path of a privid, None if it is not a key of this hierarchy"""
+        privid = bytes(privid)
+        keypath = self._by_id.get(privid)
+        if keypath is None and self._frontier:
+            self._expand()
+            keypath = self._by_id.get(privid)
+        return None if keypath is None else list(keypath)
+
+    def keyspace(self, privid):
+        """Key space a privid may sign with, None if it is not a key of this hierarchy"""
+        keypath = self.path(privid)
+        if keypath is None:
+            return None
+        return self._keyspace[len(keypath) - len(self._root):]
+
+    def privid(self, keypath):
+        """Privid of a key path, None if the path is not in this hierarchy"""
+        keypath = tuple(keypath)
+        privid = self._by_path.get(keypath)
+        if privid is None and self._frontier:
+            self._expand()
+            privid = self._by_path.get(keypath)
+        return privid
+
+    def entries(self):
+        """The fully expanded index as privid hex to key path"""
+        self._expand()
+        return {privid.hex(): list(keypath) for privid, keypath in self._by_id.items()}
+
+    def save(self, path):
+        """Write the fully expanded index to a JSON file"""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmppath = path + ".tmp"
+        with open(tmppath, "w", encoding="utf8") as outfile:
+            json.dump(self.entries(), outfile)
+        os.replace(tmppath, path)
+
+def get_index(path, hierarchy, keyspace, cache_dir=None, eager_depth=2):
+    """Get the privid index for an application config, building it at most once per process
+
+    Parameters
+    ----------
+    path, hierarchy, keyspace
+        As for PrivIdIndex
+    cache_dir : str or None
+        Directory for index cache files, for example KEYINDEX_CACHE; memory only if None
+    eager_depth : int
+        As for PrivIdIndex, for an index that is not cached yet
+
+    Returns
+    -------
+    PrivIdIndex
+        The shared index
+    """
+    digest = config_hash(path, hierarchy, keyspace)
+    index = _INDICES.get(digest)
+    if index is not None:
+        return index
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, digest + ".json")
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, encoding="utf8") as cachefile:
+                    index = PrivIdIndex(path, hierarchy, keyspace, entries=json.load(cachefile))
+            except (OSError, ValueError):
+                index = None
+    if index is None:
+        index = PrivIdIndex(path, hierarchy, keyspace, eager_depth, cache_path)
+    _INDICES[digest] = index
+    return index
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+"""Multi-tenant signing key manager with a memory cap on resident level-key material
+
+Signing keys for many accounts are registered with a KeyManager. Only the keys
+in use are kept resident; when the estimated memory of all resident keys exceeds
+the budget, cold keys are serialized to their on-disk state file and dropped.
+A later request rehydrates them from that state, which skips the OTS chain work
+for all cached level keys. The state file is also written after every
+signature, before the signature is returned, so a crash never loses a used
+index.
+"""
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+_BYTES_OVERHEAD = sys.getsizeof(b"")
+
+def key_footprint(signing_key):
+    """Estimate the resident memory in bytes of a SigningKey's level-key material"""
+    total = 0
+    for level_key in signing_key.level_keys:
+        value_size = _BYTES_OVERHEAD + level_key.hashlen
+        # Private key parts plus their list slots
+        total += len(level_key.privkey) * (value_size + 8)
+        # Flat merkle table, paid once per host if it is shared
+        if not level_key.is_shared():
+            total += level_key.merkle_table.nbytes()
+        # Precomputed chain-value tables
+        total += level_key.pending_tables() * level_key.table_size()
+    return total
+
+
+class _Entry:
+    """Registration and residency state for a single managed key"""
+    # pylint: disable=too-few-public-methods, too-many-instance-attributes
+    def __init__(self, env, wallet, idx, statefile, table_source):
+        # pylint: disable=too-many-arguments
+        self.env = env
+        self.table_source = table_source
+        self.wallet = wallet
+        self.idx = idx
+        self.statefile = statefile
+        self.signing_key = None
+        self.footprint = 0
+        self.pinned = False
+        self.frequency = 0
+        self.users = 0
+        self.lock = threading.Lock()
+
+
+class KeyManager:
+    """Keep many signing keys available while capping resident memory"""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, statedir, memory_budget, policy="lru"):
+        """Constructor
+
+        Parameters
+        ----------
+        statedir : str
+            Directory holding one state file per managed key
+        memory_budget : int
+            Maximum estimated bytes of resident level-key material
+        policy : str
+            "lru" evicts the least recently used key, "lfu" the least frequently
+            used one (ties broken by recency)
+        """
+        if policy not in ("lru", "lfu"):
+            raise ValueError("policy must be 'lru' or 'lfu'")
+        if not os.path.exists(statedir):
+            os.makedirs(statedir)
+        self.statedir = statedir
+        self.memory_budget = memory_budget
+        self.policy = policy
+        self._entries = {}
+        self._resident = OrderedDict()
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0,
+                       "misses": 0,
+                       "evictions": 0,
+                       "rehydrations": 0,
+                       "rehydrate_seconds": 0.0,
+                       "rehydrate_max_seconds": 0.0,
+                       "resident_bytes": 0}
+
+    def register(self, name, env, wallet, idx=0, table_source=None):
+        # pylint: disable=too-many-arguments
+        """Register a key, created lazily with BlockChainEnv.get_signing_key on first use
+
+        A table_source such as shared_table_source(prefix) lets the key attach to merkle
+        tables shared with other processes; shared tables do not count against the budget."""
+        with self._lock:
+            if name in self._entries:
+                raise KeyError("Key already registered: " + name)
+            statefile = os.path.join(self.statedir, name + ".json")
+            self._entries[name] = _Entry(env, wallet, idx, statefile, table_source)
+
+    def pin(self, name):
+        """Keep a key resident regardless of memory pressure"""
+        with self._lock:
+            self._entries[name].pinned = True
+
+    def unpin(self, name):
+        """Make a pinned key evictable again"""
+        with self._lock:
+            self._entries[name].pinned = False
+            self._enforce_budget()
+
+    def _load(self, entry):
+        """Create or rehydrate the SigningKey of an entry"""
+        backup = None
+        idx = entry.idx
+        if os.path.exists(entry.statefile):
+            with open(entry.statefile, encoding="utf8") as statefile:
+                backup = statefile.read()
+        start = time.time()
+        signing_key = entry.env.get_signing_key(entry.wallet, idx=idx, backup=backup,
+                                                table_source=entry.table_source)
+        if backup is not None:
+            elapsed = time.time() - start
+            self._stats["rehydrations"] += 1
+            self._stats["rehydrate_seconds"] += elapsed
+            if elapsed > self._stats["rehydrate_max_seconds"]:
+                self._stats["rehydrate_max_seconds"] = elapsed
+        return signing_key
+
+    def _store(self, entry):
+        """Write the state of a resident key to its state file"""
+        tmpfile = entry.statefile + ".tmp"
+        with open(tmpfile, "w", encoding="utf8") as statefile:
+            statefile.write(entry.signing_key.serialize())
+        os.replace(tmpfile, entry.statefile)
+        entry.idx = entry.signing_key.idx
+
+    def _victim(self):
+        """Pick the next key to evict, None if nothing is evictable"""
+        candidates = [name for name in self._resident
+                      if not self._entries[name].pinned and self._entries[name].users == 0]
+        if not candidates:
+            return None
+        if self.policy == "lfu":
+            return min(candidates, key=lambda name: self._entries[name].frequency)
+        return candidates[0]
+
+    def _enforce_budget(self):
+        while self._stats["resident_bytes"] > self.memory_budget:
+            name = self._victim()
+            if name is None:
+                return
+            self.evict(name)
+
+    def evict(self, name):
+        """Write a resident key to disk and drop its level-key material"""
+        with self._lock:
+            entry = self._entries[name]
+            if entry.signing_key is None:
+                return
+            with entry.lock:
+                self._store(entry)
+                entry.signing_key = None
+            del self._resident[name]
+            self._stats["resident_bytes"] -= entry.footprint
+            self._stats["evictions"] += 1
+            entry.footprint = 0
+
+    def _acquire(self, name):
+        """Get an entry with a resident key, rehydrating if needed"""
+        with self._lock:
+            entry = self._entries[name]
+            entry.frequency += 1
+            entry.users += 1
+            if entry.signing_key is not None:
+                self._stats["hits"] += 1
+                self._resident.move_to_end(name)
+                return entry
+            self._stats["misses"] += 1
+        try:
+            with entry.lock:
+                if entry.signing_key is None:
+                    signing_key = self._load(entry)
+                    entry.signing_key = signing_key
+                    entry.footprint = key_footprint(signing_key)
+                    with self._lock:
+                        self._resident[name] = True
+                        self._stats["resident_bytes"] += entry.footprint
+        except Exception:
+            with self._lock:
+                entry.users -= 1
+            raise
+        return entry
+
+    def _release(self, name):
+        # Precompute and level rollovers change the footprint, measure it again.
+        # Entry lock before manager lock, as in _acquire.
+        entry = self._entries[name]
+        with entry.lock:
+            footprint = 0 if entry.signing_key is None else key_footprint(entry.signing_key)
+        with self._lock:
+            entry.users -= 1
+            if entry.signing_key is not None:
+                self._stats["resident_bytes"] += footprint - entry.footprint
+                entry.footprint = footprint
+            self._enforce_budget()
+
+    def sign_data(self, name, msg, compressed=False):
+        """Sign bytes with a managed key"""
+        entry = self._acquire(name)
+        try:
+            with entry.lock:
+                signature = entry.signing_key.sign_data(msg, compressed)
+                # Never release a signature before the used index is on disk
+                self._store(entry)
+                return signature
+        finally:
+            self._release(name)
+
+    def sign_string(self, name, msg, compressed=False):
+        """Sign a string with a managed key"""
+        entry = self._acquire(name)
+        try:
+            with entry.lock:
+                signature = entry.signing_key.sign_string(msg, compressed)
+                # Never release a signature before the used index is on disk
+                self._store(entry)
+                return signature
+        finally:
+            self._release(name)
+
+    def flush(self):
+        """Write the state of all resident keys to disk"""
+        with self._lock:
+            for name in list(self._resident):
+                entry = self._entries[name]
+                with entry.lock:
+                    self._store(entry)
+
+    def stats(self):
+        """Hit/miss, eviction and rehydration latency counters
+
+        Returns
+        -------
+        dict
+            Copy of the counters
+        """
+        with self._lock:
+            rval = dict(self._stats)
+            rval["resident_keys"] = len(self._resident)
+            return rval
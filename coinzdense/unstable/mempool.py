@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+"""Columnar store of pending signatures for a mempool
+
+Tens of thousands of pending transactions held as _Signature objects cost far
+more than their wire size. SignaturePool keeps the header fields in fixed width
+columns (privid, index, sigcount, message salt and digest) and the signatures
+themselves back to back in one arena with an offset table, so a pending
+signature costs its wire size plus a few dozen bytes. Messages, if given, go in
+a second arena.
+
+Slots are numbered in arrival order. Removed slots are skipped until compact()
+drops them from the arena and renumbers the rest.
+"""
+from array import array
+from coinzdense.unstable.validation import _PRIVID_LEN, _TREE_DIGEST_FLAG, _signature_size
+
+class SignaturePool:
+    """Struct-of-arrays store of pending signatures of one key space"""
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, validator):
+        """Constructor
+
+        Parameters
+        ----------
+        validator : ValidationEnv
+            Validation environment of the key space the signatures were made in
+        """
+        self._validator = validator
+        self._hashlen = validator.hashlen
+        self._sizes = [_signature_size(validator.hashlen, validator.level_hashlen, validator.level_otsbits,
+                                       validator.heights, sigcount, validator.otsmode)
+                       for sigcount in range(0, len(validator.heights) + 1)]
+        self._reset()
+
+    def _reset(self):
+        self._privids = bytearray()
+        self._indices = array("Q")
+        self._sigcounts = bytearray()
+        self._salts = bytearray()
+        self._digests = bytearray()
+        self._live = bytearray()
+        self._offsets = array("Q", [0])
+        self._arena = bytearray()
+        self._message_offsets = array("Q", [0])
+        self._messages = bytearray()
+        # privid to the slots of its pending signatures
+        self._by_privid = {}
+        self._count = 0
+
+    def add(self, signature, message=None):
+        """Add a pending signature
+
+        Parameters
+        ----------
+        signature : bytes-like
+            Serialized signature
+        message : bytes or None
+            Signed data for the message check on validation
+
+        Returns
+        -------
+        int
+            Slot number
+
+        Raises
+        ------
+        ValueError
+            Thrown if the signature size does not match its header
+        """
+        hashlen = self._hashlen
+        if len(signature) <= _PRIVID_LEN:
+            raise ValueError("Invalid signature size")
+        sigcount = signature[_PRIVID_LEN] & ~_TREE_DIGEST_FLAG
+        if sigcount < 1 or sigcount >= len(self._sizes) or len(signature) != self._sizes[sigcount]:
+            raise ValueError("Invalid signature size")
+        slot = len(self._indices)
+        privid = bytes(signature[:_PRIVID_LEN])
+        self._privids += privid
+        self._indices.append(int.from_bytes(signature[_PRIVID_LEN + 1:_PRIVID_LEN + 9], "big"))
+        self._sigcounts.append(signature[_PRIVID_LEN])
+        self._salts += signature[_PRIVID_LEN + 9:_PRIVID_LEN + 9 + hashlen]
+        self._digests += signature[_PRIVID_LEN + 9 + hashlen:_PRIVID_LEN + 9 + 2 * hashlen]
+        self._live.append(1 if message is None else 3)
+        self._arena += signature
+        self._offsets.append(len(self._arena))
+        if message is not None:
+            self._messages += message
+        self._message_offsets.append(len(self._messages))
+        self._by_privid.setdefault(privid, array("I")).append(slot)
+        self._count += 1
+        return slot
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, slot):
+        return 0 <= slot < len(self._live) and bool(self._live[slot])
+
+    def slots(self):
+        """Slots of all pending signatures, in arrival order"""
+        return [slot for slot, live in enumerate(self._live) if live]
+
+    def slots_for(self, privid):
+        """Slots of the pending signatures of a key"""
+        return [slot for slot in self._by_privid.get(bytes(privid), ()) if self._live[slot]]
+
+    def privid(self, slot):
+        return bytes(self._privids[slot * _PRIVID_LEN:(slot + 1) * _PRIVID_LEN])
+
+    def index(self, slot):
+        return self._indices[slot]
+
+    def sigcount(self, slot):
+        return self._sigcounts[slot] & ~_TREE_DIGEST_FLAG
+
+    def salt(self, slot):
+        return bytes(self._salts[slot * self._hashlen:(slot + 1) * self._hashlen])
+
+    def digest(self, slot):
+        return bytes(self._digests[slot * self._hashlen:(slot + 1) * self._hashlen])
+
+    def signature(self, slot):
+        """Copy of a pending signature"""
+        return bytes(self._arena[self._offsets[slot]:self._offsets[slot + 1]])
+
+    def message(self, slot):
+        """Message of a pending signature, None if none was given"""
+        if not self._live[slot] & 2:
+            return None
+        return bytes(self._messages[self._message_offsets[slot]:self._message_offsets[slot + 1]])
+
+    def remove(self, slot):
+        """Drop a pending signature"""
+        if slot in self:
+            self._live[slot] = 0
+            self._count -= 1
+
+    def remove_included(self, privid, index):
+        """Drop the pending signatures of a key up to and including an index, for example after
+        a block included that index
+
+        Returns
+        -------
+        int
+            Number of signatures dropped
+        """
+        dropped = 0
+        for slot in self.slots_for(privid):
+            if self._indices[slot] <= index:
+                self.remove(slot)
+                dropped += 1
+        return dropped
+
+    def validate(self, executor=None, **kwargs):
+        """Hand all pending signatures to ValidationEnv.validate_many as views into the arena
+
+        Extra keyword arguments, for example hash_budget, are passed on.
+
+        Returns
+        -------
+        list of (int, bool or None)
+            Slot and result per pending signature, in arrival order
+        """
+        slots = self.slots()
+        with memoryview(self._arena) as arena:
+            views = [arena[self._offsets[slot]:self._offsets[slot + 1]] for slot in slots]
+            results = self._validator.validate_many(views,
+                                                    [self.message(slot) for slot in slots],
+                                                    executor=executor,
+                                                    **kwargs)
+            for view in views:
+                view.release()
+        return list(zip(slots, results))
+
+    def compact(self):
+        """Drop removed signatures from the columns and arenas
+
+        Returns
+        -------
+        dict
+            Old slot number to new slot number for the signatures kept
+        """
+        old = [(slot, self.signature(slot), self.message(slot)) for slot in self.slots()]
+        self._reset()
+        return {slot: self.add(signature, message) for slot, signature, message in old}
+
+    def nbytes(self):
+        """Bytes held by the columns, offset tables and arenas"""
+        return (len(self._privids) + self._indices.itemsize * len(self._indices) + len(self._sigcounts) +
+                len(self._salts) + len(self._digests) + len(self._live) +
+                self._offsets.itemsize * len(self._offsets) + len(self._arena) +
+                self._message_offsets.itemsize * len(self._message_offsets) + len(self._messages))
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+"""Bounded, sharded, thread-safe cache of signature chain completion results
+
+The same transaction and signature arrive from several peers and are checked
+again at block inclusion. ValidationEnv(result_cache=...) looks up the outcome
+of the OTS chain completion and merkle path checks by a digest of the
+validator parameters and the signature bytes, which include the signed
+digest, so a duplicate costs one hash and one lookup. The index, trust and
+message checks are cheap and still done every time.
+
+Every shard is a least recently used dict behind its own lock, so threads
+sharing a cache mostly do not contend.
+"""
+import threading
+from collections import OrderedDict
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from coinzdense.layerzero.onetime import OTS_DUAL
+
+_KEY_LEN = 16
+
+def result_key(hashlen, level_hashlen, level_otsbits, heights, signature, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """Cache key for a signature validated with the given key structure"""
+    params = bytes([hashlen, len(heights)] + list(heights) + list(level_hashlen) + list(level_otsbits))
+    if otsmode != OTS_DUAL:
+        params += otsmode.encode("utf8")
+    return _nacl1_hash_function(params + bytes(signature),
+                                digest_size=_KEY_LEN,
+                                encoder=_Nacl1RawEncoder)
+
+class ResultCache:
+    """Sharded LRU map of result keys to validation outcomes"""
+    def __init__(self, max_entries=65536, shards=16):
+        """Constructor
+
+        Parameters
+        ----------
+        max_entries : int
+            Upper bound on the number of cached results, over all shards
+        shards : int
+            Number of independently locked shards
+        """
+        if not isinstance(max_entries, int) or not isinstance(shards, int):
+            raise TypeError("max_entries and shards must be integers")
+        if shards < 1 or max_entries < shards:
+            raise ValueError("need at least one shard and one entry per shard")
+        self._limit = max_entries // shards
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(0, shards)]
+        # Per shard hits, misses and evictions, kept under the shard lock
+        self._counters = [[0, 0, 0] for _ in range(0, shards)]
+
+    def _shard(self, key):
+        return key[0] % len(self._shards)
+
+    def get(self, key):
+        """Cached outcome for a result key, None on a miss"""
+        number = self._shard(key)
+        lock, entries = self._shards[number]
+        with lock:
+            value = entries.get(key)
+            if value is None:
+                self._counters[number][1] += 1
+                return None
+            entries.move_to_end(key)
+            self._counters[number][0] += 1
+            return value
+
+    def put(self, key, value):
+        """Store an outcome, evicting the least recently used entry of a full shard"""
+        number = self._shard(key)
+        lock, entries = self._shards[number]
+        with lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            if len(entries) > self._limit:
+                entries.popitem(last=False)
+                self._counters[number][2] += 1
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._shards)
+
+    def clear(self):
+        """Drop all entries, keeping the metrics"""
+        for lock, entries in self._shards:
+            with lock:
+                entries.clear()
+
+    def metrics(self):
+        """Hit, miss and eviction counts, entry count and hit rate"""
+        hits = misses = evictions = 0
+        for (lock, _), counters in zip(self._shards, self._counters):
+            with lock:
+                hits += counters[0]
+                misses += counters[1]
+                evictions += counters[2]
+        lookups = hits + misses
+        return {"hits": hits,
+                "misses": misses,
+                "evictions": evictions,
+                "entries": len(self),
+                "hit_rate": hits / lookups if lookups else 0.0}
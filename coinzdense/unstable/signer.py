@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+"""Local signing service holding coinZdense signing keys for many client processes
+
+A SigningService owns the SigningKey objects in one process and accepts sign
+requests over a Unix domain socket (see coinzdense.unstable.ipc for the framing).
+Concurrent requests for the same key are coalesced into batches that move through
+a three stage pipeline:
+
+* hashing: messages of a batch are hashed in parallel on the executor
+* signing: the batch is signed in index order; with a precompute budget the OTS
+  chain work for upcoming indices runs ahead on the executor
+* persisting: the key state is saved before any signature of the batch is released
+
+The stages of consecutive batches overlap, so persisting batch N runs while batch
+N+1 is being signed and batch N+2 is being hashed.
+"""
+import asyncio
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from libnacl import crypto_kdf_derive_from_key as _nacl2_key_derive
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from coinzdense.unstable.ipc import read_frame, encode_frame, call, STATUS_OK, STATUS_ERROR
+
+OP_SIGN_DATA = 1
+OP_SIGN_STRING = 2
+
+FLAG_COMPRESSED = 1
+
+def _message_digest(hashlen, salt, msg, keyed):
+    """Digest a message the way SigningKey.sign_data (unkeyed) or sign_string (keyed) does"""
+    if keyed:
+        return _nacl1_hash_function(msg,
+                                    digest_size=hashlen,
+                                    key=salt,
+                                    encoder=_Nacl1RawEncoder)
+    return _nacl1_hash_function(msg,
+                                digest_size=hashlen,
+                                encoder=_Nacl1RawEncoder)
+
+def _sign_batch(signing_key, batch):
+    """Sign a hashed batch in index order and snapshot the resulting key state
+
+    Entries whose index no longer matches the key (after an earlier failure) get
+    their salt and digest recalculated for the index actually used."""
+    results = []
+    for idx, salt, digest, compressed, msg, keyed in batch:
+        if isinstance(digest, Exception):
+            results.append(digest)
+            continue
+        try:
+            if signing_key.idx != idx:
+                salt = _nacl2_key_derive(signing_key.hashlen, signing_key.idx, "Signatur", signing_key.key)
+                digest = _message_digest(signing_key.hashlen, salt, msg, keyed)
+            # pylint: disable=protected-access
+            results.append(signing_key._sign_digest(digest, salt, compressed))
+        except Exception as exc:  # pylint: disable=broad-except
+            results.append(exc)
+    return results, signing_key.serialize()
+
+
+class _KeySlot:
+    """Per-key request queue and pipeline state"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, signing_key, persist):
+        self.signing_key = signing_key
+        self.persist = persist
+        self.next_idx = signing_key.idx
+        self.inflight = 0
+        self.requests = None
+        self.signing = None
+        self.persisting = None
+        self.tasks = []
+
+
+class SigningService:
+    """Long running signer for many clients, built on BlockChainEnv.get_signing_key"""
+    def __init__(self, executor=None, max_batch=64, precompute_budget=0):
+        """Constructor
+
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor or None
+            Pool for message hashing and OTS chain precomputation, a thread pool if None
+        max_batch : int
+            Maximum number of requests coalesced into a single batch
+        precompute_budget : int
+            Memory budget in bytes for precomputed chain-value tables per key, 0 to disable
+        """
+        if not isinstance(max_batch, int):
+            raise TypeError("max_batch must be an integer")
+        if max_batch < 1:
+            raise ValueError("max_batch must be positive")
+        self._executor = executor
+        self._own_executor = executor is None
+        if self._own_executor:
+            self._executor = ThreadPoolExecutor()
+        self._sign_executor = ThreadPoolExecutor()
+        self._max_batch = max_batch
+        self._precompute_budget = precompute_budget
+        self._slots = {}
+
+    def add_key(self, name, signing_key, persist=None):
+        """Register a SigningKey under a name
+
+        Parameters
+        ----------
+        name : str
+            Name clients use to address the key
+        signing_key : SigningKey
+            The key, no longer to be used directly by the caller
+        persist : callable or None
+            Called with the serialized key state after every batch, before the
+            signatures of that batch are released
+        """
+        if name in self._slots:
+            raise KeyError("Signing key already registered: " + name)
+        self._slots[name] = _KeySlot(signing_key, persist)
+        if self._precompute_budget:
+            signing_key.precompute(self._executor, memory_budget=self._precompute_budget)
+
+    def add_from_env(self, name, env, wallet, idx=0, backup=None, persist=None):
+        # pylint: disable=too-many-arguments
+        """Create a signing key with BlockChainEnv.get_signing_key and register it"""
+        self.add_key(name, env.get_signing_key(wallet, idx=idx, backup=backup), persist)
+
+    def _start(self, slot):
+        """Start the pipeline tasks for a key on first use"""
+        if slot.requests is None:
+            slot.requests = asyncio.Queue()
+            slot.signing = asyncio.Queue(maxsize=2)
+            slot.persisting = asyncio.Queue(maxsize=2)
+            slot.tasks = [asyncio.ensure_future(self._hash_stage(slot)),
+                          asyncio.ensure_future(self._sign_stage(slot)),
+                          asyncio.ensure_future(self._persist_stage(slot))]
+
+    async def sign(self, name, msg, keyed=False, compressed=False):
+        """Sign a message with a named key
+
+        Parameters
+        ----------
+        name : str
+            Name of the key
+        msg : bytes
+            Data to sign, the latin1 encoding of the string for string signatures
+        keyed : bool
+            Use the salt keyed digest of SigningKey.sign_string instead of sign_data
+        compressed : bool
+            Leave out upper level signatures a validator has already seen
+
+        Returns
+        -------
+        bytes
+            The signature
+        """
+        if name not in self._slots:
+            raise KeyError("No signing key named " + name)
+        slot = self._slots[name]
+        self._start(slot)
+        future = asyncio.get_running_loop().create_future()
+        await slot.requests.put((msg, keyed, compressed, future))
+        return await future
+
+    async def _hash_stage(self, slot):
+        """Coalesce pending requests into batches and hash their messages in parallel"""
+        loop = asyncio.get_running_loop()
+        key = slot.signing_key
+        while True:
+            requests = [await slot.requests.get()]
+            while len(requests) < self._max_batch and not slot.requests.empty():
+                requests.append(slot.requests.get_nowait())
+            batch = []
+            slot.inflight += len(requests)
+            for msg, keyed, compressed, future in requests:
+                idx = slot.next_idx
+                slot.next_idx += 1
+                salt = _nacl2_key_derive(key.hashlen, idx, "Signatur", key.key)
+                batch.append([idx, salt, loop.run_in_executor(self._executor,
+                                                              _message_digest,
+                                                              key.hashlen,
+                                                              salt,
+                                                              msg,
+                                                              keyed),
+                              compressed, msg, keyed, future])
+            for entry in batch:
+                try:
+                    entry[2] = await entry[2]
+                except Exception as exc:  # pylint: disable=broad-except
+                    entry[2] = exc
+            await slot.signing.put(batch)
+
+    async def _sign_stage(self, slot):
+        """Sign hashed batches in index order"""
+        loop = asyncio.get_running_loop()
+        key = slot.signing_key
+        while True:
+            batch = await slot.signing.get()
+            try:
+                results, state = await loop.run_in_executor(self._sign_executor,
+                                                             _sign_batch,
+                                                             key,
+                                                             [entry[:6] for entry in batch])
+            except Exception as exc:  # pylint: disable=broad-except
+                results, state = [exc] * len(batch), None
+            # Indices handed out but not used (failures) shift the indices of later batches.
+            slot.inflight -= len(batch)
+            slot.next_idx = key.idx + slot.inflight
+            if self._precompute_budget:
+                key.precompute(self._executor, memory_budget=self._precompute_budget)
+            await slot.persisting.put((batch, results, state))
+
+    async def _persist_stage(self, slot):
+        """Persist key state, then release the signatures of a batch"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, results, state = await slot.persisting.get()
+            try:
+                if slot.persist is not None and state is not None:
+                    await loop.run_in_executor(self._sign_executor, slot.persist, state)
+            except Exception as exc:  # pylint: disable=broad-except
+                results = [exc] * len(batch)
+            for entry, result in zip(batch, results):
+                if entry[6].done():
+                    continue
+                if isinstance(result, Exception):
+                    entry[6].set_exception(result)
+                else:
+                    entry[6].set_result(result)
+
+    async def _handle(self, reader, writer):
+        """Serve a single client connection, answering pipelined requests in order"""
+        responses = asyncio.Queue()
+
+        async def respond():
+            while True:
+                pending = await responses.get()
+                if pending is None:
+                    return
+                try:
+                    writer.write(encode_frame(STATUS_OK, 0, b"", await pending))
+                except Exception as exc:  # pylint: disable=broad-except
+                    writer.write(encode_frame(STATUS_ERROR, 0, b"", str(exc).encode("utf8")))
+                await writer.drain()
+
+        responder = asyncio.ensure_future(respond())
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                opcode, flags, name, payload = frame
+                if opcode not in (OP_SIGN_DATA, OP_SIGN_STRING):
+                    pending = asyncio.get_running_loop().create_future()
+                    pending.set_exception(ValueError("Unknown opcode"))
+                else:
+                    pending = asyncio.ensure_future(self.sign(name.decode("utf8"),
+                                                              payload,
+                                                              opcode == OP_SIGN_STRING,
+                                                              bool(flags & FLAG_COMPRESSED)))
+                await responses.put(pending)
+        finally:
+            await responses.put(None)
+            await responder
+            writer.close()
+
+    async def serve(self, path):
+        """Start listening on a Unix domain socket
+
+        Returns
+        -------
+        asyncio.AbstractServer
+            The server, use serve_forever() or close() on it
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self._handle, path=path)
+
+    async def close(self):
+        """Stop all key pipelines and the thread pools the service created itself"""
+        for slot in self._slots.values():
+            for task in slot.tasks:
+                task.cancel()
+            if slot.tasks:
+                await asyncio.gather(*slot.tasks, return_exceptions=True)
+            slot.tasks = []
+            slot.requests = None
+        self._sign_executor.shutdown(wait=True)
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+
+class SigningClient:
+    """Thin client for a SigningService key, mirroring SigningKey.sign_data/sign_string"""
+    def __init__(self, path, name):
+        self._name = name.encode("utf8")
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+
+    def sign_data(self, msg, compressed=False):
+        """Sign a bytes using a complete multi-level signature"""
+        if not isinstance(msg, bytes):
+            raise TypeError("msg must be bytes")
+        flags = FLAG_COMPRESSED if compressed else 0
+        return call(self._sock, OP_SIGN_DATA, flags, self._name, msg)
+
+    def sign_string(self, msg, compressed=False):
+        """Sign a string using a complete multi-level signature"""
+        flags = FLAG_COMPRESSED if compressed else 0
+        return call(self._sock, OP_SIGN_STRING, flags, self._name, msg.encode("latin1"))
+
+    def close(self):
+        """Close the connection to the service"""
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,10 +2,14 @@
 """Python module for Simple Post Quantum Signatures
 
 This module provides simple BLAKE2 hash-based based signature using a simple
-design made out of a combination of a merkle tree and dual OTS chains.
+design made out of a combination of a merkle tree and dual OTS chains, or
+single OTS chains plus a checksum in the "wots" OTS mode.
 """
+import os as _os
 import sys
+import threading
 import json as _json
+from concurrent.futures import Future
 from libnacl import crypto_kdf_keygen as _nacl2_keygen
 from libnacl import crypto_kdf_derive_from_key as _nacl2_key_derive
 from libnacl import crypto_kdf_KEYBYTES as _NACL2_KEY_BYTES
@@ -15,46 +19,88 @@ from nacl.encoding import Base32Encoder as _Nacl1Base32Encoder
 from nacl.pwhash.argon2id import kdf as _nacl1_kdf
 from nacl.pwhash.argon2id import SALTBYTES as _NACL1_SALTBYTES
 from nacl.utils import random as _nacl1_random
+from coinzdense.layerzero.stream import stream_digest as _stream_digest
+from coinzdense.layerzero.stream import tree_digest as _tree_digest
+from coinzdense.layerzero.sharedtree import MerkleTable
+from coinzdense.layerzero.onetime import OTS_DUAL, OTS_WINTERNITZ
+from coinzdense.layerzero.onetime import _ots_chains_per_signature, _checksum_values, _check_otsmode
+from coinzdense.unstable.validation import _level_params, _level_digest
+
+# High bit of the sigcount header byte, set when the digest is a BLAKE2b tree-hash
+_TREE_DIGEST_FLAG = 0x80
+
+# Batch envelope, see SigningKey.sign_batch
+_BATCH_MAGIC = b"CZB1"
+_BATCH_NO_PARENT = 0xffff
 
 
 def _ots_pairs_per_signature(hashlen, otsbits):
     return ((hashlen*8-1) // otsbits)+1
 
 
-def _ots_values_per_signature(hashlen, otsbits):
-    return 2 * _ots_pairs_per_signature(hashlen, otsbits)
+def _ots_values_per_signature(hashlen, otsbits, otsmode=OTS_DUAL):
+    return _ots_chains_per_signature(hashlen, otsbits, otsmode)
 
 
-def _to_merkle_tree(pubkey_in, hashlen, salt):
-    mtree = dict()
-    if len(pubkey_in) > 2:
-        mtree["0"] = _to_merkle_tree(pubkey_in[:len(pubkey_in)//2],
-                                     hashlen,
-                                     salt)
-        mtree["1"] = _to_merkle_tree(pubkey_in[len(pubkey_in)//2:],
-                                     hashlen,
-                                     salt)
-        mtree["node"] = _nacl1_hash_function(mtree["0"]["node"] + mtree["1"]["node"],
-                                             digest_size=hashlen,
-                                             key=salt,
-                                             encoder=_Nacl1RawEncoder)
-    else:
-        mtree["0"] = {"node": pubkey_in[0]}
-        mtree["1"] = {"node": pubkey_in[1]}
-        mtree["node"] = _nacl1_hash_function(pubkey_in[0] + pubkey_in[1],
-                                             digest_size=hashlen,
-                                             key=salt,
-                                             encoder=_Nacl1RawEncoder)
-    return mtree
+def _chain_tables(privparts, otsbits, hashlen, salt):
+    """Calculate the full chain-value table for one OTS key.
+
+    For every private key part, the table holds the values after 1 up to 2^otsbits
+    hashing steps, so signing with the table is a matter of picking entries."""
+    table = list()
+    for privpart in privparts:
+        res = privpart
+        for _ in range(0, 1 << otsbits):
+            res = _nacl1_hash_function(res,
+                                       digest_size=hashlen,
+                                       key=salt,
+                                       encoder=_Nacl1RawEncoder)
+            table.append(res)
+    return b"".join(table)
+
+
+def _merkle_bottom(privkey, otsbits, hashlen, height, salt, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """Calculate the one-time pubkeys (merkle tree leaves) of a level key"""
+    vps = _ots_values_per_signature(hashlen, otsbits, otsmode)
+    big_pubkey = list()
+    for privpart in privkey:
+        res = privpart
+        for _ in range(0, 1 << otsbits):
+            res = _nacl1_hash_function(res,
+                                       digest_size=hashlen,
+                                       key=salt,
+                                       encoder=_Nacl1RawEncoder)
+        big_pubkey.append(res)
+    pubkey = list()
+    for idx1 in range(0, 1 << height):
+        pubkey.append(_nacl1_hash_function(
+            b"".join(big_pubkey[idx1*vps:idx1*vps+vps]),
+            digest_size=hashlen,
+            key=salt,
+            encoder=_Nacl1RawEncoder))
+    return pubkey
+
+
+def _level_key_bottom(hashlen, otsbits, height, key, startno, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """Calculate the merkle tree leaves of a level key from scratch, for use on an executor"""
+    salt = _nacl2_key_derive(hashlen, startno, "Signatur", key)
+    vps = _ots_values_per_signature(hashlen, otsbits, otsmode)
+    privkey = [_nacl2_key_derive(hashlen, idx, "Signatur", key)
+               for idx in range(startno + 1, startno + 1 + vps * (1 << height))]
+    return _merkle_bottom(privkey, otsbits, hashlen, height, salt, otsmode)
 
 
 class _LevelKey:
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, hashlen, otsbits, height, key, startno, sig_index, backup):
+    def __init__(self, hashlen, otsbits, height, key, startno, sig_index, backup, merkle_table=None,
+                 otsmode=OTS_DUAL):
         # pylint: disable=too-many-arguments
         self.startno = startno
         self.hashlen = hashlen
         self.otsbits = otsbits
+        self.otsmode = otsmode
         self.height = height
         self.salt = _nacl2_key_derive(hashlen,
                                       startno,
@@ -62,7 +108,8 @@ class _LevelKey:
                                       key)
         self.privkey = list()
         self.vps = _ots_values_per_signature(hashlen,
-                                             otsbits)
+                                             otsbits,
+                                             otsmode)
         self.chop_count = _ots_pairs_per_signature(hashlen,
                                                    otsbits)
         for idx in range(startno + 1,
@@ -78,61 +125,142 @@ class _LevelKey:
             self.backup = dict()
             self.backup["merkle_bottom"] = None
             self.backup["signature"] = None
-        if self.backup["merkle_bottom"] is None:
-            big_pubkey = list()
-            for privpart in self.privkey:
-                res = privpart
-                for _ in range(0, 1 << otsbits):
-                    res = _nacl1_hash_function(res,
-                                               digest_size=hashlen,
-                                               key=self.salt,
-                                               encoder=_Nacl1RawEncoder)
-                big_pubkey.append(res)
-            pubkey = list()
-            for idx1 in range(0, 1 << height):
-                pubkey.append(_nacl1_hash_function(
-                    b"".join(big_pubkey[idx1*self.vps:idx1*self.vps+self.vps]),
-                    digest_size=hashlen,
-                    key=self.salt,
-                    encoder=_Nacl1RawEncoder))
-            self.backup["merkle_bottom"] = pubkey
+        if merkle_table is not None:
+            if merkle_table.hashlen != hashlen or merkle_table.height != height:
+                raise ValueError("Shared merkle table does not match level key params")
+            # Cheap check that the table was built with this level salt
+            if _nacl1_hash_function(merkle_table.leaf(0) + merkle_table.leaf(1),
+                                    digest_size=hashlen,
+                                    key=self.salt,
+                                    encoder=_Nacl1RawEncoder) != merkle_table.node(1 << (height - 1)):
+                raise ValueError("Shared merkle table belongs to a different level key")
+            self.backup["merkle_bottom"] = merkle_table
+        elif isinstance(self.backup["merkle_bottom"], MerkleTable):
+            merkle_table = self.backup["merkle_bottom"]
+        elif self.backup["merkle_bottom"] is None:
+            merkle_table = MerkleTable.build(_merkle_bottom(self.privkey, otsbits, hashlen, height, self.salt,
+                                                            otsmode),
+                                             hashlen,
+                                             self.salt)
         else:
-            pubkey = self.backup["merkle_bottom"]
-        self.merkle_tree = _to_merkle_tree(pubkey,
-                                           hashlen,
-                                           self.salt)
-        self.pubkey = self.merkle_tree["node"]
+            merkle_table = MerkleTable.build(self.backup["merkle_bottom"], hashlen, self.salt)
+        # The backup refers to the flat table, serialization expands it to the leaf list
+        self.backup["merkle_bottom"] = merkle_table
+        self.merkle_table = merkle_table
+        self.pubkey = merkle_table.root()
         self.sig_index = sig_index
-        if self.backup["signature"] is None:
-            self.signature = None
-        else:
-            self.signature = self.backup["signature"]
+        self.signature = self.backup["signature"]
+        if self.signature is None and merkle_table.extra():
+            self.signature = merkle_table.extra()
+            self.backup["signature"] = self.signature
+        self._tables = dict()
+
+    def is_shared(self):
+        """True if the merkle table is attached from shared memory or a mapped file"""
+        return self.merkle_table.is_shared()
+
+    def share(self, name):
+        """Move the merkle table and parent signature into a named shared-memory segment
+
+        Returns
+        -------
+        MerkleTable
+            The published table, unlink() it once no new process needs to attach
+        """
+        shared = self.export_table().publish(name)
+        self.merkle_table.close()
+        self.merkle_table = shared
+        self.backup["merkle_bottom"] = shared
+        return shared
+
+    def export_table(self):
+        """Get a private copy of the merkle table with the parent signature as extra blob"""
+        extra = self.signature if self.signature is not None else b""
+        return MerkleTable.build(self.merkle_table.leaves(), self.hashlen, self.salt, extra)
+
+    def save_table(self, path):
+        """Save the merkle table and parent signature to a file for MerkleTable.open_file"""
+        self.export_table().save(path)
+
+    def table_size(self):
+        """Memory in bytes taken by the precomputed chain-value table of one signature"""
+        return self.vps * (1 << self.otsbits) * self.hashlen
+
+    def announce_tables(self, executor, indices):
+        """Schedule background calculation of chain-value tables for the given signature indices"""
+        for sig_index in indices:
+            if sig_index not in self._tables:
+                self._tables[sig_index] = executor.submit(
+                        _chain_tables,
+                        self.privkey[sig_index * self.vps: (sig_index + 1) * self.vps],
+                        self.otsbits,
+                        self.hashlen,
+                        self.salt)
+
+    def drop_tables(self, below):
+        """Forget precomputed tables for signature indices that are no longer usable"""
+        for sig_index in [idx for idx in self._tables if idx < below]:
+            self._tables.pop(sig_index).cancel()
+
+    def pending_tables(self):
+        """Number of precomputed or scheduled chain-value tables"""
+        return len(self._tables)
+
+    def _take_table(self, sig_index):
+        """Take the precomputed table for a signature index if it is ready, None otherwise"""
+        future = self._tables.get(sig_index)
+        if future is None or not future.done():
+            return None
+        del self._tables[sig_index]
+        if future.cancelled() or future.exception() is not None:
+            return None
+        return future.result()
 
     def get_signed_by_parent(self, parent):
-        """Get signed by level key one leve up"""
-        self.signature = parent.sign(self.pubkey)
-        self.backup["signature"] = self.signature
+        """Get signed by level key one leve up, unless the signature is already known"""
+        if self.signature is None:
+            self.signature = parent.sign(self.pubkey)
+            self.backup["signature"] = self.signature
+
+    def signature_size(self):
+        """Size in bytes of a single signature made with this level key"""
+        return self.hashlen * (1 + self.height + self.vps)
+
+    def _merkle_header_into(self, buffer, offset):
+        """Write the level salt and merkle header for the curent signature into buffer"""
+        hashlen = self.hashlen
+        buffer[offset:offset + hashlen] = self.salt
+        offset += hashlen
+        path = self.merkle_table.auth_path(self.sig_index)
+        buffer[offset:offset + len(path)] = path
+        return offset + len(path)
 
     def merkle_header(self):
         """Calculate the merkle header for the curent signature"""
-        fstring = "0" + str(self.height) + "b"
-        as_binlist = list(
-                format(self.sig_index,
-                       fstring)
-            )
-        header = list()
-        while len(as_binlist) > 0:
-            subtree = self.merkle_tree
-            for idx in as_binlist[:-1]:
-                subtree = subtree[idx]
-            inverse = str(1 - int(as_binlist[-1]))
-            header.append(subtree[inverse]["node"])
-            as_binlist = as_binlist[:-1]
-        return self.salt + b"".join(header)
+        header = bytearray(self.hashlen * (1 + self.height))
+        self._merkle_header_into(header, 0)
+        return bytes(header)
 
-    def sign(self, digest):
-        """Sign for a digest"""
-        signature = self.merkle_header()
+    def sign_into(self, digest, buffer, offset=0):
+        """Sign for a digest, writing the signature into a pre-allocated buffer
+
+        Parameters
+        ----------
+        digest : bytes
+            The digest to sign
+        buffer : bytearray or memoryview
+            Writable buffer with at least signature_size() bytes available at offset
+        offset : int
+            Position in buffer to start writing at
+
+        Returns
+        -------
+        int
+            The offset just past the written signature
+        """
+        hashlen = self.hashlen
+        offset = self._merkle_header_into(buffer, offset)
+        digest = _level_digest(digest, hashlen, self.salt)
         as_bigno = int.from_bytes(digest,
                                   byteorder='big',
                                   signed=True)
@@ -141,7 +269,38 @@ class _LevelKey:
             as_int_list.append(as_bigno % (1 << self.otsbits))
             as_bigno = as_bigno >> self.otsbits
         as_int_list.reverse()
+        if self.otsmode == OTS_WINTERNITZ:
+            as_int_list += _checksum_values(as_int_list, hashlen, self.otsbits)
+        table = self._take_table(self.sig_index)
+        if table is not None:
+            # Online signing: just pick the precomputed chain values
+            steps = 1 << self.otsbits
+            if self.otsmode == OTS_WINTERNITZ:
+                for part, value in enumerate(as_int_list):
+                    start = (part * steps + value) * hashlen
+                    buffer[offset:offset + hashlen] = table[start:start + hashlen]
+                    offset += hashlen
+                return offset
+            for part, value in enumerate(as_int_list):
+                start1 = (2 * part * steps + value) * hashlen
+                start2 = ((2 * part + 2) * steps - value - 1) * hashlen
+                buffer[offset:offset + hashlen] = table[start1:start1 + hashlen]
+                buffer[offset + hashlen:offset + 2 * hashlen] = table[start2:start2 + hashlen]
+                offset += 2 * hashlen
+            return offset
         my_ots_key = self.privkey[self.sig_index * self.vps: (self.sig_index + 1) * self.vps]
+        if self.otsmode == OTS_WINTERNITZ:
+            for value, privpart in zip(as_int_list, my_ots_key):
+                sig = privpart
+                for _ in range(0, value + 1):
+                    sig = _nacl1_hash_function(
+                            sig,
+                            digest_size=hashlen,
+                            key=self.salt,
+                            encoder=_Nacl1RawEncoder)
+                buffer[offset:offset + hashlen] = sig
+                offset += hashlen
+            return offset
         my_sigparts = [
                 [
                     as_int_list[i//2],
@@ -156,29 +315,66 @@ class _LevelKey:
             for _ in range(0, count1):
                 sig1 = _nacl1_hash_function(
                         sig1,
-                        digest_size=self.hashlen,
+                        digest_size=hashlen,
                         key=self.salt,
                         encoder=_Nacl1RawEncoder)
-            signature += sig1
+            buffer[offset:offset + hashlen] = sig1
+            offset += hashlen
             sig2 = sigpart[2]
             for _ in range(0, count2):
                 sig2 = _nacl1_hash_function(
                         sig2,
-                        digest_size=self.hashlen,
+                        digest_size=hashlen,
                         key=self.salt,
                         encoder=_Nacl1RawEncoder)
-            signature += sig2
-        return signature
+            buffer[offset:offset + hashlen] = sig2
+            offset += hashlen
+        return offset
+
+    def sign(self, digest):
+        """Sign for a digest"""
+        signature = bytearray(self.signature_size())
+        self.sign_into(digest, signature)
+        return bytes(signature)
+
+
+class _BufferPool:
+    """Small pool of reusable bytearray buffers, keyed by buffer size"""
+    def __init__(self, max_per_size=8):
+        self._free = dict()
+        self._max_per_size = max_per_size
+        self._lock = threading.Lock()
 
+    def acquire(self, size):
+        """Get a buffer of exactly size bytes, reusing a released one if available"""
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                return free.pop()
+        return bytearray(size)
 
-def _deep_count(hash_len, ots_bits, harr):
+    def release(self, buffer):
+        """Hand a buffer back to the pool for reuse"""
+        with self._lock:
+            free = self._free.setdefault(len(buffer), list())
+            if len(free) < self._max_per_size:
+                free.append(buffer)
+
+
+_BUFFER_POOL = _BufferPool()
+
+
+def _deep_count(hash_lens, ots_bits, harr, otsmode=OTS_DUAL):
+    """Key derivation numbers used by a level key and all keys below it, hash_lens and
+    ots_bits holding the per level values for harr"""
     if len(harr) == 1:
-        return 1 + _ots_values_per_signature(hash_len, ots_bits) * (1 << harr[0])
-    ccount = _deep_count(hash_len, ots_bits, harr[1:])
-    return 1 + (1 << harr[0]) * (_ots_values_per_signature(hash_len, ots_bits) + ccount)
+        return 1 + _ots_values_per_signature(hash_lens[0], ots_bits[0], otsmode) * (1 << harr[0])
+    ccount = _deep_count(hash_lens[1:], ots_bits[1:], harr[1:], otsmode)
+    return 1 + (1 << harr[0]) * (_ots_values_per_signature(hash_lens[0], ots_bits[0], otsmode) + ccount)
 
 
-def _idx_to_list(hash_len, ots_bits, idx, harr, start=None):
+def _idx_to_list(hash_lens, ots_bits, idx, harr, start=None, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
     if start is None:
         start = (1 << sum(harr))
     if len(harr) == 1:
@@ -189,9 +385,9 @@ def _idx_to_list(hash_len, ots_bits, idx, harr, start=None):
     deepersigs = 1 << bits
     lindex = idx // deepersigs
     dindex = idx % deepersigs
-    dstart = start + 1 + _ots_values_per_signature(hash_len, ots_bits) * (1 << harr[0]) + \
-        lindex * _deep_count(hash_len, ots_bits, harr[1:])
-    return [[start, lindex]] + _idx_to_list(hash_len, ots_bits, dindex, harr[1:], dstart)
+    dstart = start + 1 + _ots_values_per_signature(hash_lens[0], ots_bits[0], otsmode) * (1 << harr[0]) + \
+        lindex * _deep_count(hash_lens[1:], ots_bits[1:], harr[1:], otsmode)
+    return [[start, lindex]] + _idx_to_list(hash_lens[1:], ots_bits[1:], dindex, harr[1:], dstart, otsmode)
 
 
 def _jsonable(inp):
@@ -201,6 +397,8 @@ def _jsonable(inp):
         for key, val in inp.items():
             if isinstance(val, (int, float, str, bool, type(None))):
                 output[key] = val
+            elif isinstance(val, MerkleTable):
+                output[key] = [v.hex() for v in val.leaves()]
             elif isinstance(val, (dict, list)):
                 if key == "merkle_bottom":
                     output[key] = [v.hex() for v in val]
@@ -264,26 +462,59 @@ def _dejsonable(inp):
     return output
 
 
+def shared_table_source(prefix):
+    """Table source attaching to merkle tables published with SigningKey.share_tables(prefix)"""
+    def source(startno):
+        try:
+            return MerkleTable.attach(prefix + "-" + str(startno))
+        except FileNotFoundError:
+            return None
+    return source
+
+
+def file_table_source(directory):
+    """Table source memory mapping merkle tables saved with SigningKey.save_tables(directory)"""
+    def source(startno):
+        path = _os.path.join(directory, str(startno) + ".czmt")
+        if not _os.path.exists(path):
+            return None
+        return MerkleTable.open_file(path)
+    return source
+
+
 class SigningKey:
     """Class for creating multi-level-key coinZdense signatures"""
     # pylint: disable=too-many-instance-attributes
     def __init__(self, hashlen, otsbits, keyspace, keypath, keyhierarchy, wallet, idx, idx2,
-                 backup, kdf_offset=0, horizontal_signature=None):
+                 backup, kdf_offset=0, horizontal_signature=None, table_source=None, executor=None,
+                 otsmode=OTS_DUAL):
         # pylint: disable=too-many-locals, too-many-arguments, too-many-branches
+        _check_otsmode(otsmode)
         self.hashlen = hashlen
         self.otsbits = otsbits
+        self.otsmode = otsmode
         self.heights = keyspace[0]["heights"]
-        reserve = keyspace[0]["reserve"]
+        # Per level hashlen and otsbits, top level first; hashlen is also the message digest size
+        self.level_hashlen, self.level_otsbits = _level_params(hashlen, otsbits, keyspace[0])
+        reserve = keyspace[0].get("reserve", None)
         self.keyspace = keyspace[1:]
         self.hierarchy = keyhierarchy
         self.keypath = keypath
-        self.max_idx1 = (1 << sum(self.heights)) - (1 << reserve) - 1
-        self.max_idx2 = (1 << reserve) - 1
+        if reserve is None:
+            # The last keyspace level has no reserved signatures for sub-keys
+            self.max_idx1 = (1 << sum(self.heights)) - 1
+            self.max_idx2 = -1
+        else:
+            self.max_idx1 = (1 << sum(self.heights)) - (1 << reserve) - 1
+            self.max_idx2 = (1 << reserve) - 1
         self.backup = None
+        self.table_source = table_source
         self.horizontal_signature=horizontal_signature
         self.kdf_offset = kdf_offset
         if backup is not None:
             self.backup = _dejsonable(_json.loads(backup))
+            # JSON turns the integer key_cache keys into strings
+            self.backup["key_cache"] = {int(key): val for key, val in self.backup["key_cache"].items()}
         self.idx = idx
         self.idx2 = idx2
         self.key = wallet.key
@@ -293,7 +524,10 @@ class SigningKey:
             self.backup = dict()
             self.backup["hashlen"] = hashlen
             self.backup["otsbits"] = otsbits
+            self.backup["otsmode"] = otsmode
             self.backup["heights"] = self.heights
+            self.backup["level_hashlen"] = self.level_hashlen
+            self.backup["level_otsbits"] = self.level_otsbits
             self.backup["idx"] = idx
             self.backup["seedhash"] = _nacl1_hash_function(self.key,
                                                            digest_size=hashlen,
@@ -303,7 +537,10 @@ class SigningKey:
                 self.backup["salt"] = salt.hex()
         if self.backup["hashlen"] != hashlen or \
            self.backup["otsbits"] != otsbits or \
-           self.backup["heights"] != self.heights:
+           self.backup.get("otsmode", OTS_DUAL) != otsmode or \
+           self.backup["heights"] != self.heights or \
+           self.backup.get("level_hashlen", [hashlen] * len(self.heights)) != self.level_hashlen or \
+           self.backup.get("level_otsbits", [otsbits] * len(self.heights)) != self.level_otsbits:
             raise RuntimeError("Mismatch of key-structure params and backup")
         if self.backup["seedhash"] != _nacl1_hash_function(
                 self.key,
@@ -314,7 +551,7 @@ class SigningKey:
             raise RuntimeError("Backup has a higher index number than blockchain")
         if self.backup["idx"] < idx and one_client:
             raise RuntimeError("Another client may be using a copy of your signing key")
-        init_list = _idx_to_list(hashlen, otsbits, idx, self.heights)
+        init_list = _idx_to_list(self.level_hashlen, self.level_otsbits, idx, self.heights, otsmode=otsmode)
         drop = set()
         for key in self.backup["key_cache"].keys():
             if key not in {val[0] for val in init_list}:
@@ -325,81 +562,244 @@ class SigningKey:
             if key not in self.backup["key_cache"].keys():
                 self.backup["key_cache"][key] = None
         restore_info = [self.backup["key_cache"][val[0]] for val in init_list]
-        self.level_keys = list()
+        self.level_keys = [None] * len(init_list)
+        self._ready = Future()
+        if executor is None:
+            self._finish_level_keys(init_list, restore_info, [None] * len(init_list))
+            return
+        # Level keys are independent until the parent-signs-child step, so calculate all
+        # missing merkle trees concurrently and finish construction once they are done.
+        bottoms = list()
         for index, init_vals in enumerate(init_list):
-            self.level_keys.append(
-                    _LevelKey(
-                        hashlen,
-                        otsbits,
+            if restore_info[index] is None or restore_info[index]["merkle_bottom"] is None:
+                bottoms.append(executor.submit(_level_key_bottom,
+                                               self.level_hashlen[index],
+                                               self.level_otsbits[index],
+                                               self.heights[index],
+                                               self.key,
+                                               init_vals[0],
+                                               self.otsmode))
+            else:
+                bottoms.append(None)
+        pending = [future for future in bottoms if future is not None]
+        if not pending:
+            self._finish_level_keys(init_list, restore_info, bottoms)
+            return
+        remaining = [len(pending)]
+        lock = threading.Lock()
+
+        def level_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            self._finish_level_keys(init_list, restore_info, bottoms)
+
+        for future in pending:
+            future.add_done_callback(level_done)
+
+    def _finish_level_keys(self, init_list, restore_info, bottoms):
+        """Create the level keys, let parents sign children and mark the key ready
+
+        bottoms holds, per level, None or a future for merkle tree leaves calculated
+        on an executor."""
+        try:
+            for index, init_vals in enumerate(init_list):
+                table = self._attach_table(init_vals[0])
+                backup = restore_info[index]
+                if bottoms[index] is not None and table is None:
+                    backup = {"merkle_bottom": bottoms[index].result(),
+                              "signature": None if backup is None else backup["signature"]}
+                self.level_keys[index] = _LevelKey(
+                        self.level_hashlen[index],
+                        self.level_otsbits[index],
                         self.heights[index],
                         self.key,
                         init_vals[0],
                         init_vals[1],
-                        restore_info[index]
+                        backup,
+                        table,
+                        self.otsmode
                     )
-                )
-            if index > 0:
-                self.level_keys[index].get_signed_by_parent(self.level_keys[index-1])
-            self.backup["key_cache"][init_vals[0]] = self.level_keys[index].backup
+                if index > 0:
+                    self.level_keys[index].get_signed_by_parent(self.level_keys[index-1])
+                self.backup["key_cache"][init_vals[0]] = self.level_keys[index].backup
+        except Exception as exc:  # pylint: disable=broad-except
+            self._ready.set_exception(exc)
+        else:
+            self._ready.set_result(self)
+
+    def ready(self):
+        """Future that completes with this SigningKey once all level keys are available
+
+        Without an executor the key is ready when the constructor returns. Use
+        asyncio.wrap_future to await it from a coroutine."""
+        return self._ready
+
+    def _wait_ready(self):
+        """Block until the level keys are available, raising construction errors"""
+        self._ready.result()
+
+    def _attach_table(self, startno):
+        """Get a shared merkle table for a level key from the table source, if any"""
+        if self.table_source is None:
+            return None
+        return self.table_source(startno)
+
+    def share_tables(self, prefix):
+        """Move the merkle tables of all level keys into named shared-memory segments
+
+        Other processes signing under the same account attach to the segments by
+        passing shared_table_source(prefix) as table_source.
+
+        Returns
+        -------
+        list of MerkleTable
+            The newly published tables; unlink() them once no new process needs to attach
+        """
+        self._wait_ready()
+        published = list()
+        for level_key in self.level_keys:
+            if not level_key.is_shared():
+                published.append(level_key.share(prefix + "-" + str(level_key.startno)))
+        return published
+
+    def save_tables(self, directory):
+        """Save the merkle tables of all level keys for use with file_table_source(directory)"""
+        self._wait_ready()
+        for level_key in self.level_keys:
+            level_key.save_table(_os.path.join(directory, str(level_key.startno) + ".czmt"))
+
+    def export_tables(self):
+        """Get (startno, MerkleTable) pairs for all current level keys, parent signatures included"""
+        self._wait_ready()
+        return [(level_key.startno, level_key.export_table()) for level_key in self.level_keys]
 
     def _increment_index(self):
         new_idx = self.idx + 1
         if new_idx <= self.max_idx1:
-            init_list = _idx_to_list(self.hashlen,
-                                     self.otsbits,
+            init_list = _idx_to_list(self.level_hashlen,
+                                     self.level_otsbits,
                                      new_idx,
-                                     self.heights)
+                                     self.heights,
+                                     otsmode=self.otsmode)
             for index, vals in enumerate(init_list):
                 if self.level_keys[index].startno != vals[0]:
+                    old_startno = self.level_keys[index].startno
                     self.level_keys[index] = _LevelKey(
-                            self.hashlen,
-                            self.otsbits,
+                            self.level_hashlen[index],
+                            self.level_otsbits[index],
                             self.heights[index],
                             self.key,
                             vals[0],
                             vals[1],
-                            None)
+                            None,
+                            self._attach_table(vals[0]),
+                            self.otsmode)
                     if index > 0:
                         self.level_keys[index].get_signed_by_parent(self.level_keys[index - 1])
                     self.backup["key_cache"][vals[0]] = self.level_keys[index].backup
-                    del self.backup["key_cache"][self.level_keys[index].startno]
+                    del self.backup["key_cache"][old_startno]
                 else:
                     self.level_keys[index].sig_index = vals[1]
         self.idx = new_idx
         self.backup["idx"] = new_idx
 
-    def _sign_digest(self, digest, salt, compressed):
-        """Sign a digest using a complete multi-level signature"""
-        if self.idx > self.max_idx1:
-            raise RuntimeError("SigningKey exhausted")
-        rval = self.privid
+    def precompute(self, executor, count=None, memory_budget=1 << 26):
+        """Precompute chain-value tables for upcoming signatures in the background
+
+        Offline part of offline/online signing: the tables for the next count signature
+        indices of the current lowest level key are calculated on executor, bounded by
+        memory_budget. Signing with a ready table only selects table entries.
+
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor
+            Thread or process pool to calculate the tables on
+        count : int or None
+            Number of upcoming signatures to precompute, as many as fit the budget if None
+        memory_budget : int
+            Maximum number of bytes of tables to hold at once
+
+        Returns
+        -------
+        int
+            Number of signatures that have a precomputed or scheduled table
+        """
+        self._wait_ready()
+        bottom = self.level_keys[-1]
+        bottom.drop_tables(bottom.sig_index)
+        fits = memory_budget // bottom.table_size()
+        if count is None or count > fits:
+            count = fits
+        last = min(1 << bottom.height, bottom.sig_index + count)
+        bottom.announce_tables(executor, range(bottom.sig_index, last))
+        return bottom.pending_tables()
+
+    def _sigcount(self, compressed):
+        """Number of level signatures that the next signature will hold"""
         sigcount = 1
-        done = False
         for level_key in reversed(self.level_keys[1:]):
-            if not done:
-                if level_key.sig_index != 0 and compressed:
-                    done = True
-                else:
-                    sigcount += 1
-        rval += sigcount.to_bytes(1,'big')
-        rval += self.idx.to_bytes(8, 'big')
-        rval += salt
-        rval += digest
+            if level_key.sig_index != 0 and compressed:
+                break
+            sigcount += 1
+        return sigcount
+
+    def signature_size(self, compressed=False):
+        """Exact size in bytes of the next signature made with this key"""
+        self._wait_ready()
+        sigcount = self._sigcount(compressed)
+        size = len(self.privid) + 1 + 8 + 2 * self.hashlen + 8
+        for level_key in self.level_keys:
+            size += len(level_key.pubkey)
+        size += self.level_keys[-1].signature_size()
+        for level_key in list(reversed(self.level_keys[1:]))[:sigcount - 1]:
+            size += len(level_key.signature)
+        return size
+
+    def _sign_digest_into(self, digest, salt, compressed, buffer, offset, digest_flags=0):
+        """Sign a digest using a complete multi-level signature, writing into buffer"""
+        # pylint: disable=too-many-arguments
+        self._wait_ready()
+        if self.idx > self.max_idx1:
+            raise RuntimeError("SigningKey exhausted")
+        size = self.signature_size(compressed)
+        buffer = memoryview(buffer)
+        if buffer.readonly:
+            raise TypeError("buffer must be writable")
+        if offset < 0 or offset + size > len(buffer):
+            raise ValueError("buffer too small for signature")
+        sigcount = self._sigcount(compressed)
+        bin_idx = self.idx.to_bytes(8, 'big')
+        for part in [self.privid, (sigcount | digest_flags).to_bytes(1,'big'), bin_idx, salt, digest]:
+            buffer[offset:offset + len(part)] = part
+            offset += len(part)
         for level_key in reversed(self.level_keys):
-            rval += level_key.pubkey
-        rval += self.idx.to_bytes(8, 'big')
-        rval += self.level_keys[-1].sign(digest)
-        done = False
-        for level_key in reversed(self.level_keys[1:]):
-            if not done:
-                rval += level_key.signature
-                if level_key.sig_index != 0 and compressed:
-                    done = True
+            buffer[offset:offset + len(level_key.pubkey)] = level_key.pubkey
+            offset += len(level_key.pubkey)
+        buffer[offset:offset + 8] = bin_idx
+        offset += 8
+        offset = self.level_keys[-1].sign_into(digest, buffer, offset)
+        for level_key in list(reversed(self.level_keys[1:]))[:sigcount - 1]:
+            buffer[offset:offset + len(level_key.signature)] = level_key.signature
+            offset += len(level_key.signature)
         self._increment_index()
-        return rval
+        return size
 
-    def sign_string(self, msg, compressed=False):
-        """Sign a string using a complete multi-level signature"""
+    def _sign_digest(self, digest, salt, compressed, digest_flags=0):
+        """Sign a digest using a complete multi-level signature"""
+        self._wait_ready()
+        if self.idx > self.max_idx1:
+            raise RuntimeError("SigningKey exhausted")
+        buffer = _BUFFER_POOL.acquire(self.signature_size(compressed))
+        try:
+            self._sign_digest_into(digest, salt, compressed, buffer, 0, digest_flags)
+            return bytes(buffer)
+        finally:
+            _BUFFER_POOL.release(buffer)
+
+    def _string_digest(self, msg):
+        """Salt and digest for signing a string"""
         salt = _nacl2_key_derive(self.hashlen,
                                  self.idx,
                                  "Signatur",
@@ -408,10 +808,10 @@ class SigningKey:
                                       digest_size=self.hashlen,
                                       key=salt,
                                       encoder=_Nacl1RawEncoder)
-        return self._sign_digest(digest, salt, compressed)
+        return salt, digest
 
-    def sign_data(self, msg, compressed=False):
-        """Sign a bytes using a complete multi-level signature"""
+    def _data_digest(self, msg):
+        """Salt and digest for signing bytes"""
         salt = _nacl2_key_derive(self.hashlen,
                                  self.idx,
                                  "Signatur",
@@ -419,11 +819,188 @@ class SigningKey:
         digest = _nacl1_hash_function(msg,
                                       digest_size=self.hashlen,
                                       encoder=_Nacl1RawEncoder)
+        return salt, digest
+
+    def sign_string(self, msg, compressed=False):
+        """Sign a string using a complete multi-level signature"""
+        salt, digest = self._string_digest(msg)
+        return self._sign_digest(digest, salt, compressed)
+
+    def sign_data(self, msg, compressed=False):
+        """Sign a bytes using a complete multi-level signature"""
+        salt, digest = self._data_digest(msg)
         return self._sign_digest(digest,
                                  salt,
                                  compressed)
 
+    def sign_stream(self, source, compressed=False):
+        """Sign a streamed payload using a complete multi-level signature
+
+        Parameters
+        ----------
+        source : str, os.PathLike, file object, bytes-like or iterable of bytes-like
+            Path (memory mapped), file object or iterable of chunks of the data to sign
+        compressed : bool
+            Leave out upper level signatures a validator has already seen
+
+        Returns
+        -------
+        bytes
+            The signature, identical to sign_data on the concatenated payload
+        """
+        salt = _nacl2_key_derive(self.hashlen,
+                                 self.idx,
+                                 "Signatur",
+                                 self.key)
+        digest = _stream_digest(source, self.hashlen)
+        return self._sign_digest(digest,
+                                 salt,
+                                 compressed)
+
+    def sign_tree(self, path, compressed=False, executor=None):
+        """Sign a (multi-GB) file using a parallel BLAKE2b tree-hash digest
+
+        The leaves of the tree hash are hashed on executor over a memory map of
+        the file. The signature is flagged as tree-hash signature so validators
+        know to use the same digest mode.
+
+        Parameters
+        ----------
+        path : str or os.PathLike
+            The file to sign
+        compressed : bool
+            Leave out upper level signatures a validator has already seen
+        executor : concurrent.futures.Executor or None
+            Thread or process pool for hashing the leaves, sequential if None
+
+        Returns
+        -------
+        bytes
+            The signature
+        """
+        salt = _nacl2_key_derive(self.hashlen,
+                                 self.idx,
+                                 "Signatur",
+                                 self.key)
+        digest = _tree_digest(path, self.hashlen, executor=executor)
+        return self._sign_digest(digest,
+                                 salt,
+                                 compressed,
+                                 _TREE_DIGEST_FLAG)
+
+    def sign_batch(self, msgs):
+        """Sign a batch of messages into a single batch envelope
+
+        Level pubkeys and parent level signatures shared by the signatures in the
+        batch are written only once, each transaction only carries its own bottom
+        level signature. ValidationEnv.batch expands the envelope again into full
+        signatures identical to those of sign_data and sign_string.
+
+        Envelope layout::
+
+            magic "CZB1" | privid | level count (1) | key count (2) | tx count (4) |
+            keys: level (1) | parent key ref (2) | pubkey | signature by parent |
+            txs:  flags (1) | idx (8) | key ref (2) | salt | digest | bottom level signature
+
+        The top level key has parent ref 0xffff and no parent signature.
+
+        Parameters
+        ----------
+        msgs : list of bytes or str
+            Messages to sign, bytes as with sign_data, str as with sign_string
+
+        Returns
+        -------
+        bytes
+            The batch envelope
+        """
+        self._wait_ready()
+        if len(msgs) >= 1 << 32:
+            raise ValueError("Too many messages for a single batch envelope")
+        keys = list()
+        key_refs = dict()
+        txs = list()
+        for msg in msgs:
+            if self.idx > self.max_idx1:
+                raise RuntimeError("SigningKey exhausted")
+            if isinstance(msg, str):
+                salt, digest = self._string_digest(msg)
+            elif isinstance(msg, (bytes, bytearray, memoryview)):
+                salt, digest = self._data_digest(bytes(msg))
+            else:
+                raise TypeError("msgs must hold bytes or str")
+            parent_ref = _BATCH_NO_PARENT
+            for level, level_key in enumerate(self.level_keys):
+                ref = key_refs.get((level, level_key.startno))
+                if ref is None:
+                    ref = len(keys)
+                    if ref >= _BATCH_NO_PARENT:
+                        raise ValueError("Too many level keys for a single batch envelope")
+                    key_refs[(level, level_key.startno)] = ref
+                    keys.append(level.to_bytes(1, 'big') +
+                                parent_ref.to_bytes(2, 'big') +
+                                level_key.pubkey +
+                                (level_key.signature if level > 0 else b""))
+                parent_ref = ref
+            txs.append(b"\x00" +
+                       self.idx.to_bytes(8, 'big') +
+                       parent_ref.to_bytes(2, 'big') +
+                       salt +
+                       digest +
+                       self.level_keys[-1].sign(digest))
+            self._increment_index()
+        return b"".join([_BATCH_MAGIC,
+                         self.privid,
+                         len(self.level_keys).to_bytes(1, 'big'),
+                         len(keys).to_bytes(2, 'big'),
+                         len(txs).to_bytes(4, 'big')] + keys + txs)
+
+    def sign_string_into(self, buffer, msg, compressed=False, offset=0):
+        """Sign a string, writing the signature into a caller supplied buffer
+
+        Parameters
+        ----------
+        buffer : bytearray or memoryview
+            Writable buffer with at least signature_size(compressed) bytes available at offset
+        msg : str
+            The string to sign
+        compressed : bool
+            Leave out upper level signatures a validator has already seen
+        offset : int
+            Position in buffer to start writing at
+
+        Returns
+        -------
+        int
+            Number of bytes written
+        """
+        salt, digest = self._string_digest(msg)
+        return self._sign_digest_into(digest, salt, compressed, buffer, offset)
+
+    def sign_data_into(self, buffer, msg, compressed=False, offset=0):
+        """Sign bytes, writing the signature into a caller supplied buffer
+
+        Parameters
+        ----------
+        buffer : bytearray or memoryview
+            Writable buffer with at least signature_size(compressed) bytes available at offset
+        msg : bytes
+            The data to sign
+        compressed : bool
+            Leave out upper level signatures a validator has already seen
+        offset : int
+            Position in buffer to start writing at
+
+        Returns
+        -------
+        int
+            Number of bytes written
+        """
+        salt, digest = self._data_digest(msg)
+        return self._sign_digest_into(digest, salt, compressed, buffer, offset)
+
     def serialize(self):
         """Serialize signing key state to a JSON string"""
+        self._wait_ready()
         return _json.dumps(_jsonable(self.backup),
                            indent=1)
@@ -1,66 +1,658 @@
 #!/usr/bin/python
+import os
 from nacl.hash import blake2b as _nacl1_hash_function
 from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from coinzdense.layerzero.stream import stream_digest as _stream_digest
+from coinzdense.layerzero.stream import tree_digest as _tree_digest
+from coinzdense.unstable.keyindex import get_index as _get_keyindex
+from coinzdense.unstable.indexstore import NEW, REPLAY, STALE, account_id as _account_id
+from coinzdense.layerzero.onetime import OTS_DUAL, OTS_WINTERNITZ
+from coinzdense.layerzero.onetime import _ots_chains_per_signature, _checksum_values, _check_otsmode
+from coinzdense.unstable.resultcache import result_key as _result_key
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
+_PRIVID_LEN = 24
+# High bit of the sigcount header byte, set when the digest is a BLAKE2b tree-hash
+_TREE_DIGEST_FLAG = 0x80
+# Batch envelope, see SigningKey.sign_batch
+_BATCH_MAGIC = b"CZB1"
+_BATCH_NO_PARENT = 0xffff
+
+def _level_params(hashlen, otsbits, keyspace_entry):
+    """Per level hashlen and otsbits lists of a key space entry, top level first
+
+    An entry may override the application wide hashlen and otsbits with a single
+    number or with a list holding a number for every level in heights."""
+    levels = len(keyspace_entry["heights"])
+    rval = []
+    for name, default in (("hashlen", hashlen), ("otsbits", otsbits)):
+        value = keyspace_entry.get(name, default)
+        rval.append([value] * levels if isinstance(value, int) else list(value))
+    return rval[0], rval[1]
+
+def _level_signature_size(hashlen, otsbits, height, otsmode=OTS_DUAL):
+    """Size of a single level key signature: level salt, merkle header and OTS chain values"""
+    vps = _ots_chains_per_signature(hashlen, otsbits, otsmode)
+    return hashlen * (1 + height + vps)
+
+def _signature_size(hashlen, level_hashlen, level_otsbits, heights, sigcount, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """Size of a signature with sigcount level signatures, hashlen being the message digest size"""
+    header_len = _PRIVID_LEN + 9 + 2 * hashlen + sum(level_hashlen) + 8
+    return header_len + sum(_level_signature_size(level_hashlen[level], level_otsbits[level], heights[level], otsmode)
+                            for level in list(reversed(range(0, len(heights))))[:sigcount])
+
+def _hash(data, hashlen, salt):
+    return _nacl1_hash_function(data,
+                                digest_size=hashlen,
+                                key=salt,
+                                encoder=_Nacl1RawEncoder)
+
+def _level_digest(digest, hashlen, salt):
+    """The digest a level key signs: as is if hashlen long, else rehashed with the level salt
+
+    Levels with a different hashlen than the message digest or the level key below
+    sign a hashlen sized hash of it."""
+    if len(digest) == hashlen:
+        return digest
+    return _hash(bytes(digest), hashlen, salt)
+
+def _digest_chunks(digests, hashlen, otsbits, otsmode=OTS_DUAL):
+    """Split digests into the otsbits sized values SigningKey signs, most significant first
+
+    The digest is taken as a signed big-endian number, so the extra high bits of the
+    first value are sign extension. Whole batches are decomposed in one go with NumPy
+    if it is installed. In the wots OTS mode the checksum values follow."""
+    rval = _split_digests(digests, hashlen, otsbits)
+    if otsmode == OTS_WINTERNITZ:
+        return [values + _checksum_values(values, hashlen, otsbits) for values in rval]
+    return rval
+
+def _split_digests(digests, hashlen, otsbits):
+    chop_count = ((hashlen * 8 - 1) // otsbits) + 1
+    if _numpy is None or not digests:
+        rval = []
+        for digest in digests:
+            as_bigno = int.from_bytes(digest, byteorder='big', signed=True)
+            as_int_list = []
+            for _ in range(0, chop_count):
+                as_int_list.append(as_bigno % (1 << otsbits))
+                as_bigno = as_bigno >> otsbits
+            as_int_list.reverse()
+            rval.append(as_int_list)
+        return rval
+    raw = _numpy.frombuffer(b"".join(digests), dtype=_numpy.uint8).reshape(len(digests), hashlen)
+    bits = _numpy.unpackbits(raw, axis=1)
+    pad = chop_count * otsbits - hashlen * 8
+    if pad:
+        bits = _numpy.concatenate([_numpy.repeat(bits[:, :1], pad, axis=1), bits], axis=1)
+    weights = _numpy.left_shift(1, _numpy.arange(otsbits - 1, -1, -1, dtype=_numpy.int64))
+    return (bits.reshape(len(digests), chop_count, otsbits).astype(_numpy.int64) @ weights).tolist()
+
+def _level_root(hashlen, otsbits, height, position, levelsig, values, otsmode=OTS_DUAL):
+    # pylint: disable=too-many-arguments
+    """Complete the OTS chains of a level signature and walk the merkle path up to the level pubkey
+
+    levelsig may be a memoryview, only the hashlen sized parts are copied."""
+    salt = bytes(levelsig[:hashlen])
+    chains = levelsig[hashlen * (1 + height):]
+    steps = 1 << otsbits
+    ends = []
+    for part, value in enumerate(values):
+        if otsmode == OTS_WINTERNITZ:
+            chain = bytes(chains[part * hashlen:(part + 1) * hashlen])
+            for _ in range(0, steps - value - 1):
+                chain = _hash(chain, hashlen, salt)
+            ends.append(chain)
+            continue
+        upchain = bytes(chains[2 * part * hashlen:(2 * part + 1) * hashlen])
+        for _ in range(0, steps - value - 1):
+            upchain = _hash(upchain, hashlen, salt)
+        downchain = bytes(chains[(2 * part + 1) * hashlen:(2 * part + 2) * hashlen])
+        for _ in range(0, value):
+            downchain = _hash(downchain, hashlen, salt)
+        ends.append(upchain)
+        ends.append(downchain)
+    node = _hash(b"".join(ends), hashlen, salt)
+    for level in range(0, height):
+        sibling = bytes(levelsig[hashlen * (1 + level):hashlen * (2 + level)])
+        if position & 1:
+            node = _hash(sibling + node, hashlen, salt)
+        else:
+            node = _hash(node + sibling, hashlen, salt)
+        position >>= 1
+    return node
+
+def _level_roots(jobs, otsmode=OTS_DUAL):
+    """Reconstruct level pubkeys for a shard of (hashlen, otsbits, height, position, level signature,
+    values) jobs"""
+    return [_level_root(*job, otsmode) for job in jobs]
+
+def _job_values(jobs, otsmode=OTS_DUAL):
+    """Digest chunks of (hashlen, otsbits, height, position, level signature, digest) jobs,
+    split in one go for all jobs with the same hashlen and otsbits"""
+    groups = {}
+    for number, job in enumerate(jobs):
+        groups.setdefault((job[0], job[1]), []).append(number)
+    rval = [None] * len(jobs)
+    for (hashlen, otsbits), numbers in groups.items():
+        chunks = _digest_chunks([jobs[number][5] for number in numbers], hashlen, otsbits, otsmode)
+        for number, values in zip(numbers, chunks):
+            rval[number] = values
+    return rval
+
+def _message_digest(signature, message, executor=None):
+    """Digest of a message the way SigningKey signed it: bytes as sign_data, str as
+    sign_string, a path for tree-hash flagged signatures, its leaves hashed on executor.
+    None, matching no digest, for a tree-hash flagged signature with a message that is
+    not a path."""
+    if signature.tree_digest:
+        if not isinstance(message, (str, os.PathLike)):
+            return None
+        return _tree_digest(message, signature.hashlen, executor=executor)
+    if isinstance(message, str):
+        return _hash(message.encode("latin1"), signature.hashlen, signature.msgsalt)
+    return _nacl1_hash_function(bytes(message),
+                                digest_size=signature.hashlen,
+                                encoder=_Nacl1RawEncoder)
 
 class _Signature:
-    def __init__(self, hashlen, otsbits, heights, signature):
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, hashlen, level_hashlen, level_otsbits, heights, signature, env=None, otsmode=OTS_DUAL):
+        # pylint: disable=too-many-arguments, too-many-locals
         self.hashlen = hashlen
-        self.otsbits = otsbits
+        self.level_hashlen = level_hashlen
+        self.level_otsbits = level_otsbits
+        self.otsmode = otsmode
         self.heights = heights
         self.signature = signature
+        # Trusted pubkeys, key index, index store and result cache of the ValidationEnv, if any
+        self.trusted = None if env is None else env.trusted
+        self.keyindex = None if env is None else env.keyindex
+        self.index_store = None if env is None else env.index_store
+        self.result_cache = None if env is None else env.result_cache
+        self.index_status = None
         self.pubkeys = []
         self.pubkey = None
-        header_len = 9 + hashlen * (3 + len(heights))
-        if len(signature) > header_len:
-            self.privhash = signature[:hashlen]
-            self.sigcount = int.from_bytes(signature[hashlen:hashlen+1],"big")
-            self.sigindex = int.from_bytes(signature[hashlen+1:hashlen+9],"big")
-            self.msgsalt = signature[hashlen+9:2*hashlen+9]
-            self.msgdigest = signature[2*hashlen+9: 3*hashlen+9]
-            pubkeys = signature[3*hashlen+9:header_len]
-            self.pubkeys = [pubkeys[i:i+hashlen] for i in range(0,len(pubkeys),hashlen)]
-            ## Fixme: rest of signature
+        offset = _PRIVID_LEN + 9
+        header_len = offset + 2 * hashlen + sum(level_hashlen)
+        if len(signature) > header_len + 8:
+            self.privhash = bytes(signature[:_PRIVID_LEN])
+            sigcount = int.from_bytes(signature[_PRIVID_LEN:_PRIVID_LEN+1],"big")
+            self.sigcount = sigcount & ~_TREE_DIGEST_FLAG
+            self.tree_digest = bool(sigcount & _TREE_DIGEST_FLAG)
+            self.sigindex = int.from_bytes(signature[_PRIVID_LEN+1:offset],"big")
+            self.msgsalt = bytes(signature[offset:offset+hashlen])
+            self.msgdigest = bytes(signature[offset+hashlen:offset+2*hashlen])
+            # Level pubkeys, bottom level first, each as long as the level's hashlen
+            start = offset + 2 * hashlen
+            for length in reversed(level_hashlen):
+                self.pubkeys.append(bytes(signature[start:start + length]))
+                start += length
         else:
             raise RuntimeError("Invalid signature size")
+        if self.sigcount < 1 or self.sigcount > len(heights):
+            raise RuntimeError("Invalid signature count")
+        if signature[header_len:header_len + 8] != signature[_PRIVID_LEN+1:offset]:
+            raise RuntimeError("Signature index mismatch")
+        if self.sigindex >= 1 << sum(heights):
+            raise RuntimeError("Signature index out of range")
+        # Level signatures, bottom level first, each with the level of its signing key.
+        # These stay slices of the input, so a memoryview signature is not copied.
+        self.levelsigs = []
+        offset = header_len + 8
+        for level in range(len(heights) - 1, len(heights) - 1 - self.sigcount, -1):
+            size = _level_signature_size(level_hashlen[level], level_otsbits[level], heights[level], otsmode)
+            self.levelsigs.append((level, signature[offset:offset + size]))
+            offset += size
+        if offset != len(signature):
+            raise RuntimeError("Invalid signature size")
+
     def get_pubkey(self):
         return self.pubkey
-    def validate(self, stored_index=None):
-        print("Validator not yet implemented")
+
+    def _position(self, level):
+        """Merkle leaf index used at a level for this signature index"""
+        below = sum(self.heights[level + 1:])
+        return (self.sigindex >> below) & ((1 << self.heights[level]) - 1)
+
+    def _jobs(self):
+        """(hashlen, otsbits, height, position, level signature, signed digest) for every level
+        signature present"""
+        jobs = []
+        for count, (level, levelsig) in enumerate(self.levelsigs):
+            hashlen = self.level_hashlen[level]
+            digest = self.msgdigest if count == 0 else self.pubkeys[count - 1]
+            jobs.append((hashlen,
+                         self.level_otsbits[level],
+                         self.heights[level],
+                         self._position(level),
+                         levelsig,
+                         _level_digest(digest, hashlen, bytes(levelsig[:hashlen]))))
+        return jobs
+
+    def _cost(self):
+        """Number of hashes chain completion and the merkle paths take for this signature"""
+        merkle = sum(1 + self.heights[level] for level, _ in self.levelsigs)
+        if self.otsmode == OTS_WINTERNITZ:
+            # Single chains cost what is left of them, which depends on the signed digests
+            jobs = self._jobs()
+            return merkle + sum((1 << job[1]) - 1 - value
+                                for job, values in zip(jobs, _job_values(jobs, self.otsmode))
+                                for value in values)
+        cost = merkle
+        for level, _ in self.levelsigs:
+            otsbits = self.level_otsbits[level]
+            chop_count = ((self.level_hashlen[level] * 8 - 1) // otsbits) + 1
+            cost += chop_count * ((1 << otsbits) - 1)
+        return cost
+
+    def _precheck(self, stored_index, pubkey=None, pending=None):
+        """Checks that need no chain hashing, cheapest first
+
+        pending holds (privid, level pubkey) pairs a full signature validated in the
+        same batch may still make trusted."""
+        # pylint: disable=too-many-return-statements
+        if stored_index is not None and self.sigindex <= stored_index:
+            return False
+        if pubkey is not None and self.pubkeys[-1] != pubkey:
+            return False
+        if self.keyindex is not None and self.keyindex.path(self.privhash) is None:
+            return False
+        if self.index_store is not None:
+            status = self.index_store.status(self._account(), self.sigindex, self.msgdigest)
+            # Possible reuse is left to the full check, only a valid signature is evidence
+            if status in (REPLAY, STALE):
+                self.index_status = status
+                return False
+        if self.trusted is not None:
+            # Level pubkeys must agree with the tree above every level pubkey already trusted
+            for level in range(0, len(self.pubkeys)):
+                above = self.trusted.get((self.privhash, self.pubkeys[level]))
+                if above is not None and above != tuple(self.pubkeys[level + 1:]):
+                    return False
+        if self.sigcount < len(self.pubkeys):
+            key = self._trust_key()
+            if (self.trusted is None or key not in self.trusted) and (pending is None or key not in pending):
+                return False
         return True
 
-def keystruct_to_dict(keystructure, parent=None, parent_path=None):
-    rval = dict()
-    if parent is None:
-        parent = _nacl1_hash_function(b"",
-                                           digest_size=24,
-                                           encoder=_Nacl1RawEncoder)
-        rval[parent.hex()] = ""
-    for key in keystructure:
-        subkey_digest = _nacl1_hash_function(key.encode(),
-                                             digest_size=24,
-                                             key=parent,
-                                             encoder=_Nacl1RawEncoder)
-        if parent_path is None:
-            path = key
+    def _account(self):
+        """Index store key: the privid is shared by all accounts on a key path"""
+        return _account_id(self.privhash, self.pubkeys[-1])
+
+    def _trust_key(self):
+        """Trusted pubkey cache key for the highest level pubkey this signature proves"""
+        return (self.privhash, self.pubkeys[self.sigcount - 1])
+
+    def _result_key(self):
+        return _result_key(self.hashlen, self.level_hashlen, self.level_otsbits, self.heights, self.signature,
+                           self.otsmode)
+
+    def _cached(self):
+        """Chain completion outcome from the result cache, None if unknown"""
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get(self._result_key())
+
+    def _chains_valid(self, roots):
+        """Compare reconstructed level pubkeys with the header and remember the outcome"""
+        valid = list(roots) == self.pubkeys[:len(roots)]
+        if self.result_cache is not None:
+            self.result_cache.put(self._result_key(), valid)
+        return valid
+
+    def _check(self, chains_valid, stored_index):
+        """Complete compressed chains from the trusted pubkey cache and apply the index checks"""
+        if stored_index is not None and self.sigindex <= stored_index:
+            return False
+        if not chains_valid:
+            return False
+        top = self.sigcount - 1
+        above = tuple(self.pubkeys[top + 1:])
+        if above:
+            # Compressed signature: the highest verified level pubkey must be known to chain up
+            if self.trusted is None or self.trusted.get((self.privhash, self.pubkeys[top])) != above:
+                return False
+        # Only a cryptographically valid signature says anything about index reuse
+        if self.index_store is not None:
+            self.index_status = self.index_store.status(self._account(), self.sigindex, self.msgdigest)
+            if self.index_status != NEW:
+                return False
+        if self.trusted is not None:
+            for level in range(0, len(self.pubkeys)):
+                self.trusted[(self.privhash, self.pubkeys[level])] = tuple(self.pubkeys[level + 1:])
+        if self.index_store is not None:
+            self.index_store.record(self._account(), self.sigindex, self.msgdigest)
+        self.pubkey = self.pubkeys[-1]
+        return True
+
+    def validate(self, stored_index=None, pubkey=None, hash_budget=None):
+        """Validate the chain of level signatures up to the top level pubkey
+
+        The signed digest is taken from the signature; use validate_data,
+        validate_string or validate_stream to also check it against the message.
+        On success, get_pubkey() returns the top level pubkey to compare with the
+        account's known pubkey.
+
+        With an index store, signatures whose (account, index) was seen before are
+        rejected, index_status tells a replay from one-time key reuse, and
+        accepted signatures are recorded and flushed to the store's log file.
+
+        Checks that need no chain hashing run first: index, account pubkey,
+        known privid, replay, trusted pubkeys and for compressed signatures a
+        trusted level pubkey to chain up from. Chain completion runs last.
+
+        Parameters
+        ----------
+        stored_index : int or None
+            Highest signature index already used by this key; older indices are rejected
+        pubkey : bytes or None
+            Known top level pubkey of the account, rejects signatures of other keys early
+        hash_budget : int or None
+            Maximum number of hashes to spend, rejects costlier signatures unchecked
+
+        Returns
+        -------
+        bool
+            True if the signature is valid
+        """
+        if not self._precheck(stored_index, pubkey):
+            return False
+        chains_valid = self._cached()
+        if chains_valid is None:
+            if hash_budget is not None and self._cost() > hash_budget:
+                return False
+            jobs = self._jobs()
+            chains_valid = self._chains_valid(
+                [_level_root(*job[:5], values, self.otsmode)
+                 for job, values in zip(jobs, _job_values(jobs, self.otsmode))])
+        rval = self._check(chains_valid, stored_index)
+        if self.index_store is not None:
+            self.index_store.flush()
+        return rval
+
+    def validate_data(self, message, stored_index=None, pubkey=None, hash_budget=None):
+        """Validate a signature made with SigningKey.sign_data"""
+        if not self._precheck(stored_index, pubkey) or _message_digest(self, message) != self.msgdigest:
+            return False
+        return self.validate(stored_index, pubkey, hash_budget)
+
+    def validate_string(self, message, stored_index=None, pubkey=None, hash_budget=None):
+        """Validate a signature made with SigningKey.sign_string"""
+        if not self._precheck(stored_index, pubkey) or _message_digest(self, message) != self.msgdigest:
+            return False
+        return self.validate(stored_index, pubkey, hash_budget)
+
+    def validate_stream(self, source, stored_index=None, pubkey=None, hash_budget=None, executor=None):
+        # pylint: disable=too-many-arguments
+        """Validate against a streamed payload (path, file object or iterable of chunks)
+        as signed with SigningKey.sign_data or SigningKey.sign_stream. Tree-hash flagged
+        signatures (SigningKey.sign_tree) need a path, any other source does not validate,
+        and hash its leaves on executor."""
+        if not self._precheck(stored_index, pubkey):
+            return False
+        if self.tree_digest:
+            if not isinstance(source, (str, os.PathLike)):
+                return False
+            digest = _tree_digest(source, self.hashlen, executor=executor)
         else:
-            path = parent_path + [key]
-        rval[subkey_digest.hex()] = path
-        val = keystructure[key]
-        if isinstance(val, dict):
-            subresult = keystruct_to_dict(val, subkey_digest, path)
-            for key2 in subresult:
-                rval[key2] = subresult[key2]
-    return rval
+            digest = _stream_digest(source, self.hashlen)
+        if digest != self.msgdigest:
+            return False
+        return self.validate(stored_index, pubkey, hash_budget)
+
+class _BatchEnvelope:
+    """Parsed batch envelope as created by SigningKey.sign_batch"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, hashlen, level_hashlen, level_otsbits, heights, envelope, env=None, otsmode=OTS_DUAL):
+        # pylint: disable=too-many-arguments, too-many-locals
+        self.hashlen = hashlen
+        self.level_hashlen = level_hashlen
+        self.level_otsbits = level_otsbits
+        self.otsmode = otsmode
+        self.heights = heights
+        self.env = env
+        envelope = memoryview(envelope)
+        header_len = len(_BATCH_MAGIC) + _PRIVID_LEN + 7
+        if len(envelope) < header_len or bytes(envelope[:len(_BATCH_MAGIC)]) != _BATCH_MAGIC:
+            raise RuntimeError("Not a batch envelope")
+        offset = len(_BATCH_MAGIC)
+        self.privhash = bytes(envelope[offset:offset + _PRIVID_LEN])
+        offset += _PRIVID_LEN
+        levels = envelope[offset]
+        key_count = int.from_bytes(envelope[offset + 1:offset + 3], "big")
+        tx_count = int.from_bytes(envelope[offset + 3:offset + 7], "big")
+        offset += 7
+        if levels != len(heights):
+            raise RuntimeError("Batch envelope level count does not match key structure")
+        # Each key: (level, parent ref, pubkey, signature by parent)
+        self.keys = []
+        for _ in range(0, key_count):
+            if offset + 3 > len(envelope):
+                raise RuntimeError("Truncated batch envelope")
+            level = envelope[offset]
+            parent = int.from_bytes(envelope[offset + 1:offset + 3], "big")
+            offset += 3
+            if level >= levels:
+                raise RuntimeError("Invalid level in batch envelope")
+            pubkey = bytes(envelope[offset:offset + level_hashlen[level]])
+            offset += level_hashlen[level]
+            if len(pubkey) != level_hashlen[level]:
+                raise RuntimeError("Truncated batch envelope")
+            if level == 0:
+                if parent != _BATCH_NO_PARENT:
+                    raise RuntimeError("Top level key in batch envelope has a parent")
+                parent_sig = b""
+            else:
+                if parent >= len(self.keys) or self.keys[parent][0] != level - 1:
+                    raise RuntimeError("Invalid parent reference in batch envelope")
+                sig_size = _level_signature_size(level_hashlen[level - 1],
+                                                 level_otsbits[level - 1],
+                                                 heights[level - 1],
+                                                 otsmode)
+                parent_sig = bytes(envelope[offset:offset + sig_size])
+                offset += sig_size
+                if len(parent_sig) != sig_size:
+                    raise RuntimeError("Truncated batch envelope")
+            self.keys.append((level, parent, pubkey, parent_sig))
+        # Each tx: (flags, idx, key ref, salt, digest, bottom signature)
+        self.txs = []
+        bottom_size = _level_signature_size(level_hashlen[-1], level_otsbits[-1], heights[-1], otsmode)
+        tx_size = 11 + 2 * hashlen + bottom_size
+        if len(envelope) - offset != tx_count * tx_size:
+            raise RuntimeError("Invalid batch envelope size")
+        for _ in range(0, tx_count):
+            flags = envelope[offset]
+            idx = bytes(envelope[offset + 1:offset + 9])
+            ref = int.from_bytes(envelope[offset + 9:offset + 11], "big")
+            offset += 11
+            if ref >= len(self.keys) or self.keys[ref][0] != levels - 1:
+                raise RuntimeError("Invalid key reference in batch envelope")
+            self.txs.append((flags,
+                             idx,
+                             ref,
+                             bytes(envelope[offset:offset + hashlen]),
+                             bytes(envelope[offset + hashlen:offset + 2 * hashlen]),
+                             bytes(envelope[offset + 2 * hashlen:offset + tx_size - 11])))
+            offset += tx_size - 11
+
+    def __len__(self):
+        return len(self.txs)
 
+    def full_signature(self, index):
+        """Expand a single transaction into the full signature SigningKey.sign_data would give"""
+        flags, idx, ref, salt, digest, bottom_sig = self.txs[index]
+        pubkeys = []
+        parent_sigs = []
+        while ref != _BATCH_NO_PARENT:
+            _, parent, pubkey, parent_sig = self.keys[ref]
+            pubkeys.append(pubkey)
+            if parent != _BATCH_NO_PARENT:
+                parent_sigs.append(parent_sig)
+            ref = parent
+        sigcount = (len(pubkeys) | flags).to_bytes(1, "big")
+        return b"".join([self.privhash, sigcount, idx, salt, digest] +
+                        pubkeys +
+                        [idx, bottom_sig] +
+                        parent_sigs)
 
+    def signatures(self):
+        """Get the parsed full signature of every transaction, in batch order"""
+        return [_Signature(self.hashlen, self.level_hashlen, self.level_otsbits, self.heights,
+                           self.full_signature(index), self.env, self.otsmode)
+                for index in range(0, len(self.txs))]
 
 class ValidationEnv:
-    def __init__(self, hashlen, otsbits, keyspace, path, hierarchy):
+    def __init__(self, hashlen, otsbits, keyspace, path, hierarchy, index_store=None, result_cache=None,
+                 otsmode=OTS_DUAL):
+        # pylint: disable=too-many-arguments
+        _check_otsmode(otsmode)
         self.hashlen = hashlen
         self.otsbits = otsbits
+        self.otsmode = otsmode
         self.heights = keyspace[0]["heights"]
-        self.keystructure = keystruct_to_dict(hierarchy, parent_path=path)
-        print(self.keystructure)
+        # Per level hashlen and otsbits, top level first
+        self.level_hashlen, self.level_otsbits = _level_params(hashlen, otsbits, keyspace[0])
+        # privid to key path and permitted key space, shared by all validators of this config
+        self.keyindex = _get_keyindex(path, hierarchy, keyspace)
+        # (privid, level pubkey) to the level pubkeys above it, for compressed signatures
+        self.trusted = {}
+        # Optional IndexStore for replay and one-time key reuse detection
+        self.index_store = index_store
+        # Optional ResultCache, possibly shared with other validators and threads
+        self.result_cache = result_cache
 
     def signature(self, signature):
-        return _Signature(self.hashlen, self.otsbits, self.heights, signature)
+        return _Signature(self.hashlen, self.level_hashlen, self.level_otsbits, self.heights, signature, self,
+                          self.otsmode)
+
+    def validate_many(self, signatures, messages=None, stored_indices=None, executor=None, shard_size=64,
+                      pubkeys=None, priorities=None, hash_budget=None):
+        # pylint: disable=too-many-arguments, too-many-locals, too-many-branches
+        """Validate many signatures, cheap checks first, sharding the OTS chain completion over a pool
+
+        All checks that need no chain hashing (see _Signature.validate), the message
+        digest and the result cache lookup run here first, so malformed, replayed
+        or wrong-account signatures are rejected at near constant cost. The
+        remaining signatures are scheduled by priority, then by hash cost, and
+        admitted while the hash budget lasts. Full signatures are checked before
+        compressed ones, so a compressed signature may rely on a full signature
+        of the same key in the same call.
+
+        Parameters
+        ----------
+        signatures : list of bytes-like
+            Serialized signatures, for example memoryviews from a SignatureBlockReader
+        messages : list or None
+            Per signature the signed message: bytes for sign_data, str for
+            sign_string, a file path for tree digest signatures, or None to
+            skip the message check
+        stored_indices : list or None
+            Per signature the highest index already used by its key, or None
+        executor : concurrent.futures.Executor or None
+            Pool to complete the chains and hash tree digest leaves on, for
+            example a ProcessPoolExecutor; inline if None
+        shard_size : int
+            Number of level signatures per pool task
+        pubkeys : list or None
+            Per signature the known top level pubkey of the account, or None
+        priorities : list of int or None
+            Per signature the scheduling priority, lower first; for example 0 for
+            transactions from clients and 1 for bulk sync
+        hash_budget : int or None
+            Maximum number of hashes to spend on chain completion in this call
+
+        Returns
+        -------
+        list
+            Per signature, in input order, True or False, or None if it was not
+            checked because the hash budget ran out
+        """
+        count = len(signatures)
+        if messages is None:
+            messages = [None] * count
+        if stored_indices is None:
+            stored_indices = [None] * count
+        if pubkeys is None:
+            pubkeys = [None] * count
+        if priorities is None:
+            priorities = [0] * count
+        if not len(messages) == len(stored_indices) == len(pubkeys) == len(priorities) == count:
+            raise ValueError("per signature arguments must match signatures in length")
+        rval = [False] * count
+        parsed = [None] * count
+        for number, signature in enumerate(signatures):
+            try:
+                parsed[number] = self.signature(signature)
+            except RuntimeError:
+                pass
+        # Level pubkeys that full signatures in this batch may make trusted
+        pending = {(sig.privhash, pubkey)
+                   for sig in parsed if sig is not None and sig.sigcount == len(sig.pubkeys)
+                   for pubkey in sig.pubkeys}
+        # pylint: disable=protected-access
+        known = [None] * count
+        candidates = []
+        for number, sig in enumerate(parsed):
+            if sig is None or not sig._precheck(stored_indices[number], pubkeys[number], pending):
+                parsed[number] = None
+                continue
+            if messages[number] is not None and \
+               _message_digest(sig, messages[number], executor) != sig.msgdigest:
+                parsed[number] = None
+                continue
+            known[number] = sig._cached()
+            if known[number] is None:
+                # Compressed signatures waiting for trust from this batch go after full ones
+                waiting = sig.sigcount < len(sig.pubkeys) and sig._trust_key() not in self.trusted
+                candidates.append((priorities[number], waiting, sig._cost(), number))
+        candidates.sort()
+        admitted = []
+        deferred = set()
+        for _, _, cost, number in candidates:
+            if hash_budget is not None:
+                if cost > hash_budget:
+                    rval[number] = None
+                    deferred.update((parsed[number].privhash, pubkey) for pubkey in parsed[number].pubkeys)
+                    parsed[number] = None
+                    continue
+                hash_budget -= cost
+            admitted.append(number)
+        jobs = []
+        for number in admitted:
+            jobs += parsed[number]._jobs()
+        # Memory mapped level signatures are only copied when they have to go to a pool
+        jobs = [job[:4] + (job[4] if executor is None else bytes(job[4]), values)
+                for job, values in zip(jobs, _job_values(jobs, self.otsmode))]
+        shards = [jobs[start:start + shard_size] for start in range(0, len(jobs), shard_size)]
+        if executor is None:
+            results = map(_level_roots, shards, [self.otsmode] * len(shards))
+        else:
+            results = executor.map(_level_roots, shards, [self.otsmode] * len(shards))
+        roots = [root for shard in results for root in shard]
+        offset = 0
+        for number in admitted:
+            levels = len(parsed[number].levelsigs)
+            known[number] = parsed[number]._chains_valid(roots[offset:offset + levels])
+            offset += levels
+        full = [number for number, sig in enumerate(parsed) if sig is not None and sig.sigcount == len(sig.pubkeys)]
+        compressed = [number for number, sig in enumerate(parsed) if sig is not None and sig.sigcount < len(sig.pubkeys)]
+        for number in full + compressed:
+            rval[number] = parsed[number]._check(known[number], stored_indices[number])
+            if not rval[number] and number in compressed:
+                key = parsed[number]._trust_key()
+                if key in deferred and key not in self.trusted:
+                    # The full signature it chains up from ran out of budget
+                    rval[number] = None
+        if self.index_store is not None:
+            self.index_store.flush()
+        return rval
+
+    def batch(self, envelope):
+        """Parse a batch envelope created with SigningKey.sign_batch"""
+        return _BatchEnvelope(self.hashlen, self.level_hashlen, self.level_otsbits, self.heights, envelope, self,
+                              self.otsmode)
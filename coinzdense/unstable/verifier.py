@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+"""Local verification service sharing validators and caches between client processes
+
+A VerificationService owns one ValidationEnv per key space, created with
+BlockChainEnv.get_validator, and accepts verify requests over a Unix domain
+socket (see coinzdense.unstable.ipc for the framing). All clients share the
+trusted pubkey cache of those validators and a single ResultCache, so a
+signature checked for the RPC process is a cache hit for block import.
+
+Requests for the same validator are coalesced into batches for
+ValidationEnv.validate_many, chain completion optionally on a process pool.
+Every client has a priority class, sent as the request flags, that orders
+its requests in the queue and in the hash budget of a batch; signatures
+that did not fit in the budget go back in the queue.
+
+Request payload: signature length (4, big-endian) | signature | message.
+Response payload: 1 and the top level pubkey if valid, 0 if not.
+
+Tree-hash signatures (SigningKey.sign_tree) sign a file by path. Checking them
+against a message would make the service open and hash any file a client
+names, so those requests are refused; validate them locally instead.
+"""
+import asyncio
+import itertools
+import os
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from coinzdense.unstable.ipc import read_frame, encode_frame, call, STATUS_OK, STATUS_ERROR
+from coinzdense.unstable.resultcache import ResultCache
+from coinzdense.unstable.validation import _PRIVID_LEN, _TREE_DIGEST_FLAG
+
+OP_VERIFY = 1
+OP_VERIFY_DATA = 2
+OP_VERIFY_STRING = 3
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+_SIGLEN = struct.Struct(">I")
+
+
+class _ValidatorSlot:
+    """Per-validator request queue and batching task"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, validator):
+        self.validator = validator
+        self.requests = None
+        self.task = None
+
+
+class VerificationService:
+    """Long running verifier for many clients, built on BlockChainEnv.get_validator"""
+    def __init__(self, executor=None, max_batch=256, hash_budget=None, result_cache=None):
+        """Constructor
+
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor or None
+            Pool for OTS chain completion, for example a ProcessPoolExecutor; inline if None
+        max_batch : int
+            Maximum number of requests coalesced into a single batch
+        hash_budget : int or None
+            Maximum number of hashes spent on chain completion per batch
+        result_cache : ResultCache or None
+            Result cache shared by all validators, a new one if None
+        """
+        if not isinstance(max_batch, int):
+            raise TypeError("max_batch must be an integer")
+        if max_batch < 1:
+            raise ValueError("max_batch must be positive")
+        self._executor = executor
+        # Batches run one at a time, validators keep mutable trust and index state
+        self._batch_executor = ThreadPoolExecutor(max_workers=1)
+        self._max_batch = max_batch
+        self._hash_budget = hash_budget
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+        self._slots = {}
+        self._sequence = itertools.count()
+
+    def add_validator(self, name, validator):
+        """Register a ValidationEnv under a name
+
+        The validator should use this service's result_cache to share it.
+        """
+        if name in self._slots:
+            raise KeyError("Validator already registered: " + name)
+        self._slots[name] = _ValidatorSlot(validator)
+
+    def add_from_env(self, name, env, index_store=None):
+        """Create a validator with BlockChainEnv.get_validator and register it"""
+        self.add_validator(name, env.get_validator(index_store, self.result_cache))
+
+    def _start(self, slot):
+        """Start the batching task for a validator on first use"""
+        if slot.requests is None:
+            slot.requests = asyncio.PriorityQueue()
+            slot.task = asyncio.ensure_future(self._batch_stage(slot))
+
+    async def verify(self, name, signature, message=None, priority=PRIORITY_NORMAL):
+        """Verify a signature with a named validator
+
+        Parameters
+        ----------
+        name : str
+            Name of the validator
+        signature : bytes
+            The signature
+        message : bytes, str or None
+            Signed data (sign_data), signed string (sign_string) or None to only check the signature
+        priority : int
+            Priority class, lower goes first
+
+        Returns
+        -------
+        bytes or None
+            The top level pubkey if the signature is valid, None if not
+
+        Raises
+        ------
+        ValueError
+            Thrown for a tree-hash signature with a message, the service does not open files
+        """
+        if name not in self._slots:
+            raise KeyError("No validator named " + name)
+        if message is not None and len(signature) > _PRIVID_LEN and signature[_PRIVID_LEN] & _TREE_DIGEST_FLAG:
+            raise ValueError("Tree-hash signatures can not be checked against a message by the service")
+        slot = self._slots[name]
+        self._start(slot)
+        future = asyncio.get_running_loop().create_future()
+        await slot.requests.put((priority, next(self._sequence), signature, message, future))
+        return await future
+
+    async def _batch_stage(self, slot):
+        """Coalesce pending requests into batches and validate them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await slot.requests.get()]
+            while len(requests) < self._max_batch and not slot.requests.empty():
+                requests.append(slot.requests.get_nowait())
+            try:
+                results = await loop.run_in_executor(self._batch_executor, self._validate, slot.validator, requests)
+            except Exception as exc:  # pylint: disable=broad-except
+                results = [exc] * len(requests)
+            # If nothing fit in the budget, these signatures never will
+            retry = any(result is not None for result in results)
+            for request, result in zip(requests, results):
+                future = request[4]
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                elif result is None and retry:
+                    slot.requests.put_nowait(request)
+                else:
+                    future.set_result(result or None)
+
+    def _validate(self, validator, requests):
+        """Validate a batch, returning the top level pubkey, False, or None for deferred signatures"""
+        signatures = [request[2] for request in requests]
+        results = validator.validate_many(signatures,
+                                          [request[3] for request in requests],
+                                          executor=self._executor,
+                                          priorities=[request[0] for request in requests],
+                                          hash_budget=self._hash_budget)
+        # The top level pubkey is the last of the header pubkeys
+        top = _PRIVID_LEN + 9 + 2 * validator.hashlen + sum(validator.level_hashlen[1:])
+        return [bytes(signature[top:top + validator.level_hashlen[0]]) if result else result
+                for signature, result in zip(signatures, results)]
+
+    async def _handle(self, reader, writer):
+        """Serve a single client connection, answering pipelined requests in order"""
+        responses = asyncio.Queue()
+
+        async def respond():
+            while True:
+                pending = await responses.get()
+                if pending is None:
+                    return
+                try:
+                    pubkey = await pending
+                    writer.write(encode_frame(STATUS_OK, 0, b"", b"\x00" if pubkey is None else b"\x01" + pubkey))
+                except Exception as exc:  # pylint: disable=broad-except
+                    writer.write(encode_frame(STATUS_ERROR, 0, b"", str(exc).encode("utf8")))
+                await writer.drain()
+
+        responder = asyncio.ensure_future(respond())
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                opcode, flags, name, payload = frame
+                pending = asyncio.get_running_loop().create_future()
+                if opcode not in (OP_VERIFY, OP_VERIFY_DATA, OP_VERIFY_STRING) or len(payload) < _SIGLEN.size:
+                    pending.set_exception(ValueError("Unknown opcode or malformed request"))
+                else:
+                    siglen = _SIGLEN.unpack_from(payload)[0]
+                    signature = payload[_SIGLEN.size:_SIGLEN.size + siglen]
+                    message = payload[_SIGLEN.size + siglen:]
+                    if opcode == OP_VERIFY:
+                        message = None
+                    elif opcode == OP_VERIFY_STRING:
+                        message = message.decode("latin1")
+                    pending = asyncio.ensure_future(self.verify(name.decode("utf8"), signature, message, flags))
+                await responses.put(pending)
+        finally:
+            await responses.put(None)
+            await responder
+            writer.close()
+
+    async def serve(self, path):
+        """Start listening on a Unix domain socket
+
+        Returns
+        -------
+        asyncio.AbstractServer
+            The server, use serve_forever() or close() on it
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self._handle, path=path)
+
+    async def close(self):
+        """Stop all batching tasks"""
+        for slot in self._slots.values():
+            if slot.task is not None:
+                slot.task.cancel()
+                await asyncio.gather(slot.task, return_exceptions=True)
+            slot.task = None
+            slot.requests = None
+        self._batch_executor.shutdown(wait=True)
+
+
+class VerificationClient:
+    """Thin client for a VerificationService validator with a fixed priority class"""
+    def __init__(self, path, name, priority=PRIORITY_NORMAL):
+        if not 0 <= priority < 256:
+            raise ValueError("priority must fit in a byte")
+        self._name = name.encode("utf8")
+        self._priority = priority
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+
+    def _call(self, opcode, signature, message):
+        body = call(self._sock, opcode, self._priority, self._name,
+                    _SIGLEN.pack(len(signature)) + signature + message)
+        return body[1:] if body[:1] == b"\x01" else None
+
+    def verify(self, signature):
+        """Verify a signature without a message check, the top level pubkey if valid, else None"""
+        return self._call(OP_VERIFY, signature, b"")
+
+    def verify_data(self, signature, msg):
+        """Verify a signature made with sign_data, the top level pubkey if valid, else None"""
+        if not isinstance(msg, bytes):
+            raise TypeError("msg must be bytes")
+        return self._call(OP_VERIFY_DATA, signature, msg)
+
+    def verify_string(self, signature, msg):
+        """Verify a signature made with sign_string, the top level pubkey if valid, else None"""
+        return self._call(OP_VERIFY_STRING, signature, msg.encode("latin1"))
+
+    def close(self):
+        """Close the connection to the service"""
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,4 +1,5 @@
 #!/usr/bin/python3
+from functools import lru_cache as _lru_cache
 from libnacl import crypto_kdf_KEYBYTES as _NACL2_KEY_BYTES
 from nacl.pwhash.argon2id import SALTBYTES as _NACL1_SALTBYTES
 from nacl.utils import random as _nacl1_random
@@ -7,16 +8,20 @@ from nacl.hash import blake2b as _nacl1_hash_function
 from nacl.encoding import RawEncoder as _Nacl1RawEncoder
 from nacl.pwhash.argon2id import kdf as _nacl1_kdf
 
-def _keypath_to_id(path):
-    rval = _nacl1_hash_function(b"",
-                                digest_size=24,
-                                encoder=_Nacl1RawEncoder)
-    for part in path:
-        rval = _nacl1_hash_function(part.encode(),
+@_lru_cache(maxsize=4096)
+def _keypath_tuple_to_id(path):
+    """Chained privid of a key path, sharing the work for common path prefixes"""
+    if not path:
+        return _nacl1_hash_function(b"",
                                     digest_size=24,
-                                    key=rval,
                                     encoder=_Nacl1RawEncoder)
-    return rval
+    return _nacl1_hash_function(path[-1].encode(),
+                                digest_size=24,
+                                key=_keypath_tuple_to_id(path[:-1]),
+                                encoder=_Nacl1RawEncoder)
+
+def _keypath_to_id(path):
+    return _keypath_tuple_to_id(tuple(path))
 
 class _Wallet:
     def __init__(self, encwallet, privid, rawkey):
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+"""Portable, integrity-protected bundles of precomputed first level keys
+
+An offline batch job precomputes the level keys a fresh SigningKey (index 0)
+needs, for every sub-key of many accounts, and writes them as bundles in the
+FsEnv account layout::
+
+    <vardir>/<appname>/<account>/OWNER/first_levels.czkb
+    <vardir>/<appname>/<account>/<sub>/<subsub>/first_levels.czkb
+
+A hot signer passes bundle_table_source(...) as table_source to
+BlockChainEnv.get_signing_key and never generates those level keys itself.
+The merkle tables use the same flat format as layerzero LevelKey(merkle_table=...).
+
+Bundle layout (all integers big-endian)::
+
+    magic "CZKB" (4) | version (1) | hashlen (1) | otsbits (1) | otsmode (1) |
+    level count (1) | privid (24) | path length (2) | path ("/" joined, utf8) |
+    per level, top first: startno (8) | hashlen (1) | otsbits (1) | table length (4) |
+                          merkle table |
+    mac (32)
+
+The otsmode byte is the position of the mode in OTS_MODES, the per level
+hashlen and otsbits are those of the keyspace entry (see BlockChainEnv).
+
+The mac is a keyed BLAKE2b over everything before it, keyed with a key derived
+from the sub-key's wallet key, so only holders of that key can create or check it.
+"""
+import os
+import hmac
+import struct
+from libnacl import crypto_kdf_derive_from_key as _nacl2_key_derive
+from nacl.hash import blake2b as _nacl1_hash_function
+from nacl.encoding import RawEncoder as _Nacl1RawEncoder
+from coinzdense.layerzero.sharedtree import MerkleTable
+from coinzdense.layerzero.onetime import OTS_MODES
+from coinzdense.unstable.app import BlockChainEnv
+from coinzdense.unstable.validation import _level_params
+
+_MAGIC = b"CZKB"
+_VERSION = 2
+_HEADER = struct.Struct(">4sBBBBB24sH")
+_LEVEL = struct.Struct(">QBBI")
+_MAC_LEN = 32
+BUNDLE_NAME = "first_levels.czkb"
+
+def _mac(wallet, data):
+    mac_key = _nacl2_key_derive(_MAC_LEN, 0, "bundlmac", wallet.key)
+    return _nacl1_hash_function(data,
+                                digest_size=_MAC_LEN,
+                                key=mac_key,
+                                encoder=_Nacl1RawEncoder)
+
+def sub_paths(hierarchy, prefix=None):
+    """List the root key path and every sub-key path of a key hierarchy"""
+    if prefix is None:
+        prefix = []
+    rval = [prefix]
+    for key, val in hierarchy.items():
+        rval += sub_paths(val, prefix + [key])
+    return rval
+
+def sub_env(env, path):
+    """Walk a BlockChainEnv down a sub-key path"""
+    for part in path:
+        env = env[part]
+    return env
+
+def sub_wallet(wallet, path):
+    """Walk a wallet down a sub-key path"""
+    for part in path:
+        wallet = wallet[part]
+    return wallet
+
+def _key_params(env):
+    """Key structure params of a BlockChainEnv as stored in a bundle"""
+    level_hashlen, level_otsbits = _level_params(env.hashlen, env.otsbits, env.keyspace[0])
+    return {"hashlen": env.hashlen,
+            "otsbits": env.otsbits,
+            "otsmode": env.otsmode,
+            "level_hashlen": level_hashlen,
+            "level_otsbits": level_otsbits}
+
+def bundle_path(vardir, appname, account, path):
+    """Location of a bundle in the FsEnv account layout"""
+    parts = path if path else ["OWNER"]
+    return os.path.join(vardir, appname, account, *parts, BUNDLE_NAME)
+
+def create_bundle(env, wallet, path):
+    """Precompute the first level keys of a sub-key and pack them into a bundle
+
+    Parameters
+    ----------
+    env : BlockChainEnv
+        Environment of the account's root key
+    wallet : _Wallet
+        The account's root wallet
+    path : list of str
+        Sub-key path, empty for the root key
+
+    Returns
+    -------
+    bytes
+        The bundle
+    """
+    key_env = sub_env(env, path)
+    key_wallet = sub_wallet(wallet, path)
+    signing_key = key_env.get_signing_key(key_wallet)
+    tables = signing_key.export_tables()
+    params = _key_params(key_env)
+    encoded_path = "/".join(path).encode("utf8")
+    parts = [_HEADER.pack(_MAGIC,
+                          _VERSION,
+                          key_env.hashlen,
+                          key_env.otsbits,
+                          OTS_MODES.index(key_env.otsmode),
+                          len(tables),
+                          key_wallet.privid,
+                          len(encoded_path)),
+             encoded_path]
+    for level, (startno, table) in enumerate(tables):
+        blob = table.tobytes()
+        parts.append(_LEVEL.pack(startno,
+                                 params["level_hashlen"][level],
+                                 params["level_otsbits"][level],
+                                 len(blob)))
+        parts.append(blob)
+    data = b"".join(parts)
+    return data + _mac(key_wallet, data)
+
+def read_bundle(data, wallet, env=None):
+    """Check and unpack a bundle
+
+    Parameters
+    ----------
+    data : bytes
+        The bundle
+    wallet : _Wallet or sub-key wallet
+        Wallet of the sub-key the bundle was made for
+    env : BlockChainEnv or None
+        Environment of the sub-key, rejects bundles made with other key structure params
+
+    Returns
+    -------
+    dict
+        path (list of str), hashlen, otsbits, otsmode, level_hashlen, level_otsbits
+        and tables (startno to MerkleTable)
+
+    Raises
+    ------
+    ValueError
+        Thrown if the bundle is malformed, corrupted or made for another key
+    """
+    if len(data) < _HEADER.size + _MAC_LEN:
+        raise ValueError("Bundle too short")
+    if not hmac.compare_digest(_mac(wallet, data[:-_MAC_LEN]), data[-_MAC_LEN:]):
+        raise ValueError("Bundle integrity check failed")
+    magic, version, hashlen, otsbits, otsmode, levels, privid, pathlen = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION or otsmode >= len(OTS_MODES):
+        raise ValueError("Not a level key bundle")
+    if privid != wallet.privid:
+        raise ValueError("Bundle belongs to a different key")
+    offset = _HEADER.size
+    path = data[offset:offset + pathlen].decode("utf8")
+    offset += pathlen
+    params = {"hashlen": hashlen,
+              "otsbits": otsbits,
+              "otsmode": OTS_MODES[otsmode],
+              "level_hashlen": [],
+              "level_otsbits": []}
+    tables = {}
+    for _ in range(0, levels):
+        startno, level_hashlen, level_otsbits, length = _LEVEL.unpack_from(data, offset)
+        offset += _LEVEL.size
+        params["level_hashlen"].append(level_hashlen)
+        params["level_otsbits"].append(level_otsbits)
+        tables[startno] = MerkleTable(data[offset:offset + length])
+        offset += length
+    if offset != len(data) - _MAC_LEN:
+        raise ValueError("Bundle has trailing data")
+    if env is not None and params != _key_params(env):
+        raise ValueError("Bundle was made with other key structure params")
+    params["path"] = path.split("/") if path else []
+    params["tables"] = tables
+    return params
+
+def bundle_table_source(data, wallet, env=None):
+    """Table source for BlockChainEnv.get_signing_key serving the level keys of a bundle
+
+    With the sub-key's env, bundles made with other key structure params are rejected."""
+    tables = read_bundle(data, wallet, env)["tables"]
+    return tables.get
+
+def load_bundle(vardir, appname, account, path, wallet, env=None):
+    # pylint: disable=too-many-arguments
+    """Table source for a bundle in the FsEnv account layout, None if there is no bundle
+
+    env is the account's root BlockChainEnv, to reject bundles made with other key
+    structure params."""
+    location = bundle_path(vardir, appname, account, path)
+    if not os.path.exists(location):
+        return None
+    with open(location, "rb") as infile:
+        return bundle_table_source(infile.read(),
+                                   sub_wallet(wallet, path),
+                                   None if env is None else sub_env(env, path))
+
+def _bundle_job(conf, account, wallet, path):
+    return account, path, create_bundle(BlockChainEnv(conf), wallet, path)
+
+def precompute_bundles(conf, accounts, vardir, executor=None):
+    """Batch job writing bundles for every sub-key of many accounts
+
+    Parameters
+    ----------
+    conf : dict
+        BlockChainEnv configuration
+    accounts : dict
+        Account name to root wallet
+    vardir : str
+        FsEnv var directory, usually FsEnv().vardir
+    executor : concurrent.futures.Executor or None
+        Pool to precompute on in parallel, sequential if None
+
+    Returns
+    -------
+    list of str
+        The bundle files written
+    """
+    env = BlockChainEnv(conf)
+    jobs = [(conf, account, wallet, path)
+            for account, wallet in accounts.items()
+            for path in sub_paths(env.hierarchy)]
+    if executor is None:
+        results = map(_bundle_job, *zip(*jobs))
+    else:
+        results = executor.map(_bundle_job, *zip(*jobs))
+    written = []
+    for account, path, data in results:
+        location = bundle_path(vardir, env.appname, account, path)
+        directory = os.path.dirname(location)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmppath = location + ".tmp"
+        with open(tmppath, "wb") as outfile:
+            outfile.write(data)
+        os.replace(tmppath, location)
+        written.append(location)
+    return written
@@ -39,5 +39,4 @@ async def main():
             print("    done", int(100*measurement/reference),"%")
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    asyncio.run(main())
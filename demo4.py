@@ -17,8 +17,7 @@ async def main():
                         hashlen=HASH_LENGTH,
                         otsbits=OTS_BITS,
                         height=MT_HEIGHT)
-    levelkey.announce(executor)
-    await levelkey.require()
+    await levelkey.build(executor)
     message = b"hohohohoho"
     sig1 = levelkey.sign_data(message, 644)
     sig2 = levelkey.sign_data(message, 645)
@@ -33,5 +32,4 @@ async def main():
 
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    asyncio.run(main())
@@ -2,32 +2,47 @@
 import sys
 import json
 
-def keys_per_signature(hashlen, otsbits):
-    return 2*(((hashlen*8-1) // otsbits)+1)
+OTS_MODES = ["dual", "wots"]
 
-def sub_sub_keyspace_usage(hashlen, otsbits, height):
-    return 1 + keys_per_signature(hashlen, otsbits) * (1 << height)
+def keys_per_signature(hashlen, otsbits, otsmode="dual"):
+    chop_count = ((hashlen*8-1) // otsbits)+1
+    if otsmode == "wots":
+        max_checksum = chop_count * ((1 << otsbits) - 1)
+        return chop_count + ((max_checksum.bit_length()-1) // otsbits)+1
+    return 2*chop_count
 
-def sub_keyspace_usage(hashlen, otsbits, heights):
-    usage = sub_sub_keyspace_usage(hashlen, otsbits,heights[0])
+def sub_sub_keyspace_usage(hashlen, otsbits, height, otsmode="dual"):
+    return 1 + keys_per_signature(hashlen, otsbits, otsmode) * (1 << height)
+
+def level_params(hashlen, otsbits, keyspace_entry):
+    levels = len(keyspace_entry["heights"])
+    rval = []
+    for name, default in (("hashlen", hashlen), ("otsbits", otsbits)):
+        value = keyspace_entry.get(name, default)
+        rval.append([value] * levels if isinstance(value, int) else value)
+    return rval[0], rval[1]
+
+def sub_keyspace_usage(hashlens, otsbits, heights, otsmode="dual"):
+    usage = sub_sub_keyspace_usage(hashlens[0], otsbits[0], heights[0], otsmode)
     if len(heights) > 1:
-        usage += (1 << heights[0]) * sub_keyspace_usage(hashlen, otsbits, heights[1:])
+        usage += (1 << heights[0]) * sub_keyspace_usage(hashlens[1:], otsbits[1:], heights[1:], otsmode)
     if usage.bit_length() > 64:
         print("ERROR: Key-derivation entropy would be exausted", usage.bit_length(),"out of 64 bit needed to support keyspace for deepest",len(heights), "single-priv key-levels")
     elif usage.bit_length() > 32:
         print("NOTICE:", usage.bit_length(),"out of 64 bit needed to support keyspace for deepest",len(heights), "single-priv key-levels")
     return usage
 
-def keyspace_usage(hashlen, otsbits, keyspace):
-    usage = (1 << sum(keyspace[0]["heights"])) + sub_keyspace_usage(hashlen, otsbits, keyspace[0]["heights"])
+def keyspace_usage(hashlen, otsbits, keyspace, otsmode="dual"):
+    hashlens, otsbits_list = level_params(hashlen, otsbits, keyspace[0])
+    usage = (1 << sum(keyspace[0]["heights"])) + sub_keyspace_usage(hashlens, otsbits_list, keyspace[0]["heights"], otsmode)
     if len(keyspace) > 1:
-        usage += (1 << keyspace[0]["reserve"]) * keyspace_usage(hashlen, otsbits, keyspace[1:])
+        usage += (1 << keyspace[0]["reserve"]) * keyspace_usage(hashlen, otsbits, keyspace[1:], otsmode)
     if usage.bit_length() > 64:
         print("ERROR: Key-derivation entropy would be exausted", usage.bit_length(),"out of 64 bit needed to support keyspace for deepest",len(keyspace), "priviledge levels")
     return usage
 
-def test_keyspace(hashlen, otsbits, keyspace):
-    total = keyspace_usage(hashlen, otsbits, keyspace)
+def test_keyspace(hashlen, otsbits, keyspace, otsmode="dual"):
+    total = keyspace_usage(hashlen, otsbits, keyspace, otsmode)
     if total.bit_length() > 64:
         print("ERROR: Key-derivation entropy would be exausted", total.bit_length(),"out of 64 bit needed to support keyspace")
         return 1
@@ -98,6 +113,9 @@ elif conf["otsbits"] < 4:
 elif conf["otsbits"] > 16:
     print("ERROR: otsbits definition in coinZdense RC file should be a number smaller than 17")
     errcount += 1
+if "otsmode" in conf and conf["otsmode"] not in OTS_MODES:
+    print("ERROR: otsmode definition in coinZdense RC file if defined should be one of", ", ".join(OTS_MODES))
+    errcount += 1
 if "hierarchy" not in conf:
     depth = 1
 elif not isinstance(conf["hierarchy"], dict):
@@ -147,6 +165,23 @@ else:
                         errcount += 1
                     else:
                         total_height += height
+                for name, low, high in (("hashlen", 16, 64), ("otsbits", 4, 16)):
+                    if name not in val:
+                        continue
+                    if isinstance(val[name], list):
+                        per_level = val[name]
+                        if len(per_level) != len(val["heights"]):
+                            print("ERROR: The", name, "list of the", idx, "keyspace object should have a value for each of its", len(val["heights"]), "heights")
+                            errcount += 1
+                    else:
+                        per_level = [val[name]]
+                    for value in per_level:
+                        if not isinstance(value, int):
+                            print("ERROR: The", name, "field of the", idx, "keyspace object should be a number or a list of numbers")
+                            errcount += 1
+                        elif value < low or value > high:
+                            print("ERROR: The", name, "values of the", idx, "keyspace object should be between", low, "and", high)
+                            errcount += 1
             if idx < len(conf["keyspace"]) -1:
                 if "reserve" not in val:
                     print("ERROR: keyspace at index number", idx,"should have an reserve field")
@@ -166,7 +201,7 @@ else:
                     print("ERROR: The last object in the keyspace definition must NOT have a reserve field")
                     errcount += 1
 if errcount == 0:
-    errcount = test_keyspace(conf["hashlen"], conf["otsbits"], conf["keyspace"])
+    errcount = test_keyspace(conf["hashlen"], conf["otsbits"], conf["keyspace"], conf.get("otsmode", "dual"))
 else:
     print("NOTICE: There are errors in the file format, not testing keyspace dimentions!")
 print("NOTICICE: error count :", errcount)
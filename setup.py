@@ -50,5 +50,9 @@ See https://coin.z-den.se/ for more info.
         "base58",
         "starkbank-ecdsa"
         ],
+    extras_require={
+        "vectorized": ["numpy"],
+        "corpus": ["pyyaml"]
+        },
     packages=find_packages(),
 )
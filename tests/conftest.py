@@ -0,0 +1,25 @@
+"""Shared helpers for the round trip tests: small, fast key structures"""
+import pytest
+from coinzdense.unstable.app import BlockChainEnv
+from coinzdense.unstable.wallet import _Wallet, _keypath_to_id
+
+
+def make_env(otsmode="dual", **entry):
+    """BlockChainEnv for app "APP" with a single two level key space entry"""
+    keyspace_entry = {"heights": [3, 3]}
+    keyspace_entry.update(entry)
+    return BlockChainEnv({"appname": "APP",
+                          "hashlen": 16,
+                          "otsbits": 4,
+                          "otsmode": otsmode,
+                          "keyspace": [keyspace_entry]})
+
+
+def make_key(env, seed):
+    """Signing key of an account of env, all accounts share the privid of the app path"""
+    return env.get_signing_key(_Wallet(b"", _keypath_to_id(["APP"]), bytes([seed]) * 32))
+
+
+@pytest.fixture
+def env():
+    return make_env()
@@ -0,0 +1,38 @@
+"""Level key bundles: round trip and rejection of bundles made for other key structures"""
+import pytest
+from coinzdense.unstable.wallet import _Wallet, _keypath_to_id
+from coinzdense.unstable.wen3.bundle import create_bundle, read_bundle, bundle_table_source
+from conftest import make_env
+
+
+def _wallet():
+    return _Wallet(b"", _keypath_to_id(["APP"]), bytes([7]) * 32)
+
+
+def test_bundle_round_trip():
+    env = make_env(otsbits=[4, 6], hashlen=[16, 20])
+    data = create_bundle(env, _wallet(), [])
+    bundle = read_bundle(data, _wallet(), env)
+    assert bundle["otsmode"] == "dual"
+    assert bundle["level_hashlen"] == [16, 20]
+    assert bundle["level_otsbits"] == [4, 6]
+    key = env.get_signing_key(_wallet(), table_source=bundle_table_source(data, _wallet(), env))
+    signature = key.sign_data(b"hello")
+    assert env.get_validator().signature(signature).validate_data(b"hello")
+
+
+def test_bundle_rejected_for_other_key_structure():
+    data = create_bundle(make_env(), _wallet(), [])
+    with pytest.raises(ValueError):
+        read_bundle(data, _wallet(), make_env(otsmode="wots"))
+    with pytest.raises(ValueError):
+        read_bundle(data, _wallet(), make_env(otsbits=[4, 6]))
+    with pytest.raises(ValueError):
+        bundle_table_source(data, _wallet(), make_env(heights=[3, 3, 3]))
+
+
+def test_tampered_header_rejected():
+    data = bytearray(create_bundle(make_env(), _wallet(), []))
+    data[7] ^= 1
+    with pytest.raises(ValueError):
+        read_bundle(bytes(data), _wallet())
@@ -0,0 +1,60 @@
+"""Distributed level key generation and the coordinator's work unit checks"""
+from concurrent.futures import Future
+import pytest
+from libnacl import crypto_kdf_derive_from_key
+from coinzdense.layerzero.level import LevelKey
+from coinzdense.layerzero.distributed import generate_level_key, process_work_unit, _subtree_levels
+from coinzdense.layerzero.distributed import _RESPONSE
+
+_SEED = b"k" * 32
+_HASHLEN = 16
+
+
+class _InlineTransport:
+    """Runs work units in process, tamper may rewrite a (first leaf, root, leaves) response"""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, tamper=None):
+        self.tamper = tamper
+
+    def submit(self, request):
+        response = process_work_unit(request)
+        if self.tamper is not None:
+            header = _RESPONSE.unpack_from(response)
+            body = response[_RESPONSE.size:]
+            leaves = [body[i:i + _HASHLEN] for i in range(_HASHLEN, len(body), _HASHLEN)]
+            root, leaves = self.tamper(header[3], body[:_HASHLEN], leaves)
+            response = response[:_RESPONSE.size] + root + b"".join(leaves)
+        future = Future()
+        future.set_result(response)
+        return future
+
+
+def _levelsalt():
+    return crypto_kdf_derive_from_key(_HASHLEN, 0, "levelslt", _SEED)
+
+
+def test_matches_local_level_key():
+    local = LevelKey(_SEED, 0, _HASHLEN, 4, 4)
+    local.get_pubkey()
+    remote = generate_level_key(_SEED, 0, _HASHLEN, 4, 4, _InlineTransport(), unit_height=1)
+    assert remote.pubkey == local.pubkey
+
+
+def test_root_that_does_not_match_the_leaves_is_rejected():
+    def tamper(first, root, leaves):
+        return (bytes(_HASHLEN) if first == 6 else root), leaves
+    with pytest.raises(RuntimeError):
+        generate_level_key(_SEED, 0, _HASHLEN, 4, 4, _InlineTransport(tamper), unit_height=1, samples=1)
+
+
+def test_every_work_unit_is_sampled():
+    salt = _levelsalt()
+
+    def tamper(first, root, leaves):
+        if first != 10:
+            return root, leaves
+        # A consistent but wrong subtree: the root check alone can not tell
+        leaves = [bytes(_HASHLEN)] * len(leaves)
+        return _subtree_levels(leaves, _HASHLEN, salt)[-1][0], leaves
+    with pytest.raises(RuntimeError):
+        generate_level_key(_SEED, 0, _HASHLEN, 4, 4, _InlineTransport(tamper), unit_height=1, samples=1)
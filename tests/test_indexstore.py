@@ -0,0 +1,43 @@
+"""Replay and one-time key reuse detection with an IndexStore"""
+from coinzdense.unstable.indexstore import IndexStore, NEW, REPLAY, REUSE
+from conftest import make_key
+
+
+def test_accounts_sharing_a_privid_do_not_collide(env):
+    alice = make_key(env, 1)
+    bob = make_key(env, 2)
+    assert alice.privid == bob.privid
+    validator = env.get_validator(IndexStore())
+    signatures = [alice.sign_data(b"from alice"), bob.sign_data(b"from bob")]
+    assert validator.validate_many(signatures, [b"from alice", b"from bob"]) == [True, True]
+
+
+def test_replay_and_reuse(env):
+    key = make_key(env, 1)
+    validator = env.get_validator(IndexStore())
+    signature = key.sign_data(b"first")
+    parsed = validator.signature(signature)
+    assert parsed.validate_data(b"first")
+    assert parsed.index_status == NEW
+    replayed = validator.signature(signature)
+    assert not replayed.validate_data(b"first")
+    assert replayed.index_status == REPLAY
+    # Same index signed again, as after restoring a stale backup
+    reused = make_key(env, 1).sign_data(b"second")
+    parsed = validator.signature(reused)
+    assert not parsed.validate_data(b"second")
+    assert parsed.index_status == REUSE
+
+
+def test_accepted_signatures_reach_the_log(env, tmp_path):
+    key = make_key(env, 1)
+    path = str(tmp_path / "index")
+    store = IndexStore(path)
+    validator = env.get_validator(store)
+    signatures = [key.sign_data(b"m%d" % number) for number in range(0, 3)]
+    assert validator.validate_many(signatures[:2]) == [True, True]
+    assert validator.signature(signatures[2]).validate()
+    # Reopened without closing, as after a crash
+    reopened = env.get_validator(IndexStore(path))
+    assert reopened.validate_many(signatures) == [False, False, False]
+    store.close()
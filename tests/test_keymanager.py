@@ -0,0 +1,13 @@
+"""State persistence of managed signing keys"""
+import json
+from coinzdense.unstable.keymanager import KeyManager
+from coinzdense.unstable.wallet import _Wallet, _keypath_to_id
+
+
+def test_state_is_written_before_the_signature_is_returned(env, tmp_path):
+    manager = KeyManager(str(tmp_path), 1 << 30)
+    manager.register("alice", env, _Wallet(b"", _keypath_to_id(["APP"]), b"a" * 32))
+    signature = manager.sign_data("alice", b"payment")
+    with open(str(tmp_path / "alice.json"), encoding="utf8") as statefile:
+        assert json.load(statefile)["idx"] == 1
+    assert env.get_validator().signature(signature).validate_data(b"payment")
@@ -0,0 +1,17 @@
+"""SigningService lifecycle"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from coinzdense.unstable.signer import SigningService
+
+
+def test_close_shuts_down_only_the_pools_it_created():
+    service = SigningService()
+    asyncio.run(service.close())
+    with pytest.raises(RuntimeError):
+        service._executor.submit(int)  # pylint: disable=protected-access
+    executor = ThreadPoolExecutor()
+    service = SigningService(executor)
+    asyncio.run(service.close())
+    assert executor.submit(int).result() == 0
+    executor.shutdown()
@@ -0,0 +1,62 @@
+"""Sign and validate round trips"""
+import io
+import pytest
+from coinzdense.unstable.archive import signature_archive, open_archive
+from conftest import make_env, make_key
+
+
+@pytest.mark.parametrize("otsmode", ["dual", "wots"])
+@pytest.mark.parametrize("entry", [{}, {"hashlen": [16, 20], "otsbits": [4, 6]}])
+def test_round_trip(otsmode, entry):
+    env = make_env(otsmode, **entry)
+    key = make_key(env, 1)
+    validator = env.get_validator()
+    data_signature = key.sign_data(b"payload")
+    string_signature = key.sign_string("payload")
+    assert validator.signature(data_signature).validate_data(b"payload")
+    assert validator.signature(string_signature).validate_string("payload")
+    assert not validator.signature(data_signature).validate_data(b"other payload")
+    other_mode = make_env("wots" if otsmode == "dual" else "dual", **entry)
+    assert other_mode.get_validator().validate_many([data_signature], [b"payload"]) == [False]
+
+
+def test_validate_many_mixed_full_and_compressed(env):
+    key = make_key(env, 1)
+    full = key.sign_data(b"first")
+    compressed = [key.sign_data(b"next %d" % number, compressed=True) for number in range(0, 3)]
+    assert all(len(signature) < len(full) for signature in compressed)
+    # A compressed signature without its full signature has nothing to chain to
+    assert env.get_validator().validate_many(compressed[:1], [b"next 0"]) == [False]
+    signatures = [compressed[0], full, compressed[1], compressed[2]]
+    messages = [b"next 0", b"first", b"next 1", b"wrong"]
+    assert env.get_validator().validate_many(signatures, messages) == [True, True, True, False]
+
+
+def test_archive_round_trip(env, tmp_path):
+    key = make_key(env, 1)
+    signatures = [key.sign_data(b"message %d" % number, compressed=number % 2 == 1) for number in range(0, 6)]
+    validator = env.get_validator()
+    writer = signature_archive(validator)
+    numbers = [writer.add(signature) for signature in signatures]
+    path = str(tmp_path / "signatures.arc")
+    writer.save(path)
+    reader = open_archive(path)
+    try:
+        assert len(reader) == len(signatures)
+        assert [reader[number] for number in numbers] == signatures
+        assert validator.validate_many([reader[number] for number in numbers],
+                                       [b"message %d" % number for number in range(0, 6)]) == [True] * 6
+    finally:
+        reader.close()
+
+
+def test_tree_signature_with_a_non_path_message_is_invalid(env, tmp_path):
+    payload = tmp_path / "payload"
+    payload.write_bytes(b"tree hashed payload")
+    key = make_key(env, 1)
+    signature = key.sign_tree(str(payload))
+    validator = env.get_validator()
+    assert not validator.signature(signature).validate_data(b"tree hashed payload")
+    assert not validator.signature(signature).validate_stream(io.BytesIO(b"tree hashed payload"))
+    assert validator.validate_many([signature], [b"tree hashed payload"]) == [False]
+    assert validator.signature(signature).validate_stream(str(payload))
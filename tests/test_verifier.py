@@ -0,0 +1,37 @@
+"""Verification service over its Unix domain socket"""
+import asyncio
+import pytest
+from coinzdense.unstable.verifier import VerificationService, VerificationClient
+from conftest import make_key
+
+
+def _serve(env, path, client):
+    """Run a verification service for env and call client(socket path) from a thread"""
+    async def main():
+        service = VerificationService()
+        service.add_from_env("app", env)
+        server = await service.serve(path)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, client)
+        finally:
+            server.close()
+            await service.close()
+    return asyncio.run(main())
+
+
+def test_tree_signatures_do_not_open_server_files(env, tmp_path):
+    secret = tmp_path / "secret"
+    secret.write_bytes(b"server side file contents")
+    key = make_key(env, 1)
+    signature = key.sign_tree(str(secret))
+    data_signature = key.sign_data(b"payload")
+    path = str(tmp_path / "verifier.sock")
+
+    def client():
+        with VerificationClient(path, "app") as verifier:
+            with pytest.raises(RuntimeError):
+                verifier.verify_string(signature, str(secret))
+            # Without a message the signature itself is still checked
+            assert verifier.verify(signature) is not None
+            return verifier.verify_data(data_signature, b"payload")
+    assert _serve(env, path, client) is not None